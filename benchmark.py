@@ -0,0 +1,634 @@
+"""Офлайн-бенчмарк vk2tg.
+
+Поднимает в отдельном процессе локальные заглушки API VK (execute/wall.get),
+CDN с фотографиями и Bot API Telegram (send*), направляет на них бота и
+гоняет его на синтетических стенах: только текст, альбомы по 10 фото,
+репосты с copy_history, видео заданного размера. Заглушкам можно задать задержку ответа, долю
+ошибок и долю ответов 429. В конце печатает число постов в секунду,
+p50/p99 задержки от публикации поста на стене до его прихода в Telegram
+и пиковое потребление памяти процессом бота.
+
+    python benchmark.py --scenario all --posts 200 --error-rate 0.02 --throttle-rate 0.05
+"""
+import argparse
+import email.parser
+import email.policy
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+from PIL import Image
+
+SCENARIOS = ('text', 'album', 'repost', 'video', 'mixed')
+MEDIA_METHODS = ('sendVideo', 'sendDocument', 'sendAnimation')
+# Тяжелые модули, которые не должны загружаться при импорте vk2tg
+HEAVY_MODULES = ('requests', 'PIL', 'asyncio', 'http.server', 'concurrent.futures.process', 'zstandard')
+IMPORT_PROBE = (
+    "import sys, time\n"
+    "t = time.perf_counter()\n"
+    "import vk2tg\n"
+    "print(time.perf_counter() - t)\n"
+    "print(' '.join(m for m in {modules!r} if m in sys.modules))\n"
+)
+MARKER = re.compile(r'benchpost(\d+)x(\d+)')
+LOREM = (
+    "Синтетический пост для замера производительности. "
+    "В нем есть немного текста, чтобы подпись не была пустой. "
+)
+
+# ---------------- Заглушки ----------------
+
+def make_jpeg(width, height):
+    # Шум поверх градиента сжимается примерно как обычная фотография
+    base = Image.radial_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    img = Image.merge('RGB', (base, noise, Image.blend(base, noise, 0.5)))
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=90)
+    return out.getvalue()
+
+
+def make_photo(cdn, owner_id, photo_id, size):
+    return {
+        'type': 'photo',
+        'photo': {
+            'id': photo_id,
+            'owner_id': owner_id,
+            'sizes': [
+                {'type': 'm', 'width': 130, 'height': 98, 'url': f'{cdn}/{owner_id}_{photo_id}_m.jpg'},
+                {'type': 'w', 'width': size[0], 'height': size[1], 'url': f'{cdn}/{owner_id}_{photo_id}.jpg'},
+            ]
+        }
+    }
+
+
+def make_post(cdn, owner_id, post_id, kind, size):
+    text = f"benchpost{abs(owner_id)}x{post_id} {LOREM}"
+    post = {'id': post_id, 'owner_id': owner_id, 'text': text, 'attachments': []}
+    if kind == 'album':
+        post['attachments'] = [make_photo(cdn, owner_id, post_id * 100 + n, size) for n in range(10)]
+    elif kind == 'video':
+        post['attachments'] = [{
+            'type': 'video',
+            'video': {
+                'id': post_id,
+                'owner_id': owner_id,
+                'title': f'video{post_id}',
+                'files': {'mp4_360': f'{cdn}/media/{owner_id}_{post_id}_360.mp4',
+                          'mp4_720': f'{cdn}/media/{owner_id}_{post_id}_720.mp4'},
+            }
+        }]
+    elif kind == 'repost':
+        source_id = -999
+        post['copy_history'] = [{
+            'id': post_id,
+            'owner_id': source_id,
+            'text': LOREM * 3,
+            'attachments': [make_photo(cdn, source_id, owner_id * -100000 + post_id * 10 + n, size) for n in range(4)]
+        }]
+    return post
+
+
+class StandIn:
+    """Состояние заглушек: стены, расписание публикаций и принятые Telegram посты."""
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.jpeg = make_jpeg(*options['photo_size'])
+        self.walls = {}
+        self.started = None
+        self.deliveries = {}
+        self.duplicates = 0
+        self.requests = {}
+        self.message_id = 0
+
+    def start(self, cdn, t0):
+        options = self.options
+        kinds = ('text', 'album', 'repost') if options['scenario'] == 'mixed' else (options['scenario'],)
+        rate = options['rate']
+        with self.lock:
+            self.walls = {}
+            for owner_id in options['owner_ids']:
+                wall = []
+                # Старые посты ниже позиции бота: на них чтение стены останавливается
+                for post_id in range(1, 6):
+                    post = make_post(cdn, owner_id, post_id, 'text', options['photo_size'])
+                    post['date'] = int(t0) - 3600
+                    wall.append((t0 - 3600, post))
+                for n in range(options['posts']):
+                    published = t0 + (n / rate if rate else 0)
+                    post = make_post(cdn, owner_id, n + 100, kinds[n % len(kinds)], options['photo_size'])
+                    post['date'] = int(published)
+                    wall.append((published, post))
+                self.walls[owner_id] = wall
+            self.started = t0
+            self.deliveries = {}
+            self.duplicates = 0
+            self.requests = {}
+
+    def published(self, owner_id, post_id):
+        for published, post in self.walls.get(owner_id, []):
+            if post['id'] == post_id:
+                return published
+        return None
+
+    def wall_get(self, params):
+        owner_id = int(params.get('owner_id', 0))
+        offset = int(params.get('offset', 0))
+        count = int(params.get('count', 20))
+        now = time.time()
+        visible = [post for published, post in self.walls.get(owner_id, []) if published <= now]
+        visible.reverse()
+        return {'count': len(visible), 'items': visible[offset:offset + count]}
+
+    def record(self, kind, chat_id, text):
+        match = MARKER.search(text or '')
+        if not match:
+            return
+        owner_id, post_id = -int(match.group(1)), int(match.group(2))
+        key = f'{owner_id}_{post_id}_{chat_id}'
+        with self.lock:
+            if key in self.deliveries:
+                self.duplicates += 1
+                return
+            published = self.published(owner_id, post_id)
+            self.deliveries[key] = {'published': published, 'received': time.time(), 'kind': kind}
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def next_message_id(self):
+        with self.lock:
+            self.message_id += 1
+            return self.message_id
+
+    def stats(self):
+        with self.lock:
+            return {
+                'deliveries': self.deliveries,
+                'duplicates': self.duplicates,
+                'requests': self.requests,
+            }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return {k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()}, 0
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body
+        )
+        fields, uploaded = {}, 0
+        for part in message.iter_parts():
+            payload = part.get_payload(decode=True) or b''
+            if part.get_filename():
+                uploaded += len(payload)
+            else:
+                fields[part.get_param('name', header='content-disposition')] = payload.decode('utf-8')
+        return fields, uploaded
+
+    def inject(self, latency):
+        # Задержка сети и сервера, затем случайная ошибка или ограничение
+        options = self.server.stand_in.options
+        if latency:
+            time.sleep(latency)
+        roll = random.random()
+        if roll < options['throttle_rate']:
+            return 'throttle'
+        if roll < options['throttle_rate'] + options['error_rate']:
+            return 'error'
+        return None
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        if self.path == '/_stats':
+            return self.reply(200, stand_in.stats())
+        if not self.path.startswith('/cdn/'):
+            return self.reply(404, b'', 'text/plain')
+        stand_in.count('cdn')
+        failure = self.inject(stand_in.options['cdn_latency'])
+        if failure == 'throttle':
+            return self.reply(429, b'', 'text/plain')
+        if failure == 'error':
+            return self.reply(500, b'', 'text/plain')
+        if self.path.startswith('/cdn/media/'):
+            return self.send_media(stand_in.options['media_bytes'])
+        # Хвост после конца JPEG у каждого фото свой, чтобы кэш по содержимому не склеивал их
+        self.reply(200, stand_in.jpeg + self.path.encode(), 'image/jpeg')
+
+    def send_media(self, size):
+        # Видео отдается потоком, чтобы заглушка сама не держала файл в памяти
+        block = os.urandom(1024 * 1024)
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        for offset in range(0, size, len(block)):
+            self.wfile.write(block[:size - offset])
+
+    def read_upload(self):
+        # Тело sendVideo/sendDocument читается по частям; поля берутся из начала, до файла
+        remaining = int(self.headers.get('Content-Length') or 0)
+        total, head = remaining, b''
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            if len(head) < 65536:
+                head += chunk[:65536 - len(head)]
+            remaining -= len(chunk)
+        fields = {
+            name.decode(): value.decode('utf-8', errors='ignore')
+            for name, value in re.findall(rb'name="(\w+)"\r\n\r\n(.*?)\r\n--', head, re.S)
+        }
+        return fields, total
+
+    def do_POST(self):
+        stand_in = self.server.stand_in
+        if self.path.rsplit('/', 1)[-1] in MEDIA_METHODS:
+            fields, uploaded = self.read_upload()
+        else:
+            fields, uploaded = self.read_form()
+        if self.path == '/_start':
+            stand_in.start(f'http://{self.headers["Host"]}/cdn', float(fields['t0']))
+            return self.reply(200, {'ok': True})
+        if self.path.startswith('/method/'):
+            return self.vk_method(self.path[len('/method/'):], fields)
+        match = re.match(r'/bot[^/]+/(\w+)$', self.path)
+        if match:
+            return self.telegram_method(match.group(1), fields, uploaded)
+        self.reply(404, b'', 'text/plain')
+
+    def vk_method(self, method, fields):
+        stand_in = self.server.stand_in
+        stand_in.count(method)
+        failure = self.inject(stand_in.options['vk_latency'])
+        if failure == 'throttle':
+            return self.reply(200, {'error': {'error_code': 6, 'error_msg': 'Too many requests per second'}})
+        if failure == 'error':
+            return self.reply(500, b'Internal Server Error', 'text/plain')
+        if method == 'execute':
+            calls = re.findall(r'API\.wall\.get\((\{.*?\})\)', fields.get('code', ''))
+            return self.reply(200, {'response': [stand_in.wall_get(json.loads(call)) for call in calls]})
+        if method == 'wall.get':
+            return self.reply(200, {'response': stand_in.wall_get(fields)})
+        self.reply(200, {'error': {'error_code': 3, 'error_msg': 'Unknown method passed'}})
+
+    def telegram_method(self, method, fields, uploaded):
+        stand_in = self.server.stand_in
+        stand_in.count(method)
+        # Загрузка файлов идет с ограниченной скоростью, как на реальном канале
+        bandwidth = stand_in.options['upload_bandwidth']
+        failure = self.inject(stand_in.options['tg_latency'] + (uploaded / bandwidth if bandwidth else 0))
+        if failure == 'throttle':
+            retry_after = stand_in.options['retry_after']
+            return self.reply(429, {
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {retry_after}',
+                'parameters': {'retry_after': retry_after}
+            })
+        if failure == 'error':
+            return self.reply(500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'})
+
+        chat_id = fields.get('chat_id')
+        if method == 'sendMediaGroup':
+            media = json.loads(fields.get('media', '[]'))
+            stand_in.record('album', chat_id, media[0].get('caption') if media else '')
+            return self.reply(200, {'ok': True, 'result': [self.message(chat_id, photo=True) for _ in media]})
+        if method == 'sendPhoto':
+            stand_in.record('photo', chat_id, fields.get('caption'))
+            return self.reply(200, {'ok': True, 'result': self.message(chat_id, photo=True)})
+        if method == 'sendMessage':
+            stand_in.record('text', chat_id, fields.get('text'))
+            return self.reply(200, {'ok': True, 'result': self.message(chat_id)})
+        if method in MEDIA_METHODS:
+            stand_in.record('video', chat_id, fields.get('caption'))
+            message = self.message(chat_id)
+            field = method[len('send'):].lower()
+            message[field] = {'file_id': f'{field}{message["message_id"]}', 'file_size': uploaded}
+            return self.reply(200, {'ok': True, 'result': message})
+        self.reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+    def message(self, chat_id, photo=False):
+        message_id = self.server.stand_in.next_message_id()
+        message = {'message_id': message_id, 'chat': {'id': chat_id}}
+        if photo:
+            message['photo'] = [
+                {'file_id': f'small{message_id}', 'width': 90, 'height': 68},
+                {'file_id': f'photo{message_id}', 'width': 1280, 'height': 960},
+            ]
+        return message
+
+
+def serve_stand_in(conn, options):
+    # Заглушки живут в своем процессе: их CPU и память не попадают в замер бота
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.stand_in = StandIn(options)
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+# ---------------- Замер ----------------
+
+def current_rss():
+    # Текущий RSS процесса в байтах (None, если узнать нельзя)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def configure(vk2tg, args, base_url, workdir, owner_ids):
+    settings = vk2tg.CONFIG['settings']
+    vk2tg.CONFIG['vk'].update({'token': 'bench', 'group_token': '', 'api_url': f'{base_url}/method'})
+    vk2tg.CONFIG['telegram'].update({'bot_token': 'bench', 'api_url': base_url})
+    vk2tg.CONFIG['routes'] = [
+        {'owner_id': owner_id, 'chat_ids': [f'@bench{abs(owner_id)}_{n}' for n in range(args.chats)]}
+        for owner_id in owner_ids
+    ]
+    settings.update({
+        'journal_path': os.path.join(workdir, 'bench.db'),
+        'engine': args.engine,
+        'use_longpoll': False,
+        'remote_media': args.remote_media,
+        'check_interval': args.poll_interval,
+        'poll_min_interval': args.poll_interval,
+        'poll_max_interval': max(5, args.poll_interval),
+        'max_fetch_posts': max(1000, args.posts + 10),
+        'retry_base_delay': 1,
+        'retry_max_delay': 5,
+        'metrics_port': 0,
+    })
+    if not args.real_limits:
+        # Без лимитов Telegram и VK замеряется сам конвейер, а не паузы планировщика
+        settings.update({'tg_global_rate': 10000, 'tg_chat_per_minute': 600000, 'vk_requests_per_second': 1000})
+
+
+def run_scenario(vk2tg, args, scenario):
+    owner_ids = [-(1000001 + n) for n in range(args.sources)]
+    options = {
+        'scenario': scenario,
+        'owner_ids': owner_ids,
+        'posts': args.posts,
+        'rate': args.rate,
+        'photo_size': tuple(int(x) for x in args.photo_size.lower().split('x')),
+        'media_bytes': int(args.video_mb * 1024 * 1024),
+        'vk_latency': args.vk_latency / 1000,
+        'cdn_latency': args.cdn_latency / 1000,
+        'tg_latency': args.tg_latency / 1000,
+        'upload_bandwidth': args.upload_mbit * 125000,
+        'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate,
+        'retry_after': args.retry_after,
+    }
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve_stand_in, args=(child, options), daemon=True)
+    server.start()
+    base_url = f'http://127.0.0.1:{parent.recv()}'
+    workdir = tempfile.mkdtemp(prefix='vk2tg-bench-')
+    bot = None
+    try:
+        configure(vk2tg, args, base_url, workdir, owner_ids)
+        bot = vk2tg.VK2TGBot()
+        t0 = time.time() + 0.5
+        for owner_id in owner_ids:
+            bot.save_last_post_time(owner_id, int(t0) - 1)
+        bot.journal.commit()
+        requests.post(f'{base_url}/_start', data={'t0': t0}, timeout=10)
+
+        if args.engine == 'async':
+            import asyncio
+            target = lambda: asyncio.run(bot.run_async())
+        else:
+            target = bot.run
+        worker = threading.Thread(target=target, name='bot', daemon=True)
+        worker.start()
+
+        expected = args.posts * args.sources * args.chats
+        deadline = time.time() + args.timeout
+        peak_rss = current_rss() or 0
+        stats = {}
+        while time.time() < deadline:
+            time.sleep(0.2)
+            peak_rss = max(peak_rss, current_rss() or 0)
+            stats = requests.get(f'{base_url}/_stats', timeout=10).json()
+            if len(stats['deliveries']) >= expected:
+                break
+        bot.stop()
+        worker.join(args.timeout)
+        stats = requests.get(f'{base_url}/_stats', timeout=10).json()
+    finally:
+        if bot is not None:
+            for pool in (bot.prefetch_pool, bot.download_pool, bot.transcode_pool):
+                if pool is not None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+            bot.journal.conn.close()
+        server.terminate()
+        server.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    deliveries = list(stats['deliveries'].values())
+    latencies = [d['received'] - d['published'] for d in deliveries if d['published'] is not None]
+    elapsed = max((d['received'] for d in deliveries), default=t0) - t0
+    return {
+        'scenario': scenario,
+        'delivered': len(deliveries),
+        'expected': expected,
+        'duplicates': stats['duplicates'],
+        'elapsed': elapsed,
+        'posts_per_sec': len(deliveries) / elapsed if elapsed > 0 else 0.0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'peak_rss': peak_rss,
+        'requests': stats['requests'],
+    }
+
+
+def format_report(results):
+    lines = [
+        f"{'сценарий':<8} {'доставлено':>11} {'дублей':>6} {'постов/с':>9} "
+        f"{'p50, с':>8} {'p99, с':>8} {'пик RSS, МБ':>12}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r['scenario']:<8} {r['delivered']:>5}/{r['expected']:<5} {r['duplicates']:>6} "
+            f"{r['posts_per_sec']:>9.2f} {r['p50']:>8.2f} {r['p99']:>8.2f} {r['peak_rss'] / 1048576:>12.1f}"
+        )
+    for r in results:
+        calls = ', '.join(f'{name}={count}' for name, count in sorted(r['requests'].items()))
+        lines.append(f"{r['scenario']}: запросы {calls}")
+    return '\n'.join(lines)
+
+
+def measure_import(runs):
+    """Медианное время холодного импорта vk2tg в свежих процессах и загруженные тяжелые модули."""
+    code = IMPORT_PROBE.format(modules=HEAVY_MODULES)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    imports, processes, loaded = [], [], set()
+    for _ in range(runs):
+        started = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', code], cwd=cwd, capture_output=True, text=True, check=True)
+        processes.append(time.perf_counter() - started)
+        lines = out.stdout.splitlines()
+        imports.append(float(lines[0]))
+        loaded.update(lines[1].split() if len(lines) > 1 else ())
+    return percentile(imports, 50), percentile(processes, 50), sorted(loaded)
+
+
+def measure_parsing(vk2tg, args):
+    """Стоимость разбора одного поста: декодирование ответа execute и process_post, мкс."""
+    owner_id = -1000001
+    size = tuple(int(x) for x in args.photo_size.lower().split('x'))
+    kinds = SCENARIOS[:4] if args.scenario in ('mixed', 'all') else (args.scenario,)
+    posts = [make_post('https://cdn.example', owner_id, n, kinds[n % len(kinds)], size)
+             for n in range(1, args.posts + 1)]
+    # Ответ execute с 25 страницами wall.get, как при опросе стен
+    pages = [{'count': len(posts), 'items': posts[i:i + 100]} for i in range(0, len(posts), 100)]
+    body = json.dumps({'response': (pages * 25)[:25]}, ensure_ascii=False).encode('utf-8')
+    decoded = sum(len(page['items']) for page in (pages * 25)[:25])
+
+    def per_post(func, count, repeat=5):
+        best = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - started)
+        return best / count * 1e6
+
+    workdir = tempfile.mkdtemp(prefix='vk2tg-bench-')
+    bot = None
+    try:
+        configure(vk2tg, args, 'http://127.0.0.1:9', workdir, [owner_id])
+        bot = vk2tg.VK2TGBot()
+        return {
+            'posts': len(posts),
+            'body_kb': len(body) / 1024,
+            'json': per_post(lambda: json.loads(body), decoded),
+            'json_loads': per_post(lambda: vk2tg.json_loads(body), decoded),
+            'decoder': getattr(vk2tg.json_loads, '__module__', None) or 'json',
+            'process_post': per_post(lambda: [bot.process_post(post) for post in posts], len(posts)),
+        }
+    finally:
+        if bot is not None:
+            bot.download_pool.shutdown(wait=False)
+            bot.prefetch_pool.shutdown(wait=False)
+            bot.journal.conn.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def format_startup_report(imported, process, loaded, parsing):
+    return '\n'.join([
+        f"импорт vk2tg (медиана): {imported * 1000:.1f} мс, процесс целиком: {process * 1000:.1f} мс",
+        f"тяжелые модули при импорте: {', '.join(loaded) or 'нет'}",
+        f"ответ execute: {parsing['body_kb']:.0f} КБ, постов на стене: {parsing['posts']}",
+        f"декодирование, мкс/пост: json {parsing['json']:.2f}, "
+        f"{parsing['decoder']} {parsing['json_loads']:.2f}",
+        f"process_post, мкс/пост: {parsing['process_post']:.2f}",
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк vk2tg на локальных заглушках VK и Telegram")
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='mixed',
+                        help="тип стены: только текст, альбомы по 10 фото, репосты, видео или все по очереди")
+    parser.add_argument('--engine', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--posts', type=int, default=100, help="постов на каждой стене")
+    parser.add_argument('--sources', type=int, default=1, help="число сообществ VK")
+    parser.add_argument('--chats', type=int, default=1, help="чатов Telegram на каждое сообщество")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="постов в секунду на стене (0 — все посты уже опубликованы к старту)")
+    parser.add_argument('--poll-interval', type=float, default=1, help="интервал опроса стен, с")
+    parser.add_argument('--photo-size', default='1280x960', help="размер фото на CDN")
+    parser.add_argument('--video-mb', type=float, default=20, help="размер видео на CDN, МБ")
+    parser.add_argument('--vk-latency', type=float, default=50, help="задержка ответа VK, мс")
+    parser.add_argument('--cdn-latency', type=float, default=20, help="задержка ответа CDN, мс")
+    parser.add_argument('--tg-latency', type=float, default=100, help="задержка ответа Telegram, мс")
+    parser.add_argument('--upload-mbit', type=float, default=0,
+                        help="скорость загрузки файлов в Telegram, Мбит/с (0 — без ограничения)")
+    parser.add_argument('--error-rate', type=float, default=0, help="доля ответов с ошибкой 500")
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help="доля ответов 429 (в VK — ошибка 6)")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429 Telegram, с")
+    parser.add_argument('--remote-media', action='store_true',
+                        help="отдавать Telegram ссылки на фото вместо загрузки файлов")
+    parser.add_argument('--real-limits', action='store_true',
+                        help="оставить лимиты Telegram и VK из CONFIG")
+    parser.add_argument('--timeout', type=float, default=300, help="предел времени на сценарий, с")
+    parser.add_argument('--output', help="сохранить отчет в файл")
+    parser.add_argument('--verbose', action='store_true', help="показывать журнал бота")
+    parser.add_argument('--startup', type=int, nargs='?', const=10, default=0, metavar='RUNS',
+                        help="замерить холодный старт (RUNS запусков) и разбор постов вместо доставки")
+    args = parser.parse_args()
+
+    import vk2tg
+    # Импорт vk2tg не настраивает журнал (это делает vk2tg.main), поэтому
+    # ошибки, подстроенные заглушками, не попадут в журнал настоящего бота
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL, format=vk2tg.LOG_FORMAT)
+
+    if args.startup:
+        imported, process, loaded = measure_import(args.startup)
+        report = format_startup_report(imported, process, loaded, measure_parsing(vk2tg, args))
+        print(report)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(report + '\n')
+        return
+
+    scenarios = SCENARIOS[:4] if args.scenario == 'all' else (args.scenario,)
+    results = []
+    for scenario in scenarios:
+        print(f"Сценарий {scenario}...", file=sys.stderr)
+        results.append(run_scenario(vk2tg, args, scenario))
+    report = format_report(results)
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+
+if __name__ == "__main__":
+    main()
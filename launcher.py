@@ -2,10 +2,11 @@
 import os
 import sys
 import json
-import subprocess
+import copy
+import secrets
 import threading
 import time
-import requests
+from collections import deque
 from datetime import datetime
 import warnings
 
@@ -17,12 +18,14 @@ warnings.filterwarnings(
 
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QTabWidget,
-    QFormLayout, QLineEdit, QPushButton, QTextBrowser, QGraphicsOpacityEffect
+    QFormLayout, QLineEdit, QPushButton, QPlainTextEdit, QGraphicsOpacityEffect,
+    QDateTimeEdit, QComboBox
 )
-from PyQt6.QtGui import QIcon, QTextCursor, QPixmap
-from PyQt6.QtCore import Qt, QTimer, pyqtSignal, QObject, QPropertyAnimation
+from PyQt6.QtGui import QIcon, QTextCursor, QPixmap, QTextCharFormat, QColor, QFont
+from PyQt6.QtCore import Qt, QTimer, QPropertyAnimation, QProcess, QProcessEnvironment, QDateTime
+from PyQt6.QtNetwork import QTcpServer, QHostAddress
 
-from vk2tg import CONFIG
+from vk2tg import CONFIG, CONFIG_PATH, LogArchive, RestartPolicy, load_config, validate_config, apply_config
 import logging
 
 logging.basicConfig(
@@ -33,9 +36,33 @@ logging.basicConfig(
     errors = "ignore"
 )
 
-# ---------------- Signals ----------------
-class LogEmitter(QObject):
-    new_line = pyqtSignal(str, bool)
+# ---------------- Log Buffer ----------------
+class LogBuffer:
+    """Кольцевой буфер строк журнала между выводом бота и окном.
+
+    Чтение вывода только складывает строки, окно забирает их пачкой раз
+    за кадр. Если окно не успевает, старые строки вытесняются: показывать
+    их все равно было бы негде.
+    """
+
+    def __init__(self, max_lines):
+        self.lines = deque(maxlen=max_lines)
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def push(self, text, mode):
+        line = (f'[{datetime.now().strftime("%H:%M:%S")}] {text}', mode)
+        with self.lock:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(line)
+
+    def drain(self):
+        with self.lock:
+            lines, dropped = list(self.lines), self.dropped
+            self.lines.clear()
+            self.dropped = 0
+        return lines, dropped
 
 # ---------------- Title Bar ----------------
 class TitleBar(QWidget):
@@ -85,10 +112,30 @@ class BotGUI(QWidget):
         super().__init__()
         self.bot_running = False
         self.vk_process = None
-        self.stdout_thread = None
-        self.stderr_thread = None
-        self.log_emitter = LogEmitter()
-        self.log_emitter.new_line.connect(self.handle_new_line)
+        self.output_tail = {False: b"", True: b""}
+        self.log_max_lines = max(100, int(CONFIG.get('settings', {}).get('log_max_lines', 5000)))
+        self.log_buffer = LogBuffer(self.log_max_lines)
+        self.log_formats = {}
+        for mode, color in {"normal": "white", "info": "cyan", "warning": "orange", "error": "red"}.items():
+            fmt = QTextCharFormat()
+            fmt.setForeground(QColor(color))
+            self.log_formats[mode] = fmt
+
+        # События бота (NDJSON) приходят на локальный сокет; токен отсекает чужие подключения
+        self.events_token = secrets.token_hex(16)
+        self.events_server = QTcpServer(self)
+        self.events_server.newConnection.connect(self.accept_events)
+        if not self.events_server.listen(QHostAddress(QHostAddress.SpecialAddress.LocalHost), 0):
+            logging.warning(f"Канал событий недоступен: {self.events_server.errorString()}")
+        self.event_sockets = {}
+        self.events_socket = None
+        self.sent_times = deque()
+        self.last_lag = None
+        self.queue_depth = 0
+        self.error_count = 0
+        # Страницы истории журнала читаются по мере прокрутки
+        self.history_pages = None
+        self.history_lines = 0
 
         self.ui_colors = [(30,30,50),(50,30,60),(30,50,50),(60,30,30),(30,30,30)]
         self.ui_index = 0
@@ -105,9 +152,28 @@ class BotGUI(QWidget):
         # ---------------- UI ----------------
         self.init_ui()
         self.tabs.currentChanged.connect(self.animate_tab_change)
-        self.ui_timer = QTimer(self)
-        self.ui_timer.timeout.connect(self.ui_tick)
-        self.ui_timer.start(40)
+        # Журнал перерисовывается не чаще раза за кадр, сколько бы строк ни пришло
+        self.log_timer = QTimer(self)
+        self.log_timer.setSingleShot(True)
+        self.log_timer.setInterval(16)
+        self.log_timer.timeout.connect(self.flush_log)
+
+        # Супервизор: перезапуск после падения, проверка heartbeat, принудительная остановка
+        settings = CONFIG.get('settings', {})
+        self.supervise = False
+        self.started_at = 0
+        self.restart_policy = RestartPolicy.from_config()
+        self.restart_timer = QTimer(self)
+        self.restart_timer.setSingleShot(True)
+        self.restart_timer.timeout.connect(self.spawn_worker)
+        self.watchdog = QTimer(self)
+        self.watchdog.setSingleShot(True)
+        self.watchdog.setInterval(int(settings.get('heartbeat_timeout', 30) * 1000))
+        self.watchdog.timeout.connect(self.worker_hung)
+        self.kill_timer = QTimer(self)
+        self.kill_timer.setSingleShot(True)
+        self.kill_timer.setInterval(int((settings.get('shutdown_timeout', 10) + 5) * 1000))
+        self.kill_timer.timeout.connect(self.kill_worker)
 
     # ---------------- UI Init ----------------
     def init_ui(self):
@@ -130,10 +196,13 @@ class BotGUI(QWidget):
         # Tabs
         self.main_tab = QWidget()
         self.settings_tab = QWidget()
+        self.history_tab = QWidget()
         self.tabs.addTab(self.main_tab, "Главная")
+        self.tabs.addTab(self.history_tab, "История")
         self.tabs.addTab(self.settings_tab, "Настройки")
 
         self.init_main_tab()
+        self.init_history_tab()
         self.init_settings_tab()
 
     # ---------------- Main Tab ----------------
@@ -144,6 +213,9 @@ class BotGUI(QWidget):
 
         status_row = QHBoxLayout()
         status_row.setSpacing(12)
+        self.stats_label = QLabel()
+        self.stats_label.setStyleSheet("color:#ddd; font-size:13px;")
+        status_row.addWidget(self.stats_label)
         status_row.addStretch()
 
         self.start_btn = QPushButton("Старт")
@@ -161,8 +233,15 @@ class BotGUI(QWidget):
 
         layout.addLayout(status_row)
 
-        self.log_box = QTextBrowser()
-        self.log_box.setOpenExternalLinks(True)
+        self.log_box = QPlainTextEdit()
+        self.log_box.setReadOnly(True)
+        # Документ хранит не больше log_max_lines строк, старые удаляются сами
+        self.log_box.setMaximumBlockCount(self.log_max_lines)
+        self.log_box.setUndoRedoEnabled(False)
+        font = QFont("monospace")
+        font.setStyleHint(QFont.StyleHint.Monospace)
+        font.setPixelSize(12)
+        self.log_box.setFont(font)
         self.log_box.setStyleSheet("background-color:transparent; color:#ddd; padding:8px; border:none;")
         layout.addWidget(self.log_box,1)
 
@@ -171,6 +250,96 @@ class BotGUI(QWidget):
         layout.addWidget(hint)
 
         self.main_tab.setLayout(layout)
+        self.update_stats()
+
+    # ---------------- History Tab ----------------
+    def init_history_tab(self):
+        layout = QVBoxLayout()
+        layout.setContentsMargins(12,12,12,12)
+        layout.setSpacing(10)
+
+        filter_row = QHBoxLayout()
+        filter_row.setSpacing(8)
+        now = QDateTime.currentDateTime()
+        self.history_from = QDateTimeEdit(now.addDays(-1))
+        self.history_to = QDateTimeEdit(now)
+        for edit in (self.history_from, self.history_to):
+            edit.setDisplayFormat("dd.MM.yyyy HH:mm")
+            edit.setCalendarPopup(True)
+        self.history_level = QComboBox()
+        for title, level in (("Все", "DEBUG"), ("INFO и выше", "INFO"), ("Предупреждения", "WARNING"), ("Ошибки", "ERROR")):
+            self.history_level.addItem(title, level)
+        show_btn = QPushButton("Показать")
+        show_btn.setFixedHeight(30)
+        show_btn.clicked.connect(self.show_history)
+        filter_row.addWidget(QLabel("С"))
+        filter_row.addWidget(self.history_from)
+        filter_row.addWidget(QLabel("по"))
+        filter_row.addWidget(self.history_to)
+        filter_row.addWidget(self.history_level)
+        filter_row.addStretch()
+        filter_row.addWidget(show_btn)
+        layout.addLayout(filter_row)
+
+        self.history_box = QPlainTextEdit()
+        self.history_box.setReadOnly(True)
+        self.history_box.setUndoRedoEnabled(False)
+        self.history_box.setFont(self.log_box.font())
+        self.history_box.setStyleSheet("background-color:transparent; color:#ddd; padding:8px; border:none;")
+        self.history_box.verticalScrollBar().valueChanged.connect(self.history_scrolled)
+        layout.addWidget(self.history_box,1)
+
+        self.history_status = QLabel("Журнал, включая сжатые части в папке logs.")
+        self.history_status.setStyleSheet("color:#9aa9b2; font-size:12px;")
+        layout.addWidget(self.history_status)
+
+        self.history_tab.setLayout(layout)
+
+    def show_history(self):
+        if self.history_pages is not None:
+            self.history_pages.close()
+        self.history_box.clear()
+        self.history_lines = 0
+        start = self.history_from.dateTime().toSecsSinceEpoch()
+        # Конец диапазона включает всю выбранную минуту
+        end = self.history_to.dateTime().toSecsSinceEpoch() + 60
+        self.history_pages = LogArchive().pages(start, end, self.history_level.currentData())
+        # Первые страницы — пока окно не заполнится, дальше по прокрутке
+        for _ in range(2):
+            self.load_history_page()
+
+    def history_scrolled(self, value):
+        if self.history_pages is not None and value >= self.history_box.verticalScrollBar().maximum():
+            self.load_history_page()
+
+    def load_history_page(self):
+        if self.history_pages is None:
+            return
+        try:
+            page = next(self.history_pages, None)
+        except OSError as e:
+            page = None
+            self.append_log(f"Ошибка чтения журнала: {e}", mode="error")
+        if page is None:
+            self.history_pages = None
+            self.history_status.setText(f"Строк: {self.history_lines}, это весь диапазон.")
+            return
+        cursor = QTextCursor(self.history_box.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.beginEditBlock()
+        for text in page:
+            if " - ERROR - " in text or " - CRITICAL - " in text:
+                mode = "error"
+            elif " - WARNING - " in text:
+                mode = "warning"
+            else:
+                mode = "normal"
+            if not self.history_box.document().isEmpty():
+                cursor.insertBlock()
+            cursor.insertText(text, self.log_formats[mode])
+        cursor.endEditBlock()
+        self.history_lines += len(page)
+        self.history_status.setText(f"Строк: {self.history_lines}, прокрутите вниз, чтобы загрузить еще.")
 
     # ---------------- Settings Tab ----------------
     def init_settings_tab(self):
@@ -210,107 +379,237 @@ class BotGUI(QWidget):
     # ---------------- Save Settings ----------------
     def save_settings(self):
         try:
-            CONFIG['vk']['token'] = self.vk_token_input.text().strip()
-            CONFIG['vk']['owner_id'] = int(self.owner_id_input.text().strip())
-            CONFIG['vk']['api_version'] = self.api_version_input.text().strip()
-            CONFIG['telegram']['bot_token'] = self.tg_token_input.text().strip()
-            CONFIG['telegram']['chat_id'] = self.tg_chat_input.text().strip()
-            CONFIG['telegram']['bot_username'] = self.tg_botname_input.text().strip()
-            with open("config.json", "w", encoding="utf-8", errors="ignore") as f:
-                json.dump(CONFIG, f, ensure_ascii=False, indent=2)
+            # Проверяем копию: неверные значения не попадают ни в файл, ни в CONFIG
+            config = copy.deepcopy(CONFIG)
+            config['vk']['token'] = self.vk_token_input.text().strip()
+            config['vk']['owner_id'] = int(self.owner_id_input.text().strip())
+            config['vk']['api_version'] = self.api_version_input.text().strip()
+            config['telegram']['bot_token'] = self.tg_token_input.text().strip()
+            config['telegram']['chat_id'] = self.tg_chat_input.text().strip()
+            config['telegram']['bot_username'] = self.tg_botname_input.text().strip()
+            validate_config(config)
+            # Пишем во временный файл и подменяем: работающий бот не прочитает файл наполовину
+            tmp_path = CONFIG_PATH + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8", errors="ignore") as f:
+                json.dump(config, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, CONFIG_PATH)
+            apply_config(config)
             self.append_log("Настройки сохранены в config.json", mode="info")
         except Exception as e:
             self.append_log(f"Ошибка сохранения настроек: {e}", mode="error")
 
     # ---------------- Logs ----------------
     def append_log(self, text, mode="normal"):
-        color = {"normal": "white","info":"cyan","error":"red"}.get(mode,"white")
-        html = f'<div style="color:{color}; font-family: monospace; font-size:12px;">'
-        html += f'[{datetime.now().strftime("%H:%M:%S")}] {text}</div>'
-        self.log_box.insertHtml(html + "<br>")
-        self.log_box.moveCursor(QTextCursor.MoveOperation.End)
+        # Строка попадет в окно при следующей отрисовке вместе с остальными
+        self.log_buffer.push(text, mode)
+        if not self.log_timer.isActive():
+            self.log_timer.start()
+
+    def flush_log(self):
+        lines, dropped = self.log_buffer.drain()
+        if not lines:
+            return
+        scrollbar = self.log_box.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum() - 4
+        cursor = QTextCursor(self.log_box.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.beginEditBlock()
+        if dropped:
+            lines.insert(0, (f"... пропущено строк: {dropped}", "info"))
+        for text, mode in lines:
+            if not self.log_box.document().isEmpty():
+                cursor.insertBlock()
+            cursor.insertText(text, self.log_formats.get(mode, self.log_formats["normal"]))
+        cursor.endEditBlock()
+        # Прокручиваем вниз, только если пользователь не листает историю
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
 
     # ---------------- Handle new line ----------------
     def handle_new_line(self, text, is_err):
-        lowered = text.lower()
-        if "ошибка" in lowered or is_err:
+        # Цвет по уровню записи лога; ошибки считаются по событиям, а не по тексту
+        if is_err or " - ERROR - " in text or " - CRITICAL - " in text:
             self.append_log(text, mode="error")
+        elif " - WARNING - " in text:
+            self.append_log(text, mode="warning")
         else:
             self.append_log(text, mode="normal")
 
+    # ---------------- Events ----------------
+    def accept_events(self):
+        while self.events_server.hasPendingConnections():
+            sock = self.events_server.nextPendingConnection()
+            self.event_sockets[sock] = False
+            sock.readyRead.connect(lambda s=sock: self.read_events(s))
+            sock.disconnected.connect(lambda s=sock: self.drop_events_socket(s))
+
+    def drop_events_socket(self, sock):
+        self.event_sockets.pop(sock, None)
+        if sock is self.events_socket:
+            self.events_socket = None
+        sock.deleteLater()
+
+    def read_events(self, sock):
+        while sock.canReadLine():
+            line = bytes(sock.readLine()).decode("utf-8", errors="ignore")
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if not self.event_sockets.get(sock):
+                # Первое событие должно быть hello с токеном этого запуска
+                if event.get("type") != "hello" or event.get("token") != self.events_token:
+                    sock.abort()
+                    return
+                self.event_sockets[sock] = True
+                self.events_socket = sock
+                continue
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        kind = event.get("type")
+        # Любое событие — признак жизни; тишина дольше heartbeat_timeout означает зависание
+        if self.vk_process is not None:
+            self.watchdog.start()
+        if kind == "post_sent":
+            self.sent_times.append(time.monotonic())
+            self.last_lag = event.get("lag")
+        elif kind == "heartbeat":
+            self.queue_depth = event.get("outbox", 0) + event.get("queue", 0)
+            if event.get("idle", 0) > CONFIG.get('settings', {}).get('hang_timeout', 1800):
+                self.worker_hung()
+        elif kind == "error":
+            self.error_count += 1
+        self.update_stats()
+
+    def update_stats(self):
+        # Посты за последнюю минуту; окно сдвигается с каждым событием, heartbeat приходит регулярно
+        now = time.monotonic()
+        while self.sent_times and now - self.sent_times[0] > 60:
+            self.sent_times.popleft()
+        lag = f"{self.last_lag:.0f} с" if self.last_lag is not None else "—"
+        self.stats_label.setText(
+            f"Постов/мин: {len(self.sent_times)}   Задержка: {lag}   "
+            f"Очередь: {self.queue_depth}   Ошибок: {self.error_count}"
+        )
+
     # ---------------- Bot process ----------------
     def start_bot(self):
-        if self.bot_running:
+        if self.supervise:
             self.append_log("Бот уже запущен", mode="info")
             return
+        self.supervise = True
+        self.restart_policy.reset()
+        self.sent_times.clear()
+        self.last_lag = None
+        self.error_count = 0
+        self.update_stats()
+        self.spawn_worker()
+
+    def spawn_worker(self):
         python_exe = sys.executable
         script_path = os.path.join(os.getcwd(), "vk2tg.py")
         if not os.path.exists(script_path):
             self.append_log(f"vk2tg.py не найден в {script_path}", mode="error")
+            self.supervise = False
             return
-        try:
-            self.vk_process = subprocess.Popen(
-                [python_exe, script_path],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1,
-                universal_newlines=True,
-                encoding="utf-8",
-                errors = "ignore"
-            )
-        except Exception as e:
-            self.append_log(f"Не удалось запустить процесс: {e}", mode="error")
+        args = [script_path]
+        if self.events_server.isListening():
+            args.append(f"--events=127.0.0.1:{self.events_server.serverPort()}")
+        env = QProcessEnvironment.systemEnvironment()
+        env.insert("VK2TG_EVENTS_TOKEN", self.events_token)
+        env.insert("PYTHONIOENCODING", "utf-8")
+        env.insert("PYTHONUNBUFFERED", "1")
+
+        # QProcess сообщает о выводе и завершении сигналами: ни потоков чтения, ни опроса poll()
+        self.vk_process = QProcess(self)
+        self.vk_process.setProcessEnvironment(env)
+        self.vk_process.setWorkingDirectory(os.getcwd())
+        self.vk_process.readyReadStandardOutput.connect(lambda: self.read_output(False))
+        self.vk_process.readyReadStandardError.connect(lambda: self.read_output(True))
+        self.vk_process.finished.connect(self.process_finished)
+        self.output_tail = {False: b"", True: b""}
+        self.started_at = time.monotonic()
+        self.vk_process.start(python_exe, args)
+        if not self.vk_process.waitForStarted(5000):
+            self.append_log(f"Не удалось запустить процесс: {self.vk_process.errorString()}", mode="error")
+            self.vk_process.deleteLater()
+            self.vk_process = None
+            self.schedule_restart()
             return
-        self._stop_threads = False
-        self.stdout_thread = threading.Thread(target=self._read_stream,args=(self.vk_process.stdout,False),daemon=True)
-        self.stderr_thread = threading.Thread(target=self._read_stream,args=(self.vk_process.stderr,True),daemon=True)
-        self.stdout_thread.start()
-        self.stderr_thread.start()
         self.bot_running = True
+        if self.events_server.isListening():
+            self.watchdog.start()
         self.append_log("Скрипт запущен.", mode="info")
 
     def stop_bot(self):
-        if not self.bot_running:
+        if not self.supervise and not self.bot_running:
             self.append_log("Скрипт уже остановлен", mode="info")
             return
-        try:
-            if self.vk_process:
-                self.vk_process.terminate()
-                try:
-                    self.vk_process.wait(timeout=5)
-                except Exception:
-                    try:
-                        self.vk_process.kill()
-                    except Exception:
-                        pass
-            self._stop_threads = True
-            if self.stdout_thread and self.stdout_thread.is_alive():
-                self.stdout_thread.join(timeout=1)
-            if self.stderr_thread and self.stderr_thread.is_alive():
-                self.stderr_thread.join(timeout=1)
-        except Exception as e:
-            self.append_log(f"Ошибка при остановке процесса: {e}", mode="error")
-        self.vk_process = None
-        self.bot_running = False
-        self.append_log("Скрипт отключен", mode="info")
+        self.supervise = False
+        self.restart_timer.stop()
+        self.watchdog.stop()
+        if self.vk_process is None:
+            self.append_log("Скрипт отключен", mode="info")
+            return
+        self.request_stop()
+
+    def request_stop(self):
+        # Бот дописывает текущий пост и выходит; неотправленные остаются в outbox до следующего запуска
+        if self.events_socket is not None:
+            self.events_socket.write(b'{"type": "stop"}\n')
+            self.events_socket.flush()
+        elif os.name == "nt":
+            # Консольный процесс Windows не отвечает на terminate() (WM_CLOSE)
+            self.vk_process.kill()
+        else:
+            self.vk_process.terminate()
+        self.kill_timer.start()
 
-    def _read_stream(self, stream, is_err):
-        try:
-            for line in stream:
-                if line is None: break
-                line = line.rstrip("\n")
-                self.log_emitter.new_line.emit(line, is_err)
-                if getattr(self,"_stop_threads",False):
-                    break
-        except Exception as e:
-            self.log_emitter.new_line.emit(f"Ошибка чтения потока: {e}", True)
+    def kill_worker(self):
+        if self.vk_process is not None:
+            self.vk_process.kill()
+
+    def worker_hung(self):
+        if self.vk_process is None:
+            return
+        self.append_log("Бот не отвечает, перезапускаем", mode="error")
+        self.watchdog.stop()
+        self.kill_worker()
+
+    def schedule_restart(self):
+        delay = self.restart_policy.crashed(time.monotonic() - self.started_at)
+        if delay is None:
+            self.append_log("Бот падает слишком часто, автоматический перезапуск остановлен", mode="error")
+            self.supervise = False
+            return
+        self.append_log(f"Перезапуск через {delay} с", mode="info")
+        self.restart_timer.start(int(delay * 1000))
 
-    # ---------------- UI Tick ----------------
-    def ui_tick(self):
-        if self.bot_running and self.vk_process and self.vk_process.poll() is not None:
-            self.append_log(f"vk2tg.py процесс завершился с кодом {self.vk_process.returncode}", mode="error")
-            self.bot_running = False
+    def read_output(self, is_err):
+        process = self.vk_process
+        if process is None:
+            return
+        data = bytes(process.readAllStandardError() if is_err else process.readAllStandardOutput())
+        # Незаконченная строка ждет следующей порции вывода
+        lines = (self.output_tail[is_err] + data).split(b"\n")
+        self.output_tail[is_err] = lines.pop()
+        for line in lines:
+            self.handle_new_line(line.decode("utf-8", errors="ignore").rstrip("\r"), is_err)
+
+    def process_finished(self, exit_code, exit_status):
+        self.read_output(False)
+        self.read_output(True)
+        self.kill_timer.stop()
+        self.watchdog.stop()
+        self.bot_running = False
+        self.vk_process.deleteLater()
+        self.vk_process = None
+        if not self.supervise:
+            self.append_log("Скрипт отключен", mode="info")
+            return
+        self.append_log(f"vk2tg.py процесс завершился с кодом {exit_code}", mode="error")
+        self.schedule_restart()
 
     # ---------------- Tab Animation ----------------
     def animate_tab_change(self, index):
@@ -339,12 +638,24 @@ class BotGUI(QWidget):
     # ---------------- Close Event ----------------
     def closeEvent(self, event):
         try:
-            if self.bot_running: self.stop_bot()
+            process = self.vk_process
+            if self.supervise or self.bot_running: self.stop_bot()
+            if process is not None and process.state() != QProcess.ProcessState.NotRunning:
+                if not process.waitForFinished(self.kill_timer.interval()):
+                    process.kill()
+                    process.waitForFinished(1000)
         except: pass
         event.accept()
 
 # ---------------- Main ----------------
 def main():
+    # Форма настроек показывает то, что сохранено в config.json, даже если там еще не все заполнено
+    try:
+        apply_config(load_config(CONFIG_PATH, validate=False))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.error(f"Не удалось прочитать {CONFIG_PATH}: {e}")
     app = QApplication(sys.argv)
     try:
         import qdarktheme
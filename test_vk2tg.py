@@ -0,0 +1,169 @@
+# test_vk2tg.py — офлайн-проверки vk2tg: python -m unittest test_vk2tg
+import copy
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import vk2tg
+
+
+class BotTestCase(unittest.TestCase):
+    """Бот во временном каталоге; VK и Telegram недоступны (порт 9)."""
+
+    settings = {}
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp(prefix='vk2tg-test-')
+        os.chdir(self.workdir)
+        config = copy.deepcopy(vk2tg.DEFAULT_CONFIG)
+        config['vk'].update({'token': 't', 'owner_id': -5, 'api_url': 'http://127.0.0.1:9/method'})
+        config['telegram'].update({'bot_token': 'b', 'chat_id': '@c', 'api_url': 'http://127.0.0.1:9'})
+        config['settings'].update({'journal_path': 'vk2tg.db', 'use_longpoll': False, **self.settings})
+        vk2tg.apply_config(config)
+        self.bot = None
+
+    def tearDown(self):
+        if self.bot is not None:
+            self.bot.download_pool.shutdown(wait=False)
+            self.bot.prefetch_pool.shutdown(wait=False)
+            self.bot.journal.conn.close()
+        vk2tg.apply_config(copy.deepcopy(vk2tg.DEFAULT_CONFIG))
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class LegacyCursorTest(BotTestCase):
+    """Обновление с версии, хранившей позицию в last_post_time.txt."""
+
+    def test_start_with_legacy_file(self):
+        with open('last_post_time.txt', 'w') as f:
+            f.write('1700000000')
+        self.bot = vk2tg.VK2TGBot()
+        self.assertIn(-5, self.bot.cursors)
+        self.assertEqual(self.bot.journal.get_cursor(-5), self.bot.cursors[-5])
+
+    def test_legacy_last_post_is_not_resent(self):
+        # В last_post_time.txt — дата поста, который старая версия уже отправила
+        with open('last_post_time.txt', 'w') as f:
+            f.write('1700000000')
+        self.bot = vk2tg.VK2TGBot()
+        delivered = {'id': 7, 'owner_id': -5, 'date': 1700000000, 'text': 'old'}
+        new = {'id': 8, 'owner_id': -5, 'date': 1700000001, 'text': 'new'}
+        self.bot.enqueue_posts([delivered, new])
+        self.assertEqual([item['post_id'] for item in self.bot.outbox.due()], [8])
+
+
+class PrefetchLimitTest(BotTestCase):
+    """prefetch_max_bytes учитывает и фото, которые еще качаются."""
+
+    settings = {'remote_media': False, 'prefetch_max_bytes': 3 * 1024 * 1024}
+
+    def test_pending_downloads_count_toward_limit(self):
+        self.bot = vk2tg.VK2TGBot()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.bot.fetch_images = lambda urls: release.wait(5) and [b'x' * 1024 * 1024] * len(urls)
+        items = [
+            {'payload': vk2tg.PostContent('', [f'https://cdn/{n}.jpg'], [f'-5_{n}'])}
+            for n in range(10)
+        ]
+        self.assertEqual(len(self.bot.prefetch(items)), 3)
+
+
+class WallPagingTest(BotTestCase):
+    """Пост, удаленный на стене посреди чтения, не сдвигает страницы мимо соседнего."""
+
+    settings = {'page_size': 10}
+
+    def setUp(self):
+        super().setUp()
+        self.bot = vk2tg.VK2TGBot()
+        self.wall = [{'id': n, 'owner_id': -5, 'date': 1700000000 + n, 'text': str(n)} for n in range(30, 0, -1)]
+        self.bot.cursors[-5] = 1700000001
+
+    def wall_get(self, call):
+        page = self.wall[call['offset']:call['offset'] + call['count']]
+        if call['offset'] == 0:
+            self.wall = [post for post in self.wall if post['id'] != 25]
+        return {'items': page}
+
+    def fake_vk_call(self, method, params):
+        if method == 'wall.get':
+            return {'response': self.wall_get(params)}
+        calls = re.findall(r'API\.wall\.get\((\{.*?\})\)', params['code'])
+        return {'response': [self.wall_get(json.loads(call)) for call in calls]}
+
+    def test_get_vk_posts(self):
+        self.bot.vk_call = self.fake_vk_call
+        ids = [post['id'] for post in self.bot.get_vk_posts(-5)]
+        self.assertEqual(sorted(ids), list(range(1, 31)))
+
+    def test_fetch_walls(self):
+        self.bot.vk_call = self.fake_vk_call
+        ids = [post['id'] for post in self.bot.fetch_walls([-5])]
+        self.assertEqual(sorted(ids), list(range(1, 31)))
+
+
+class LeaseFencingTest(unittest.TestCase):
+    """Epoch аренды: воркер, потерявший источник, не продолжает отправку."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='vk2tg-test-')
+        self.store = vk2tg.SqliteLeaseStore(os.path.join(self.workdir, 'leases.db'))
+
+    def tearDown(self):
+        self.store.conn.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_expired_lease_is_fenced(self):
+        old = vk2tg.ShardMember(self.store, 'a', 0.2)
+        old.epochs[-5] = self.store.acquire('-5', 'a', 0.2)
+        self.assertTrue(old.holds(-5))
+        time.sleep(0.3)
+        # Аренда истекла и перешла к другому воркеру, пока старый стоял
+        self.assertEqual(self.store.acquire('-5', 'b', 10), old.epochs[-5] + 1)
+        self.assertFalse(old.holds(-5))
+        # Даже если старый воркер снова возьмет источник, прежний epoch недействителен
+        self.store.release('-5', 'b')
+        epoch = self.store.acquire('-5', 'a', 10)
+        self.assertEqual(epoch, old.epochs[-5] + 2)
+        self.assertFalse(old.holds(-5))
+        self.assertTrue(self.store.holds('-5', 'a', epoch))
+
+
+class LogPruneTest(unittest.TestCase):
+    """log_keep_segments удаляет самые старые части, а не первые по имени."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='vk2tg-test-')
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+
+    def segment(self, name, second):
+        path = os.path.join(self.workdir, name + '.log')
+        with open(path, 'w') as f:
+            f.write(f'2026-10-17 12:00:{second},000 - INFO - {name}\n')
+        vk2tg.compress_log_segment(path)
+
+    def test_same_second_rotation(self):
+        self.segment('vk2tg-20261017-120000', '00')
+        # Вторая ротация в ту же секунду, но строки в ней позже
+        self.segment('vk2tg-20261017-120000-1', '01')
+        self.segment('vk2tg-20261017-115959', '00')
+        settings = {'log_dir': self.workdir, 'log_keep_segments': 1}
+        with mock.patch.dict(vk2tg.CONFIG['settings'], settings):
+            handler = vk2tg.LogSegmentHandler(os.path.join(self.workdir, 'vk2tg.log'))
+            handler.compress_all(self.workdir)
+        self.assertEqual(
+            sorted(os.listdir(self.workdir)), ['vk2tg-20261017-120000-1.idx', 'vk2tg-20261017-120000-1.log.gz']
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
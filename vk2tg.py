@@ -1,109 +1,2447 @@
-import requests
+# Тяжелые модули (requests, Pillow, asyncio, http.server) импортируются там, где нужны:
+# лаунчер берет отсюда только настройки, и импорт не должен ничего запускать
 import time
 import os
+import copy
 import json
 import logging
+import re
+import functools
+import hashlib
+import heapq
+import glob
+import gzip
+import mmap
+import struct
 from urllib.parse import quote
-from PIL import Image
 import io
 import sys
+import signal
+import selectors
+import socket
+import sqlite3
+import subprocess
+import secrets
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+try:
+    # orjson разбирает ответы VK в несколько раз быстрее json
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 # -*- coding: utf-8 -*-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("vk2tg.log", encoding="utf-8"),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-
 # Конфигурация
 CONFIG = {
     'vk': {
         'token': '',
         'owner_id': "YOURIDGROUP", 
-        'api_version': '5.131'
+        'api_version': '5.131',
+        'group_token': '',  # Ключ сообщества, нужен для Bots Long Poll
+        'api_url': 'https://api.vk.com/method'  # Адрес API (меняется только для тестовых стендов)
     },
     'telegram': {
         'bot_token': 'YourBotToken',
         'chat_id': '@IDGroup',
-        'bot_username': 'idBot'
+        'bot_username': 'idBot',
+        'api_url': 'https://api.telegram.org'  # Адрес Bot API (свой сервер или тестовый стенд)
     },
     'settings': {
         'button_text': 'Button_Text',
         'check_interval': 60,
         'timeout': 30,
         'max_retries': 3,
-        'max_images': 10  # Максимальное количество изображений в медиагруппе
-    }
+        'max_images': 10,  # Максимальное количество изображений в медиагруппе
+        'download_workers': 4,  # Сколько изображений альбома качаем одновременно
+        'use_longpoll': True,  # Получать новые посты через Bots Long Poll вместо опроса wall.get
+        'longpoll_wait': 25,  # Сколько секунд сервер long poll держит запрос
+        'longpoll_retry': 300,  # Через сколько секунд снова пробовать long poll после отказа
+        'page_size': 100,  # Постов в одном запросе wall.get (максимум VK — 100)
+        'max_fetch_posts': 1000,  # Предел постов, просматриваемых за один цикл (остаток стены дочитывается в следующих)
+        'initial_posts': 10,  # Сколько последних постов взять при первом запуске
+        'journal_path': 'vk2tg.db',  # Журнал доставленных постов (SQLite)
+        'remote_media': True,  # Отдавать Telegram ссылки VK на фото вместо загрузки файлов
+        'file_id_cache_size': 50000,  # Сколько file_id Telegram хранить в кэше
+        'file_id_cache_days': 30,  # Через сколько дней запись кэша file_id устаревает
+        'transcode': True,  # Пережимать скачанные фото в JPEG под ограничения Telegram
+        'transcode_workers': 2,  # Процессов для пережатия фото
+        'jpeg_quality': 87,  # Качество JPEG при пережатии
+        'max_photo_side': 2560,  # Длинная сторона фото после уменьшения (Telegram больше не показывает)
+        'max_photo_bytes': 10 * 1024 * 1024,  # Предел Telegram для sendPhoto
+        'tg_global_rate': 30,  # Сообщений в секунду на бота (лимит Telegram)
+        'tg_chat_per_minute': 20,  # Сообщений в минуту в одну группу/канал (лимит Telegram)
+        'retry_base_delay': 30,  # Первая пауза перед повтором неотправленного поста, с
+        'retry_max_delay': 3600,  # Максимальная пауза между повторами, с
+        'max_attempts': 8,  # После стольких неудач пост уходит в очередь неотправленных
+        'engine': 'sync',  # 'async' — получение, подготовка и отправка идут параллельными задачами
+        'queue_size': 100,  # Размер очереди постов между получением и подготовкой (async)
+        'shutdown_timeout': 10,  # Сколько секунд ждать завершения отправки при остановке (async)
+        'prefetch_posts': 2,  # Сколько следующих постов качать, пока отправляется текущий
+        'prefetch_max_bytes': 50 * 1024 * 1024,  # Предел памяти под заранее скачанные фото
+        'poll_min_interval': 30,  # Самый частый опрос одного источника, с
+        'poll_max_interval': 900,  # Самый редкий опрос одного источника (и предел паузы при ошибках), с
+        'vk_requests_per_second': 2,  # Бюджет запросов к API VK (VK допускает 3 в секунду)
+        'metrics_port': 0,  # Порт HTTP /metrics в формате Prometheus (0 — выключено)
+        'metrics_host': '127.0.0.1',  # Адрес, на котором слушает /metrics
+        'log_max_lines': 5000,  # Сколько последних строк журнала держит окно лаунчера
+        'heartbeat_interval': 5,  # Как часто бот сообщает лаунчеру, что жив, с
+        'heartbeat_timeout': 30,  # Без heartbeat дольше этого бот считается зависшим, с
+        'hang_timeout': 1800,  # Основной цикл не двигается дольше этого — бот завис, с
+        'restart_base_delay': 5,  # Первая пауза перед перезапуском упавшего бота, с
+        'restart_max_delay': 300,  # Максимальная пауза перед перезапуском, с
+        'crash_loop_limit': 5,  # Столько падений подряд за crash_loop_window — перезапуски прекращаются
+        'crash_loop_window': 600,  # Окно подсчета падений, с
+        'stable_uptime': 120,  # Проработав столько, бот считается стабильным и пауза сбрасывается, с
+        'max_upload_bytes': 50 * 1024 * 1024,  # Предел Telegram для загрузки видео и документов
+        'media_timeout': 300,  # Таймаут загрузки и отправки видео и документов, с
+        'media_temp_dir': '',  # Каталог для временных файлов видео и документов ('' — системный)
+        'lease_store': '',  # Хранилище аренды источников для --worker/--shards ('' — файл journal_path + '.leases')
+        'lease_ttl': 60,  # Срок аренды источника воркером; умерший воркер отдает источники через столько, с
+        'migration_pages': 24,  # Страниц wall.get по 100 постов в одном execute при переносе стены (до 24)
+        'migration_prefetch': 10,  # Сколько следующих постов качать заранее при переносе стены
+        'migration_report_interval': 30,  # Как часто писать в лог ход переноса стены, с
+        'edit_window': 86400,  # Сколько секунд после публикации переносить в Telegram правки поста (0 — не переносить)
+        'edit_poll_interval': 300,  # При long poll: как часто читать первую страницу стены ради правок и удалений, с (0 — никогда)
+        'propagate_deletes': True,  # Удалять в Telegram посты, удаленные со стены VK (в пределах edit_window)
+        'log_dir': 'logs',  # Каталог сжатых частей журнала vk2tg.log
+        'log_max_bytes': 10 * 1024 * 1024,  # Размер vk2tg.log, после которого он сжимается в отдельную часть
+        'log_rotate_hours': 24,  # Не реже чем через столько часов vk2tg.log сжимается в отдельную часть (0 — только по размеру)
+        'log_keep_segments': 60,  # Сколько сжатых частей журнала хранить
+        'log_compression': 'gzip'  # 'gzip' или 'zstd' (нужен пакет zstandard)
+    },
+    # Маршруты: из какого сообщества VK в какие чаты Telegram.
+    # Пустой список — одна пара vk.owner_id -> telegram.chat_id.
+    # Пример: [{'owner_id': -123, 'chat_ids': ['@news', '@archive']}]
+    'routes': []
 }
 
-class VK2TGBot:
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({'User-Agent': 'VK2TG/2.0'})
-        self.last_post_time = self.load_last_post_time()
+DEFAULT_CONFIG = copy.deepcopy(CONFIG)
+CONFIG_PATH = 'config.json'
+# Эти настройки читаются только при запуске, на лету они не меняются
+RESTART_SETTINGS = (
+    'journal_path', 'engine', 'download_workers', 'transcode_workers', 'queue_size',
+    'metrics_port', 'metrics_host', 'heartbeat_interval', 'lease_store', 'lease_ttl'
+)
+# Эти настройки делятся на них или задают темп опроса, поэтому должны быть больше нуля
+POSITIVE_SETTINGS = (
+    'check_interval', 'timeout', 'max_images', 'page_size', 'poll_min_interval', 'poll_max_interval',
+    'vk_requests_per_second', 'tg_global_rate', 'tg_chat_per_minute', 'heartbeat_interval', 'lease_ttl',
+    'migration_pages'
+)
+
+def merge_config(base, override):
+    # Значения из файла поверх умолчаний; вложенные разделы сливаются, остальное заменяется
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge_config(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+def validate_config(config):
+    """Проверяет настройки целиком; при ошибке поднимает ValueError с описанием."""
+    for section in ('vk', 'telegram', 'settings'):
+        if not isinstance(config.get(section), dict):
+            raise ValueError(f"раздел {section} должен быть объектом")
+    telegram = config['telegram']
+    if not isinstance(telegram.get('bot_token'), str) or not telegram['bot_token'].strip():
+        raise ValueError("не задан telegram.bot_token")
+
+    routes = config.get('routes') or []
+    if not isinstance(routes, list):
+        raise ValueError("routes должен быть списком")
+    if not routes:
+        routes = [{'owner_id': config['vk'].get('owner_id'), 'chat_ids': [telegram.get('chat_id')]}]
+    for route in routes:
+        if not isinstance(route, dict):
+            raise ValueError("каждый маршрут должен быть объектом")
+        try:
+            int(route.get('owner_id'))
+        except (TypeError, ValueError):
+            raise ValueError(f"owner_id {route.get('owner_id')!r} должен быть числом")
+        chat_ids = route.get('chat_ids') or [route.get('chat_id')]
+        if not isinstance(chat_ids, list) or not all(
+            isinstance(chat_id, (str, int)) and not isinstance(chat_id, bool) and str(chat_id).strip()
+            for chat_id in chat_ids
+        ):
+            raise ValueError(f"для источника {route.get('owner_id')} не указан чат Telegram")
+
+    settings = config['settings']
+    for key, default in DEFAULT_CONFIG['settings'].items():
+        value = settings.get(key, default)
+        if isinstance(default, bool):
+            if not isinstance(value, bool):
+                raise ValueError(f"settings.{key} должен быть true или false")
+        elif isinstance(default, (int, float)):
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f"settings.{key} должен быть неотрицательным числом")
+    for key in POSITIVE_SETTINGS:
+        if settings.get(key, DEFAULT_CONFIG['settings'][key]) <= 0:
+            raise ValueError(f"settings.{key} должен быть больше нуля")
+    if settings.get('poll_min_interval', 30) > settings.get('poll_max_interval', 900):
+        raise ValueError("settings.poll_min_interval больше poll_max_interval")
+    return config
+
+def load_config(path=CONFIG_PATH, validate=True):
+    """Читает config.json поверх настроек по умолчанию (CONFIG не меняется)."""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path} должен содержать объект JSON")
+    config = merge_config(copy.deepcopy(DEFAULT_CONFIG), data)
+    return validate_config(config) if validate else config
+
+def apply_config(config):
+    # Разделы заменяются целиком: поток, читающий CONFIG, видит либо старый раздел, либо новый
+    CONFIG.update(config)
+
+def legacy_table(conn, table):
+    # Таблица из схемы до маршрутизации (без chat_id) откладывается в <table>_legacy
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if columns and 'chat_id' not in columns:
+        for index in conn.execute(f'PRAGMA index_list({table})').fetchall():
+            if index[3] == 'c':
+                conn.execute(f'DROP INDEX {index[1]}')
+        conn.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+
+def copy_legacy_table(conn, table, chat_id):
+    # Переносим старые записи в новую таблицу, считая их отправленными в chat_id
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table}_legacy)')]
+    if not columns:
+        return
+    names = ', '.join(columns)
+    conn.execute(
+        f'INSERT OR IGNORE INTO {table} ({names}, chat_id) SELECT {names}, ? FROM {table}_legacy',
+        (str(chat_id),)
+    )
+    conn.execute(f'DROP TABLE {table}_legacy')
+
+# ---------------- Журнал ----------------
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+LOG_LINE = re.compile(rb'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - ([A-Z]+) - ')
+LOG_LEVELS = {'DEBUG': 1, 'INFO': 2, 'WARNING': 4, 'ERROR': 8, 'CRITICAL': 16}
+# Сжатая часть журнала — блоки по LOG_BLOCK_SIZE байт, каждый сжат отдельно, поэтому
+# любой блок читается без распаковки предыдущих. Индекс рядом: по записи на блок
+# (время первой и последней строки, маска уровней, смещение и длина в файле, число строк)
+LOG_BLOCK_SIZE = 256 * 1024
+LOG_INDEX_MAGIC = b'VK2TGIX1'
+LOG_INDEX_RECORD = struct.Struct('<ddBQII')
+LOG_CODECS = {'gzip': ('.gz', lambda data: gzip.compress(data, 6), gzip.decompress)}
+
+def log_codec(name):
+    # zstd подключается при первом обращении, если установлен пакет zstandard
+    if name == 'zstd' and 'zstd' not in LOG_CODECS:
+        try:
+            import zstandard
+            LOG_CODECS['zstd'] = (
+                '.zst', lambda data: zstandard.ZstdCompressor().compress(data),
+                lambda data: zstandard.ZstdDecompressor().decompress(data)
+            )
+        except ImportError:
+            pass
+    return LOG_CODECS.get(name) or LOG_CODECS['gzip']
+
+@functools.lru_cache(maxsize=1024)
+def log_second(second):
+    # Подряд идущие строки журнала почти всегда из одной секунды, а strptime медленный
+    return time.mktime(time.strptime(second.decode(), '%Y-%m-%d %H:%M:%S'))
+
+def parse_log_line(line):
+    """(время, бит уровня) строки журнала или None для продолжения записи (traceback и т.п.)."""
+    match = LOG_LINE.match(line)
+    if not match:
+        return None
+    return log_second(match.group(1)) + int(match.group(2)) / 1000, LOG_LEVELS.get(match.group(3).decode(), 2)
+
+def compress_log_segment(path, compression='gzip'):
+    """Сжимает vk2tg-*.log блоками и пишет индекс .idx; исходный файл удаляется.
+
+    Файлы пишутся под временными именами, так что прерванное сжатие
+    просто повторится со следующего запуска.
+    """
+    extension, compress, _ = log_codec(compression)
+    base = path[:-len('.log')]
+    temp = f'.{os.getpid()}.tmp'
+    records = []
+    with open(path, 'rb') as source, open(base + '.log' + extension + temp, 'wb') as target:
+        block, first, last, levels, lines = [], None, None, 0, 0
+        size = 0
+        for line in source:
+            parsed = parse_log_line(line)
+            if parsed:
+                last, level = parsed
+                first = last if first is None else first
+                levels |= level
+            block.append(line)
+            size += len(line)
+            lines += 1
+            if size >= LOG_BLOCK_SIZE:
+                data = compress(b''.join(block))
+                records.append((first or 0, last or 0, levels, target.tell(), len(data), lines))
+                target.write(data)
+                # Продолжение записи в следующем блоке относится ко времени и уровню ее начала
+                block, first, levels, size, lines = [], last, 0, 0, 0
+        if block:
+            data = compress(b''.join(block))
+            records.append((first or 0, last or 0, levels, target.tell(), len(data), lines))
+            target.write(data)
+    with open(base + '.idx' + temp, 'wb') as index:
+        index.write(LOG_INDEX_MAGIC)
+        for record in records:
+            index.write(LOG_INDEX_RECORD.pack(*record))
+    # Сначала данные, потом индекс: часть без индекса читатель не видит
+    os.replace(base + '.log' + extension + temp, base + '.log' + extension)
+    os.replace(base + '.idx' + temp, base + '.idx')
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def log_segment_order(index_path):
+    """Ключ сортировки сжатых частей по времени: (первое время из индекса, номер части в секунде).
+
+    По имени сортировать нельзя: vk2tg-…-HHMMSS-1 (вторая ротация в ту же
+    секунду) идет раньше vk2tg-…-HHMMSS. Если в индексе нет времени,
+    берется время изменения файла.
+    """
+    name = os.path.basename(index_path)[:-len('.idx')]
+    parts = name.split('-')
+    number = int(parts[3]) if len(parts) > 3 and parts[3].isdigit() else 0
+    try:
+        with open(index_path, 'rb') as f:
+            head = f.read(len(LOG_INDEX_MAGIC) + LOG_INDEX_RECORD.size)
+        started = 0
+        if head.startswith(LOG_INDEX_MAGIC) and len(head) == len(LOG_INDEX_MAGIC) + LOG_INDEX_RECORD.size:
+            started = LOG_INDEX_RECORD.unpack_from(head, len(LOG_INDEX_MAGIC))[0]
+        return started or os.path.getmtime(index_path), number
+    except OSError:
+        return 0, number
+
+class LogSegmentHandler(logging.Handler):
+    """Запись в vk2tg.log со сжатием старых частей в log_dir.
+
+    Когда файл вырастает до log_max_bytes или его первой строке больше
+    log_rotate_hours часов, он переименовывается в log_dir/vk2tg-<время>.log
+    и сжимается в фоне (compress_log_segment). Файл открывается на каждую
+    запись: журнал пишут несколько процессов (супервизор, воркеры), и
+    переименовать его может любой из них. Старые части сверх
+    log_keep_segments удаляются.
+    """
+
+    def __init__(self, path='vk2tg.log'):
+        super().__init__()
+        self.path = path
+        self.rotate_at = None
+        self.last_size = 0
+        self.compressor = None
+        self.compress_pending()
+
+    def emit(self, record):
+        try:
+            data = (self.format(record) + '\n').encode('utf-8', errors='replace')
+            self.maybe_rotate(record.created)
+            with open(self.path, 'ab') as f:
+                f.write(data)
+        except Exception:
+            self.handleError(record)
+
+    def first_time(self):
+        try:
+            with open(self.path, 'rb') as f:
+                parsed = parse_log_line(f.readline())
+        except OSError:
+            parsed = None
+        return parsed[0] if parsed else time.time()
+
+    def maybe_rotate(self, now):
+        settings = CONFIG['settings']
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            self.rotate_at = None
+            return
+        if self.rotate_at is None or size < self.last_size:
+            # Новый файл, в том числе после ротации в другом процессе
+            hours = settings.get('log_rotate_hours', 24)
+            self.rotate_at = self.first_time() + hours * 3600 if hours else float('inf')
+        self.last_size = size
+        max_bytes = settings.get('log_max_bytes', 10 * 1024 * 1024)
+        if size and ((max_bytes and size >= max_bytes) or now >= self.rotate_at):
+            self.rotate(now)
+
+    def rotate(self, now):
+        directory = CONFIG['settings'].get('log_dir', 'logs')
+        os.makedirs(directory, exist_ok=True)
+        lock = os.path.join(directory, '.rotate.lock')
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Ротацию делает другой процесс; замок упавшего процесса снимаем через минуту
+            try:
+                if time.time() - os.path.getmtime(lock) > 60:
+                    os.remove(lock)
+            except OSError:
+                pass
+            return
+        try:
+            self.rotate_at = None
+            name = time.strftime('vk2tg-%Y%m%d-%H%M%S', time.localtime(self.first_time()))
+            target = os.path.join(directory, name + '.log')
+            suffix = 1
+            while any(os.path.exists(target[:-len('.log')] + ext) for ext in ('.log', '.idx')):
+                target = os.path.join(directory, f'{name}-{suffix}.log')
+                suffix += 1
+            try:
+                os.rename(self.path, target)
+            except OSError:
+                # Windows не дает переименовать файл, открытый в другом процессе: попробуем позже
+                self.rotate_at = now + 60
+                return
+        finally:
+            os.close(fd)
+            os.remove(lock)
+        self.last_size = 0
+        self.compress_pending()
+
+    def compress_pending(self):
+        # Несжатые части и мусор прерванного сжатия (в том числе от прошлого запуска) разбираются в фоне
+        if self.compressor is not None and self.compressor.is_alive():
+            return
+        directory = CONFIG['settings'].get('log_dir', 'logs')
+        if not any(glob.glob(os.path.join(directory, pattern)) for pattern in ('vk2tg-*.log', 'vk2tg-*.tmp')):
+            return
+        self.compressor = threading.Thread(target=self.compress_all, args=(directory,), name='log-compress', daemon=True)
+        self.compressor.start()
+
+    def compress_all(self, directory):
+        settings = CONFIG['settings']
+        for path in glob.glob(os.path.join(directory, 'vk2tg-*.tmp')):
+            # Временные файлы прерванного сжатия; свежие может писать другой процесс
+            try:
+                if time.time() - os.path.getmtime(path) > 3600:
+                    os.remove(path)
+            except OSError:
+                pass
+        for path in sorted(glob.glob(os.path.join(directory, 'vk2tg-*.log'))):
+            try:
+                compress_log_segment(path, settings.get('log_compression', 'gzip'))
+            except OSError:
+                # Файл сжимает другой процесс
+                continue
+        indexes = sorted(glob.glob(os.path.join(directory, 'vk2tg-*.idx')), key=log_segment_order)
+        for index in indexes[:max(0, len(indexes) - settings.get('log_keep_segments', 60))]:
+            for path in glob.glob(index[:-len('.idx')] + '.*'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+class LogArchive:
+    """Чтение журнала по времени и уровню: сжатые части из log_dir и текущий vk2tg.log.
+
+    В сжатых частях по индексу распаковываются только блоки, попавшие в
+    диапазон и содержащие нужные уровни. Текущий файл читается через mmap
+    с двоичным поиском начала диапазона. pages() отдает строки страницами
+    по мере чтения, поэтому файлы целиком в память не попадают.
+    """
+
+    def __init__(self, path='vk2tg.log', directory=None):
+        self.path = path
+        self.directory = directory or CONFIG['settings'].get('log_dir', 'logs')
+        log_codec('zstd')
+
+    def segments(self):
+        """Части журнала по времени: (первое время, последнее время, путь, индекс или None)."""
+        segments = []
+        for index_path in glob.glob(os.path.join(self.directory, 'vk2tg-*.idx')):
+            base = index_path[:-len('.idx')]
+            data = next((
+                (base + '.log' + ext, decompress)
+                for ext, _, decompress in LOG_CODECS.values() if os.path.exists(base + '.log' + ext)
+            ), None)
+            if data is None:
+                continue
+            with open(index_path, 'rb') as f:
+                raw = f.read()
+            if not raw.startswith(LOG_INDEX_MAGIC):
+                continue
+            records = list(LOG_INDEX_RECORD.iter_unpack(raw[len(LOG_INDEX_MAGIC):]))
+            if records:
+                segments.append((records[0][0], max(r[1] for r in records), data, records))
+        # Несжатые: еще ждущие сжатия части и текущий файл
+        for path in sorted(glob.glob(os.path.join(self.directory, 'vk2tg-*.log'))) + [self.path]:
+            try:
+                with open(path, 'rb') as f:
+                    parsed = parse_log_line(f.readline())
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            segments.append((parsed[0] if parsed else mtime, mtime, (path, None), None))
+        segments.sort(key=lambda segment: segment[0])
+        return segments
+
+    def pages(self, start=None, end=None, min_level='DEBUG', page_size=500):
+        """Строки журнала в [start, end] с уровнем не ниже min_level, списками по page_size."""
+        start = start or 0
+        end = end or float('inf')
+        mask = sum(bit for bit in LOG_LEVELS.values() if bit >= LOG_LEVELS.get(min_level, 1))
+        page = []
+        for first, last, (path, decompress), records in self.segments():
+            if last < start or first > end:
+                continue
+            if records is None:
+                blocks = self.plain_blocks(path, start)
+            else:
+                blocks = self.compressed_blocks(path, decompress, records, start, end, mask)
+            keep = False
+            for block in blocks:
+                for line in block.splitlines():
+                    parsed = parse_log_line(line)
+                    if parsed:
+                        if parsed[0] > end:
+                            break
+                        keep = parsed[0] >= start and bool(parsed[1] & mask)
+                    if keep:
+                        page.append(line.decode('utf-8', errors='replace'))
+                        if len(page) >= page_size:
+                            yield page
+                            page = []
+                else:
+                    continue
+                break
+        if page:
+            yield page
+
+    def compressed_blocks(self, path, decompress, records, start, end, mask):
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for first, last, levels, offset, length, _ in records:
+                if last >= start and first <= end and levels & mask:
+                    yield decompress(data[offset:offset + length])
+
+    def plain_blocks(self, path, start):
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # Двоичный поиск первой записи не раньше start
+                lo, hi = 0, len(data)
+                while hi - lo > LOG_BLOCK_SIZE // 16:
+                    mid = (lo + hi) // 2
+                    pos = data.find(b'\n', mid) + 1
+                    parsed = None
+                    while 0 < pos < hi and parsed is None:
+                        parsed = parse_log_line(data[pos:data.find(b'\n', pos) + 1 or len(data)])
+                        if parsed is None:
+                            pos = data.find(b'\n', pos) + 1
+                    if parsed is None:
+                        hi = mid
+                    elif parsed[0] < start:
+                        lo = pos
+                    else:
+                        hi = mid
+                while lo < len(data):
+                    stop = data.find(b'\n', min(len(data), lo + LOG_BLOCK_SIZE))
+                    stop = len(data) if stop < 0 else stop + 1
+                    yield data[lo:stop]
+                    lo = stop
+
+def setup_logging():
+    # Настройка логирования: вызывается при запуске бота, а не при импорте модуля
+    logging.basicConfig(
+        level=logging.INFO,
+        format=LOG_FORMAT,
+        handlers=[
+            LogSegmentHandler("vk2tg.log"),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
+class OutboundQueue:
+    """Очередь исходящих постов и очередь неотправленных (dead letters).
+
+    Обработанный пост сначала попадает в outbox и отправляется оттуда.
+    Неудачи откладывают пост с экспоненциальной паузой, а после
+    max_attempts попыток он переносится в dead_letters, откуда его можно
+    посмотреть и вернуть в очередь. Живет в базе журнала.
+    """
+
+    def __init__(self, journal, base_delay, max_delay, max_attempts, legacy_chat_id=''):
+        self.journal = journal
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        with journal.lock:
+            conn = journal.conn
+            legacy_table(conn, 'outbox')
+            legacy_table(conn, 'dead_letters')
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    owner_id INTEGER NOT NULL,
+                    post_id INTEGER NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    date INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at INTEGER NOT NULL,
+                    PRIMARY KEY (owner_id, post_id, chat_id)
+                );
+                CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt_at);
+                CREATE TABLE IF NOT EXISTS dead_letters (
+                    owner_id INTEGER NOT NULL,
+                    post_id INTEGER NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    date INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    failed_at INTEGER NOT NULL,
+                    PRIMARY KEY (owner_id, post_id, chat_id)
+                );
+            """)
+            copy_legacy_table(conn, 'outbox', legacy_chat_id)
+            copy_legacy_table(conn, 'dead_letters', legacy_chat_id)
+            conn.commit()
+
+    def contains(self, owner_id, post_id, chat_id):
+        with self.journal.lock:
+            conn = self.journal.conn
+            for table in ('outbox', 'dead_letters'):
+                row = conn.execute(
+                    f'SELECT 1 FROM {table} WHERE owner_id = ? AND post_id = ? AND chat_id = ?',
+                    (owner_id, post_id, str(chat_id))
+                ).fetchone()
+                if row:
+                    return True
+        return False
+
+    def enqueue(self, owner_id, post_id, chat_id, date, payload):
+        with self.journal.lock:
+            self.journal.conn.execute(
+                'INSERT OR IGNORE INTO outbox '
+                '(owner_id, post_id, chat_id, date, payload, attempts, next_attempt_at) '
+                'VALUES (?, ?, ?, ?, ?, 0, ?)',
+                (owner_id, post_id, str(chat_id), date,
+                 json.dumps(payload.to_payload(), ensure_ascii=False), int(time.time()))
+            )
+
+    def due(self, chat_id=None, owner_ids=None):
+        # Готовые к отправке посты в порядке публикации в VK (все или для одного чата
+        # и только из источников owner_ids, если он задан)
+        where, params = '', ()
+        if chat_id is not None:
+            where, params = ' AND chat_id = ?', (str(chat_id),)
+        if owner_ids is not None:
+            owner_ids = list(owner_ids)
+            if not owner_ids:
+                return []
+            where += f" AND owner_id IN ({', '.join('?' * len(owner_ids))})"
+            params += tuple(owner_ids)
+        with self.journal.lock:
+            rows = self.journal.conn.execute(
+                'SELECT owner_id, post_id, chat_id, date, payload, attempts FROM outbox '
+                f'WHERE next_attempt_at <= ?{where} ORDER BY date, post_id',
+                (int(time.time()),) + params
+            ).fetchall()
+        return [
+            {'owner_id': r[0], 'post_id': r[1], 'chat_id': r[2], 'date': r[3],
+             'payload': PostContent.from_payload(json_loads(r[4])), 'attempts': r[5]}
+            for r in rows
+        ]
+
+    def remove(self, owner_id, post_id, chat_id):
+        with self.journal.lock:
+            self.journal.conn.execute(
+                'DELETE FROM outbox WHERE owner_id = ? AND post_id = ? AND chat_id = ?',
+                (owner_id, post_id, str(chat_id))
+            )
+
+    def save_progress(self, item):
+        # Только отправленные части (payload.sent), без подсчета попытки и паузы
+        with self.journal.lock:
+            self.journal.conn.execute(
+                'UPDATE outbox SET payload = ? WHERE owner_id = ? AND post_id = ? AND chat_id = ?',
+                (json.dumps(item['payload'].to_payload(), ensure_ascii=False),
+                 item['owner_id'], item['post_id'], str(item['chat_id']))
+            )
+            self.journal.conn.commit()
+
+    def fail(self, item):
+        """Откладывает пост после неудачи. Возвращает True, если он ушел в dead_letters.
+
+        Вместе с постом сохраняются уже отправленные его части (payload.sent),
+        чтобы повтор или replay продолжили с места сбоя.
+        """
+        attempts = item['attempts'] + 1
+        key = (item['owner_id'], item['post_id'], str(item['chat_id']))
+        where = 'WHERE owner_id = ? AND post_id = ? AND chat_id = ?'
+        payload = json.dumps(item['payload'].to_payload(), ensure_ascii=False)
+        with self.journal.lock:
+            conn = self.journal.conn
+            if attempts >= self.max_attempts:
+                conn.execute(
+                    'INSERT OR REPLACE INTO dead_letters '
+                    f'SELECT owner_id, post_id, chat_id, date, ?, ?, ? FROM outbox {where}',
+                    (payload, attempts, int(time.time())) + key
+                )
+                conn.execute(f'DELETE FROM outbox {where}', key)
+                conn.commit()
+                return True
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+            conn.execute(
+                f'UPDATE outbox SET payload = ?, attempts = ?, next_attempt_at = ? {where}',
+                (payload, attempts, int(time.time()) + delay) + key
+            )
+            # Фиксируем сразу: следующий пост пойдет в сеть, а открытая запись держала бы общую базу
+            conn.commit()
+        return False
+
+    def size(self, table='outbox'):
+        with self.journal.lock:
+            return self.journal.conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def dead_letters(self):
+        with self.journal.lock:
+            rows = self.journal.conn.execute(
+                'SELECT owner_id, post_id, chat_id, date, attempts, failed_at FROM dead_letters '
+                'ORDER BY date, post_id'
+            ).fetchall()
+        return [
+            {'owner_id': r[0], 'post_id': r[1], 'chat_id': r[2], 'date': r[3], 'attempts': r[4], 'failed_at': r[5]}
+            for r in rows
+        ]
+
+    def replay(self, owner_id=None, post_id=None):
+        """Возвращает пост (или все посты) из dead_letters в outbox. Возвращает их число."""
+        where, params = '', ()
+        if owner_id is not None:
+            where, params = ' WHERE owner_id = ? AND post_id = ?', (owner_id, post_id)
+        with self.journal.lock:
+            conn = self.journal.conn
+            conn.execute(
+                'INSERT OR REPLACE INTO outbox '
+                f'SELECT owner_id, post_id, chat_id, date, payload, 0, ? FROM dead_letters{where}',
+                (int(time.time()),) + params
+            )
+            count = conn.execute(f'DELETE FROM dead_letters{where}', params).rowcount
+            conn.commit()
+        return count
+
+class Metrics:
+    """Счетчики, гистограммы и датчики в текстовом формате Prometheus."""
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    LAG_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}
+        self.values = {}
+        self.gauges = {}
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self.meta[name] = (kind, help_text, buckets)
+
+    def labels_key(self, labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self.labels_key(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self.meta[name][2]
+        key = (name, self.labels_key(labels))
+        with self.lock:
+            hist = self.values.setdefault(key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+            for idx, bound in enumerate(buckets):
+                if value <= bound:
+                    hist['buckets'][idx] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def gauge(self, name, func):
+        # Значение датчика вычисляется при каждом запросе /metrics
+        self.gauges[name] = func
+
+    def format_labels(self, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            values = {key: (dict(v, buckets=list(v['buckets'])) if isinstance(v, dict) else v)
+                      for key, v in self.values.items()}
+        for name, (kind, help_text, buckets) in self.meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'gauge':
+                try:
+                    value = self.gauges[name]() if name in self.gauges else None
+                except Exception:
+                    value = None
+                if value is not None:
+                    lines.append(f'{name} {value}')
+                continue
+            for (metric, labels), value in sorted(values.items()):
+                if metric != name:
+                    continue
+                if kind == 'histogram':
+                    for bound, count in zip(buckets, value['buckets']):
+                        lines.append(f'{name}_bucket{self.format_labels(labels, [("le", bound)])} {count}')
+                    lines.append(f'{name}_bucket{self.format_labels(labels, [("le", "+Inf")])} {value["count"]}')
+                    lines.append(f'{name}_sum{self.format_labels(labels)} {value["sum"]}')
+                    lines.append(f'{name}_count{self.format_labels(labels)} {value["count"]}')
+                else:
+                    lines.append(f'{name}{self.format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+def start_metrics_server(metrics, host, port):
+    """Запускает HTTP-сервер /metrics в фоновом потоке."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Запросы Prometheus не засоряют лог
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
+
+class EventChannel:
+    """События для лаунчера: по строке JSON на событие через локальный сокет.
+
+    Без адреса канал ничего не отправляет. Если лаунчер закрыл соединение,
+    канал отключается, а бот продолжает работу.
+    """
+
+    def __init__(self, address=None, token=''):
+        self.sock = None
+        self.lock = threading.Lock()
+        if address:
+            host, port = address.rsplit(':', 1)
+            self.sock = socket.create_connection((host, int(port)), timeout=5)
+            self.emit('hello', pid=os.getpid(), token=token)
+
+    @property
+    def enabled(self):
+        return self.sock is not None
+
+    def start_reader(self, handler):
+        # Команды от лаунчера (например, {"type": "stop"}) приходят по тому же сокету
+        threading.Thread(target=self.read_commands, args=(handler,), name='events', daemon=True).start()
+
+    def read_commands(self, handler):
+        buffer = b''
+        while self.sock is not None:
+            try:
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                try:
+                    handler(json.loads(line))
+                except ValueError:
+                    continue
+
+    def emit(self, event_type, **fields):
+        if self.sock is None:
+            return
+        line = json.dumps({'type': event_type, 'ts': time.time(), **fields}, ensure_ascii=False) + '\n'
+        with self.lock:
+            if self.sock is None:
+                return
+            try:
+                self.sock.sendall(line.encode('utf-8'))
+            except OSError:
+                # Здесь нельзя писать в лог: ошибки лога сами уходят в канал
+                self.sock.close()
+                self.sock = None
+
+class EventLogHandler(logging.Handler):
+    # Ошибки из лога уходят в канал событий: лаунчеру не нужно искать их в тексте
+    def __init__(self, channel):
+        super().__init__(logging.ERROR)
+        self.channel = channel
+
+    def emit(self, record):
+        self.channel.emit('error', message=record.getMessage(), thread=record.threadName)
+
+class ConfigWatcher:
+    """Следит за config.json и вызывает callback после его изменения.
+
+    На Linux с пакетом inotify_simple ждет событий inotify в каталоге файла
+    (редакторы часто заменяют файл переименованием), иначе раз в interval
+    секунд сверяет время изменения и размер. Запись, которая еще идет,
+    пропускается: callback вызывается, когда файл перестал меняться.
+    """
+
+    def __init__(self, path, callback, interval=2):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.interval = interval
+        self.last = self.stamp()
+
+    def start(self):
+        threading.Thread(target=self.run, name='config', daemon=True).start()
+
+    def stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def run(self):
+        try:
+            from inotify_simple import INotify, flags
+            inotify = INotify()
+            inotify.add_watch(os.path.dirname(self.path), flags.CLOSE_WRITE | flags.MOVED_TO)
+        except (ImportError, OSError):
+            inotify = None
+        name = os.path.basename(self.path)
+        while True:
+            if inotify is not None:
+                if not any(event.name == name for event in inotify.read()):
+                    continue
+            else:
+                time.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        stamp = self.stamp()
+        if stamp is None or stamp == self.last:
+            return
+        # Ждем, пока запись закончится
+        time.sleep(0.5)
+        if self.stamp() != stamp:
+            return
+        self.last = stamp
+        try:
+            self.callback()
+        except Exception as e:
+            logging.error(f"Ошибка применения настроек: {str(e)}")
+
+class RestartPolicy:
+    """Паузы перед перезапуском упавшего бота.
+
+    Пауза удваивается с каждым падением подряд (до max_delay) и
+    сбрасывается, если бот перед падением проработал stable_after секунд.
+    Больше crash_limit падений за crash_window секунд — это цикл падений:
+    crashed() возвращает None, и перезапускать бота не нужно.
+    """
+
+    def __init__(self, base_delay, max_delay, crash_limit, crash_window, stable_after):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.crash_limit = crash_limit
+        self.crash_window = crash_window
+        self.stable_after = stable_after
+        self.reset()
+
+    @classmethod
+    def from_config(cls):
+        settings = CONFIG['settings']
+        return cls(
+            settings.get('restart_base_delay', 5),
+            settings.get('restart_max_delay', 300),
+            settings.get('crash_loop_limit', 5),
+            settings.get('crash_loop_window', 600),
+            settings.get('stable_uptime', 120)
+        )
+
+    def reset(self):
+        self.streak = 0
+        self.crashes = []
+
+    def crashed(self, uptime):
+        now = time.monotonic()
+        if uptime >= self.stable_after:
+            self.streak = 0
+        self.crashes = [t for t in self.crashes if now - t < self.crash_window] + [now]
+        if len(self.crashes) > self.crash_limit:
+            return None
+        delay = min(self.max_delay, self.base_delay * 2 ** self.streak)
+        self.streak += 1
+        return delay
+
+class Supervisor:
+    """Запуск бота без лаунчера: дочерний процесс с перезапуском при падении и зависании.
+
+    Бот получает --events и шлет heartbeat на локальный сокет супервизора.
+    Если heartbeat не приходит heartbeat_timeout секунд или основной цикл
+    стоит дольше hang_timeout, процесс считается зависшим и
+    перезапускается. Остановка идет командой stop по сокету: бот
+    дописывает текущий пост, а остальные остаются в outbox и уходят
+    после запуска. С worker_id дочерний процесс запускается воркером
+    (--worker) шардированного запуска.
+    """
+
+    def __init__(self, config_path=CONFIG_PATH, worker_id=None):
+        self.config_path = config_path
+        self.worker_id = worker_id
+        self.name = f"Воркер {worker_id}" if worker_id else "Бот"
+        self.policy = RestartPolicy.from_config()
+        self.stopping = threading.Event()
+        self.token = secrets.token_hex(16)
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.conn = None
+        self.buffer = b''
+        self.authorized = False
+        self.last_idle = 0
+
+    def run(self):
+        while not self.stopping.is_set():
+            started = time.monotonic()
+            code = self.run_worker()
+            if self.stopping.is_set():
+                break
+            delay = self.policy.crashed(time.monotonic() - started)
+            if delay is None:
+                logging.critical(f"{self.name} падает слишком часто, перезапуски прекращены")
+                return 1
+            logging.error(f"{self.name} завершился (код {code}), перезапуск через {delay} с")
+            self.stopping.wait(delay)
+        return 0
+
+    def run_worker(self):
+        settings = CONFIG['settings']
+        port = self.server.getsockname()[1]
+        env = {**os.environ, 'VK2TG_EVENTS_TOKEN': self.token}
+        command = [sys.executable, os.path.abspath(__file__), f'--events=127.0.0.1:{port}', f'--config={self.config_path}']
+        if self.worker_id:
+            command.append(f'--worker={self.worker_id}')
+        process = subprocess.Popen(command, env=env)
+        heartbeat_at = time.monotonic()
+        hung = False
+        while process.poll() is None:
+            for key, _ in self.selector.select(timeout=1):
+                if key.fileobj is self.server:
+                    self.accept()
+                elif key.fileobj is self.conn and self.read_events():
+                    heartbeat_at = time.monotonic()
+            if self.stopping.is_set():
+                break
+            idle = time.monotonic() - heartbeat_at
+            if idle > settings.get('heartbeat_timeout', 30) or self.last_idle > settings.get('hang_timeout', 1800):
+                logging.error(f"{self.name} не отвечает {idle:.0f} с, перезапускаем")
+                hung = True
+                break
+        self.stop_worker(process, graceful=not hung)
+        return process.returncode
+
+    def accept(self):
+        conn, _ = self.server.accept()
+        # Прежнее соединение принадлежало завершенному процессу
+        self.close_conn()
+        conn.setblocking(False)
+        self.conn, self.buffer, self.authorized, self.last_idle = conn, b'', False, 0
+        self.selector.register(conn, selectors.EVENT_READ)
+
+    def close_conn(self):
+        if self.conn is not None:
+            self.selector.unregister(self.conn)
+            self.conn.close()
+            self.conn = None
+        self.last_idle = 0
+
+    def read_events(self):
+        # Возвращает True, если пришли события от бота
+        try:
+            chunk = self.conn.recv(65536)
+        except BlockingIOError:
+            return False
+        except OSError:
+            chunk = b''
+        if not chunk:
+            self.close_conn()
+            return False
+        self.buffer += chunk
+        received = False
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if not self.authorized:
+                if event.get('type') != 'hello' or event.get('token') != self.token:
+                    self.close_conn()
+                    return False
+                self.authorized = True
+            if event.get('type') == 'heartbeat':
+                self.last_idle = event.get('idle', 0)
+            received = True
+        return received
+
+    def stop_worker(self, process, graceful=True):
+        grace = CONFIG['settings'].get('shutdown_timeout', 10) + 5
+        if process.poll() is None and graceful and self.conn is not None:
+            try:
+                self.conn.setblocking(True)
+                self.conn.sendall(b'{"type": "stop"}\n')
+            except OSError:
+                pass
+            try:
+                process.wait(grace)
+            except subprocess.TimeoutExpired:
+                pass
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        self.close_conn()
+
+class VKApiError(RuntimeError):
+    """Ошибка, которую вернул API VK."""
+
+    def __init__(self, code, message):
+        super().__init__(f"{message} (код {code})")
+        self.code = code
+
+class PollScheduler:
+    """Расписание опроса источников на куче по времени следующего опроса.
+
+    Для каждого источника оценивается частота постов (экспоненциальное
+    среднее), и следующий опрос назначается примерно через время, за
+    которое ожидается один новый пост, в пределах [min_interval,
+    max_interval]. Нижняя граница дополнительно поднимается так, чтобы все
+    источники вместе укладывались в бюджет запросов (25 стен на execute).
+    При ошибках пауза растет экспоненциально.
+    """
+
+    def __init__(self, owner_ids, base_interval, min_interval, max_interval, budget):
+        self.lock = threading.RLock()
+        self.stats = {}
+        self.heap = []
+        self.reconfigure(owner_ids, base_interval, min_interval, max_interval, budget)
+
+    def reconfigure(self, owner_ids, base_interval, min_interval, max_interval, budget):
+        # Новые источники опрашиваются сразу, у оставшихся сохраняется статистика
+        with self.lock:
+            self.base_interval = base_interval
+            self.max_interval = max_interval
+            self.min_interval = max(min_interval, len(owner_ids) / (25 * budget))
+            now = time.time()
+            for owner_id in owner_ids:
+                if owner_id not in self.stats:
+                    self.stats[owner_id] = {'rate': None, 'failures': 0, 'last_poll': None}
+                    self.heap.append((now, owner_id))
+            for owner_id in set(self.stats) - set(owner_ids):
+                del self.stats[owner_id]
+            self.heap = [(when, owner_id) for when, owner_id in self.heap if owner_id in self.stats]
+            heapq.heapify(self.heap)
+
+    def due(self):
+        # Забираем из кучи все источники, которым пора на опрос
+        now = time.time()
+        owner_ids = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                owner_ids.append(heapq.heappop(self.heap)[1])
+        return owner_ids
+
+    def next_time(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else time.time() + self.base_interval
+
+    def success(self, owner_id, new_posts):
+        with self.lock:
+            stats = self.stats.get(owner_id)
+            if stats is None:
+                return
+            now = time.time()
+            stats['failures'] = 0
+            if stats['last_poll'] is not None:
+                observed = new_posts / max(1.0, now - stats['last_poll'])
+                stats['rate'] = observed if stats['rate'] is None else 0.3 * observed + 0.7 * stats['rate']
+            stats['last_poll'] = now
+
+            if stats['rate'] is None:
+                interval = self.base_interval
+            elif stats['rate'] > 0:
+                interval = 1 / stats['rate']
+            else:
+                interval = self.max_interval
+            interval = min(self.max_interval, max(self.min_interval, interval))
+            heapq.heappush(self.heap, (now + interval, owner_id))
+
+    def failure(self, owner_id, delay=None):
+        with self.lock:
+            # Источник мог быть удален из настроек, пока шел опрос
+            stats = self.stats.get(owner_id)
+            if stats is None:
+                return
+            stats['failures'] += 1
+            if delay is None:
+                delay = min(self.max_interval, self.base_interval * 2 ** (stats['failures'] - 1))
+            heapq.heappush(self.heap, (time.time() + delay, owner_id))
+
+    def delay_all(self, delay):
+        # Flood control VK: никого не опрашиваем раньше, чем через delay
+        not_before = time.time() + delay
+        with self.lock:
+            self.heap = [(max(when, not_before), owner_id) for when, owner_id in self.heap]
+            heapq.heapify(self.heap)
+
+class TokenBucket:
+    """Потокобезопасное ведро токенов: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= tokens:
+                        self.tokens -= tokens
+                        return
+                    wait = (tokens - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def configure(self, rate, capacity):
+        with self.lock:
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+
+    def pause(self, seconds):
+        # Сервер попросил подождать: до конца паузы запросов нет, после нее — без пачки
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = min(self.tokens, 1)
+            self.updated = self.paused_until
+
+class SendScheduler:
+    """Общие лимиты исходящих запросов к Telegram: на бота и на каждый чат."""
+
+    def __init__(self, global_rate, chat_per_minute):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_per_minute = chat_per_minute
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+
+    def chat_bucket(self, chat_id):
+        with self.lock:
+            if chat_id not in self.chat_buckets:
+                self.chat_buckets[chat_id] = TokenBucket(self.chat_per_minute / 60, self.chat_per_minute)
+            return self.chat_buckets[chat_id]
+
+    def configure(self, global_rate, chat_per_minute):
+        self.global_bucket.configure(global_rate, global_rate)
+        with self.lock:
+            self.chat_per_minute = chat_per_minute
+            for bucket in self.chat_buckets.values():
+                bucket.configure(chat_per_minute / 60, chat_per_minute)
+
+    def acquire(self, chat_id, tokens=1):
+        # Сначала ждем чат, чтобы не занимать общий лимит во время ожидания
+        self.chat_bucket(chat_id).acquire(tokens)
+        self.global_bucket.acquire(tokens)
+
+    def pause(self, chat_id, seconds):
+        self.chat_bucket(chat_id).pause(seconds)
+
+def format_duration(seconds):
+    # 3725 -> '1 ч 2 мин'
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} с"
+    if seconds < 3600:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+
+def transcode_image(image_data, max_side, quality, max_bytes):
+    """Пережимает фото в JPEG под ограничения Telegram.
+
+    Выполняется в отдельном процессе. Уменьшает длинную сторону до
+    max_side, убирает метаданные, переводит PNG/WEBP/палитру в RGB на
+    белом фоне и снижает качество, пока файл не влезет в max_bytes.
+    """
+    from PIL import Image, ImageOps
+    try:
+        img = Image.open(io.BytesIO(image_data))
+        # Поворот из EXIF применяем до того, как метаданные будут отброшены
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        while True:
+            out = io.BytesIO()
+            img.save(out, 'JPEG', quality=quality, optimize=True)
+            if out.tell() <= max_bytes or quality <= 30:
+                break
+            quality -= 10
+
+        data = out.getvalue()
+        if len(data) > max_bytes:
+            return {'data': None, 'size': len(data), 'ok': False, 'error': 'слишком большой файл'}
+        return {'data': data, 'size': len(data), 'ok': True, 'error': None}
+    except Exception as e:
+        return {'data': None, 'size': 0, 'ok': False, 'error': str(e)}
+
+class MultipartStream:
+    """Тело multipart/form-data с файлом, которое читается с диска по частям.
+
+    requests отправляет его потоком: в памяти одновременно находится
+    только очередной блок файла, а не весь файл.
+    """
+
+    def __init__(self, fields, file_field, filename, path, chunk_size=64 * 1024):
+        boundary = secrets.token_hex(16)
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        head = b''
+        for name, value in fields.items():
+            head += (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            ).encode('utf-8')
+        filename = filename.replace('"', '').replace('\r', '').replace('\n', '')
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        self.length = len(head) + os.path.getsize(path) + len(tail)
+        self.chunk_size = chunk_size
+        self.pending = head
+        self.tail = tail
+        self.file = open(path, 'rb')
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        while len(self.pending) < size and self.file is not None:
+            chunk = self.file.read(max(size, self.chunk_size))
+            if not chunk:
+                self.close()
+                self.pending += self.tail
+                break
+            self.pending += chunk
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.chunk_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class DeliveryJournal:
+    """Журнал доставленных постов в SQLite (WAL).
+
+    Ключ — (owner_id, post_id, chat_id), вместе с постом хранятся id
+    сообщений в Telegram и хеш содержимого (VK2TGBot.content_hash), по
+    которому находятся правки поста. Методы записи только выполняют
+    запрос, а фиксирует вызывающий код (commit()), и делает это сразу
+    после каждой доставки (record вместе с outbox.remove) и после
+    постановки новых постов в очередь. От этого зависит устойчивость к падению: при
+    перезапуске повторяется разве что пост, который отправлялся в момент
+    падения. Запись не остается открытой на время запросов к Telegram,
+    поэтому базу могут делить воркеры и --migrate/--replay.
+    """
+
+    def __init__(self, path, legacy_chat_id=''):
+        self.lock = threading.Lock()
+        # Базу могут делить несколько воркеров (--shards), поэтому ждем чужую запись дольше
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        legacy_table(self.conn, 'deliveries')
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS deliveries (
+                owner_id INTEGER NOT NULL,
+                post_id INTEGER NOT NULL,
+                chat_id TEXT NOT NULL,
+                date INTEGER NOT NULL,
+                message_ids TEXT NOT NULL,
+                sent_at INTEGER NOT NULL,
+                content_hash TEXT,
+                PRIMARY KEY (owner_id, post_id, chat_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS cursors (
+                owner_id TEXT PRIMARY KEY,
+                last_post_time INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS migrations (
+                owner_id INTEGER NOT NULL,
+                chat_id TEXT NOT NULL,
+                last_post_id INTEGER NOT NULL,
+                read INTEGER NOT NULL,
+                migrated INTEGER NOT NULL,
+                PRIMARY KEY (owner_id, chat_id)
+            );
+        """)
+        copy_legacy_table(self.conn, 'deliveries', legacy_chat_id)
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(deliveries)')]
+        if 'content_hash' not in columns:
+            # Журнал прежней версии: у старых записей хеша нет, он появится при первой проверке
+            self.conn.execute('ALTER TABLE deliveries ADD COLUMN content_hash TEXT')
+        self.conn.commit()
+
+    def is_sent(self, owner_id, post_id, chat_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM deliveries WHERE owner_id = ? AND post_id = ? AND chat_id = ?',
+                (owner_id, post_id, str(chat_id))
+            ).fetchone()
+        return row is not None
+
+    def get_message_ids(self, owner_id, post_id, chat_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT message_ids FROM deliveries WHERE owner_id = ? AND post_id = ? AND chat_id = ?',
+                (owner_id, post_id, str(chat_id))
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def record(self, owner_id, post_id, chat_id, date, message_ids, content_hash=None):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO deliveries '
+                '(owner_id, post_id, chat_id, date, message_ids, sent_at, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (owner_id, post_id, str(chat_id), date, json.dumps(message_ids), int(time.time()), content_hash)
+            )
+
+    def recent(self, owner_id, min_post_id, since):
+        # Доставки источника начиная с поста min_post_id, опубликованные не раньше since
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT post_id, chat_id, message_ids, content_hash FROM deliveries '
+                'WHERE owner_id = ? AND post_id >= ? AND date >= ?',
+                (owner_id, min_post_id, since)
+            ).fetchall()
+        return [(r[0], r[1], json.loads(r[2]), r[3]) for r in rows]
+
+    def set_content_hash(self, owner_id, post_id, chat_id, content_hash):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE deliveries SET content_hash = ? WHERE owner_id = ? AND post_id = ? AND chat_id = ?',
+                (content_hash, owner_id, post_id, str(chat_id))
+            )
+
+    def get_cursor(self, owner_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT last_post_time FROM cursors WHERE owner_id = ?',
+                (str(owner_id),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, owner_id, timestamp):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cursors VALUES (?, ?)',
+                (str(owner_id), timestamp)
+            )
+
+    def get_migration(self, owner_id, chat_id):
+        # Контрольная точка переноса стены: последний перенесенный пост,
+        # сколько постов прочитано от начала стены и сколько пройдено
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT last_post_id, read, migrated FROM migrations WHERE owner_id = ? AND chat_id = ?',
+                (owner_id, str(chat_id))
+            ).fetchone()
+        return {'last_post_id': row[0], 'read': row[1], 'migrated': row[2]} if row else None
+
+    def set_migration(self, owner_id, chat_id, state):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO migrations VALUES (?, ?, ?, ?, ?)',
+                (owner_id, str(chat_id), state['last_post_id'], state['read'], state['migrated'])
+            )
+
+    def reset_migration(self, owner_id, chat_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM migrations WHERE owner_id = ? AND chat_id = ?', (owner_id, str(chat_id)))
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+class FileIdCache:
+    """Кэш file_id Telegram для уже загруженных фото.
+
+    Ключ — идентичность фото VK (owner_id_photo_id) или хеш содержимого
+    ("sha1:..."). Живет в базе журнала. put и forget фиксируются сразу,
+    а чтение в базу не пишет: время использования копится в памяти и
+    записывается пачкой в evict. Иначе транзакция записи оставалась бы
+    открытой на время загрузок в Telegram и держала общую базу.
+    """
+
+    def __init__(self, journal, max_size, max_age):
+        self.journal = journal
+        self.max_size = max_size
+        self.max_age = max_age
+        self.used = {}
+        with journal.lock:
+            journal.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS file_ids (
+                    key TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    used_at INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS file_ids_created ON file_ids (created_at);
+                CREATE INDEX IF NOT EXISTS file_ids_used ON file_ids (used_at);
+            """)
+            journal.conn.commit()
+
+    def get(self, *keys):
+        # Первый найденный file_id по любому из ключей
+        now = int(time.time())
+        with self.journal.lock:
+            for key in keys:
+                if not key:
+                    continue
+                row = self.journal.conn.execute(
+                    'SELECT file_id FROM file_ids WHERE key = ? AND created_at >= ?',
+                    (key, now - self.max_age)
+                ).fetchone()
+                if row:
+                    self.used[key] = now
+                    return row[0]
+        return None
+
+    def put(self, file_id, *keys):
+        now = int(time.time())
+        with self.journal.lock:
+            for key in keys:
+                if key:
+                    self.journal.conn.execute(
+                        'INSERT OR REPLACE INTO file_ids VALUES (?, ?, ?, ?)',
+                        (key, file_id, now, now)
+                    )
+            self.journal.conn.commit()
+
+    def forget(self, *keys):
+        with self.journal.lock:
+            for key in keys:
+                if key:
+                    self.journal.conn.execute('DELETE FROM file_ids WHERE key = ?', (key,))
+            self.journal.conn.commit()
+
+    def evict(self):
+        # Сначала устаревшие записи, затем самые давно использованные сверх лимита
+        with self.journal.lock:
+            conn = self.journal.conn
+            used, self.used = self.used, {}
+            conn.executemany('UPDATE file_ids SET used_at = ? WHERE key = ?', [(at, key) for key, at in used.items()])
+            conn.execute('DELETE FROM file_ids WHERE created_at < ?', (int(time.time()) - self.max_age,))
+            excess = conn.execute('SELECT COUNT(*) FROM file_ids').fetchone()[0] - self.max_size
+            if excess > 0:
+                conn.execute(
+                    'DELETE FROM file_ids WHERE key IN '
+                    '(SELECT key FROM file_ids ORDER BY used_at LIMIT ?)',
+                    (excess,)
+                )
+
+class SqliteLeaseStore:
+    """Аренда источников воркерами в общей базе SQLite (один хост).
+
+    shard_workers — живые воркеры (отметка продлевается вместе с арендой),
+    shard_assignments — какой воркер должен вести источник (пишет
+    координатор), shard_leases — кто ведет источник сейчас и до какого
+    времени. Аренду можно взять, только если она свободна, истекла или уже
+    своя; каждая смена владельца увеличивает epoch. Воркер запоминает epoch
+    своей аренды и перед отправкой проверяет его (holds): после истечения
+    аренды старый владелец не отправит и не запишет пост нового.
+    Другое хранилище (для нескольких хостов) реализует те же методы и
+    регистрируется в LEASE_BACKENDS.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        # Транзакции открываем сами (BEGIN IMMEDIATE), чтобы проверка и запись аренды были атомарны
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS shard_workers (
+                worker TEXT PRIMARY KEY,
+                expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shard_assignments (
+                source TEXT PRIMARY KEY,
+                worker TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shard_leases (
+                source TEXT PRIMARY KEY,
+                worker TEXT NOT NULL,
+                expires REAL NOT NULL,
+                epoch INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def register(self, worker, ttl):
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO shard_workers (worker, expires) VALUES (?, ?) '
+                'ON CONFLICT(worker) DO UPDATE SET expires = excluded.expires',
+                (worker, time.time() + ttl)
+            )
+
+    def live_workers(self):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT worker FROM shard_workers WHERE expires > ? ORDER BY worker', (time.time(),)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def unregister(self, worker):
+        # Плановая остановка: источники освобождаются сразу, без ожидания конца аренды
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM shard_workers WHERE worker = ?', (worker,))
+            conn.execute('UPDATE shard_leases SET expires = 0 WHERE worker = ?', (worker,))
+
+    def acquire(self, source, worker, ttl):
+        """Берет или продлевает аренду source; возвращает epoch или None, если она чужая."""
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                'SELECT worker, expires, epoch FROM shard_leases WHERE source = ?', (source,)
+            ).fetchone()
+            if row is None:
+                epoch = 1
+            elif row[0] == worker and row[1] > now:
+                epoch = row[2]
+            elif row[1] <= now:
+                epoch = row[2] + 1
+            else:
+                return None
+            conn.execute(
+                'INSERT OR REPLACE INTO shard_leases (source, worker, expires, epoch) VALUES (?, ?, ?, ?)',
+                (source, worker, now + ttl, epoch)
+            )
+        return epoch
+
+    def renew(self, worker, ttl):
+        """Продлевает все действующие аренды воркера и возвращает их epoch по источникам.
+
+        Истекшая аренда не продлевается: источник мог уже перейти к другому воркеру.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                'UPDATE shard_leases SET expires = ? WHERE worker = ? AND expires > ?',
+                (now + ttl, worker, now)
+            )
+            rows = conn.execute(
+                'SELECT source, epoch FROM shard_leases WHERE worker = ? AND expires > ?', (worker, now)
+            ).fetchall()
+        return dict(rows)
+
+    def holds(self, source, worker, epoch):
+        """True, если аренда source действует и все еще принадлежит worker с тем же epoch."""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM shard_leases WHERE source = ? AND worker = ? AND epoch = ? AND expires > ?',
+                (source, worker, epoch, time.time())
+            ).fetchone()
+        return row is not None
+
+    def release(self, source, worker):
+        # Запись остается истекшей, а не удаляется: следующий владелец получит больший epoch
+        with self.transaction() as conn:
+            conn.execute('UPDATE shard_leases SET expires = 0 WHERE source = ? AND worker = ?', (source, worker))
+
+    def assign(self, assignments):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM shard_assignments')
+            conn.executemany(
+                'INSERT INTO shard_assignments (source, worker) VALUES (?, ?)', assignments.items()
+            )
+
+    def assignments(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT source, worker FROM shard_assignments').fetchall()
+        return dict(rows)
+
+LEASE_BACKENDS = {'sqlite': SqliteLeaseStore}
+
+def open_lease_store(url):
+    """Открывает хранилище аренды по адресу вида backend://path (без схемы — путь к SQLite)."""
+    backend, sep, path = url.partition('://')
+    if not sep:
+        backend, path = 'sqlite', url
+    if backend not in LEASE_BACKENDS:
+        raise ValueError(f"Неизвестное хранилище аренды: {backend}")
+    return LEASE_BACKENDS[backend](path)
+
+class LeaseLost(RuntimeError):
+    """Аренда источника перешла к другому воркеру посреди отправки поста."""
+
+class ShardMember:
+    """Воркер шардированного запуска: ведет только арендованные источники.
+
+    Раз в ttl/3 секунд воркер отмечается живым, продлевает аренду и берет
+    назначенные ему источники. Один из воркеров держит аренду координатора
+    и распределяет источники поровну между живыми, по возможности оставляя
+    их прежним владельцам. Отданный источник перестает получать новые
+    отправки сразу, а аренда освобождается, только когда текущая отправка
+    из него закончена. Новый владелец берет источник лишь после этого или
+    после истечения аренды. Перед каждой частью поста и перед записью
+    доставки воркер сверяет epoch аренды с хранилищем (holds), поэтому
+    воркер, который завис дольше аренды, не продолжит отправку за нового
+    владельца. Повториться может разве что часть, которая уже ушла в
+    Telegram в момент потери аренды.
+    """
+
+    COORDINATOR = 'coordinator'
+
+    def __init__(self, store, worker_id, ttl):
+        self.store = store
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.sources = []
+        self.owned = set()
+        self.epochs = {}
+        self.in_flight = {}
+        self.valid_until = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def start(self, on_change):
+        def loop():
+            while not self.stopping.wait(self.ttl / 3):
+                try:
+                    if self.sync():
+                        on_change()
+                except Exception as e:
+                    logging.error(f"Ошибка продления аренды источников: {str(e)}")
+        threading.Thread(target=loop, name='leases', daemon=True).start()
+
+    def sync(self):
+        """Продлевает аренду и приводит свои источники к назначению; True, если набор изменился."""
+        started = time.time()
+        store, worker = self.store, self.worker_id
+        store.register(worker, self.ttl)
+        if store.acquire(self.COORDINATOR, worker, self.ttl) is not None:
+            self.rebalance()
+        assigned = {source for source, owner in store.assignments().items() if owner == worker}
+        held = store.renew(worker, self.ttl)
+        held.pop(self.COORDINATOR, None)
+        with self.lock:
+            previous = self.owned
+            release = {s for s in held.keys() - assigned if not self.in_flight.get(int(s))}
+            self.owned = {int(s) for s in held.keys() & assigned}
+            # Источник, который отдается после текущей отправки, сохраняет epoch до освобождения
+            self.epochs = {int(s): epoch for s, epoch in held.items() if s not in release}
+            self.valid_until = started + self.ttl
+        for source in release:
+            store.release(source, worker)
+        gained = {}
+        for source in assigned - held.keys():
+            epoch = store.acquire(source, worker, self.ttl)
+            if epoch is not None:
+                gained[int(source)] = epoch
+        with self.lock:
+            self.owned |= gained.keys()
+            self.epochs.update(gained)
+            changed = self.owned != previous
+        if changed:
+            logging.info(f"Воркер {worker} ведет источники: {', '.join(map(str, sorted(self.owned))) or 'нет'}")
+        return changed
+
+    def rebalance(self):
+        # Поровну между живыми воркерами; источник остается у прежнего владельца, пока тот не перегружен
+        workers = self.store.live_workers()
+        if not workers:
+            return
+        current = self.store.assignments()
+        sources = sorted(map(str, self.sources))
+        quota = -(-len(sources) // len(workers))
+        load = {worker: [] for worker in workers}
+        unassigned = []
+        for source in sources:
+            worker = current.get(source)
+            if worker in load and len(load[worker]) < quota:
+                load[worker].append(source)
+            else:
+                unassigned.append(source)
+        for source in unassigned:
+            worker = min(load, key=lambda w: len(load[w]))
+            load[worker].append(source)
+        assignments = {source: worker for worker, owned in load.items() for source in owned}
+        if assignments != current:
+            self.store.assign(assignments)
+
+    def owns(self, source):
+        # Аренда считается своей с запасом в половину срока: продление идет каждые ttl/3
+        with self.lock:
+            return source in self.owned and time.time() < self.valid_until - self.ttl / 2
+
+    def owned_sources(self):
+        with self.lock:
+            return set(self.owned)
+
+    def begin_send(self, source):
+        with self.lock:
+            if source not in self.owned or time.time() >= self.valid_until - self.ttl / 2:
+                return False
+            self.in_flight[source] = self.in_flight.get(source, 0) + 1
+            return True
+
+    def end_send(self, source):
+        with self.lock:
+            self.in_flight[source] -= 1
+
+    def holds(self, source):
+        # Проверка по хранилищу, а не по времени продления: аренду могли отдать, пока воркер стоял
+        with self.lock:
+            epoch = self.epochs.get(source)
+        return epoch is not None and self.store.holds(str(source), self.worker_id, epoch)
+
+    def stop(self):
+        self.stopping.set()
+        with self.lock:
+            self.owned = set()
+            self.epochs = {}
+        try:
+            self.store.unregister(self.worker_id)
+        except Exception as e:
+            logging.error(f"Не удалось освободить аренду источников: {str(e)}")
+
+class PostContent:
+    """Разобранный пост, готовый к отправке: текст, фото (ссылки и ключи VK) и файлы.
+
+    Постов в очередях бывает много, поэтому это компактная запись со
+    __slots__, а не словарь. В outbox хранится как JSON (to_payload/from_payload).
+
+    В sent копятся id сообщений уже отправленных частей поста (текст или
+    фото, затем каждый файл): повтор после сбоя продолжает с первой
+    неотправленной части, а не шлет пост заново.
+    """
+
+    __slots__ = ('text', 'images', 'photo_keys', 'media', 'sent')
+
+    def __init__(self, text='', images=None, photo_keys=None, media=None, sent=None):
+        self.text = text
+        self.images = images or []
+        self.photo_keys = photo_keys or []
+        self.media = media or []
+        self.sent = sent or []
+
+    def to_payload(self):
+        return {
+            'text': self.text, 'images': self.images, 'photo_keys': self.photo_keys, 'media': self.media,
+            'sent': self.sent
+        }
+
+    @classmethod
+    def from_payload(cls, payload):
+        # Записи outbox прежних версий: без photo_keys, media и sent, со stats и timestamp
+        return cls(
+            payload.get('text', ''), payload.get('images'), payload.get('photo_keys'), payload.get('media'),
+            payload.get('sent')
+        )
+
+class VK2TGBot:
+    def __init__(self, events=None, shard=None):
+        import requests
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': 'VK2TG/2.0'})
+        workers = max(1, int(CONFIG['settings'].get('download_workers', 4)))
+        # Одна сессия и общий пул соединений на все маршруты.
+        # Пул не меньше числа потоков загрузки, иначе urllib3 будет сбрасывать соединения
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=max(10, workers))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.download_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+        # Отдельный поток для предзагрузки: он сам раздает работу download_pool
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self.prefetched = {}
+        # Средний размер скачанного фото: столько считаем за каждое фото, которое еще качается
+        self.prefetch_estimate = 1024 * 1024
+        self.prefetch_lock = threading.Lock()
+        self.transcode_pool = None
+        self.transcode_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.async_stop = None
+        self.posts_queue = None
+        self.config_lock = threading.Lock()
+        self.last_progress = time.monotonic()
+        self.scheduler = SendScheduler(
+            CONFIG['settings'].get('tg_global_rate', 30),
+            CONFIG['settings'].get('tg_chat_per_minute', 20)
+        )
+        self.journal = DeliveryJournal(
+            CONFIG['settings'].get('journal_path', 'vk2tg.db'),
+            CONFIG['telegram']['chat_id']
+        )
+        self.outbox = OutboundQueue(
+            self.journal,
+            CONFIG['settings'].get('retry_base_delay', 30),
+            CONFIG['settings'].get('retry_max_delay', 3600),
+            CONFIG['settings'].get('max_attempts', 8),
+            CONFIG['telegram']['chat_id']
+        )
+        self.file_ids = FileIdCache(
+            self.journal,
+            CONFIG['settings'].get('file_id_cache_size', 50000),
+            CONFIG['settings'].get('file_id_cache_days', 30) * 86400
+        )
+        self.routes = self.load_routes()
+        self.cursors = {owner_id: self.load_last_post_time(owner_id) for owner_id in self.routes}
+        # Недочитанные стены (max_fetch_posts кончился раньше позиции): продолжаются в следующем опросе
+        self.wall_reads = {}
+        self.shard = shard
+        if shard is not None:
+            shard.sources = list(self.routes)
+            shard.sync()
+        budget = CONFIG['settings'].get('vk_requests_per_second', 2)
+        self.vk_bucket = TokenBucket(budget, max(1, budget))
+        self.poll_scheduler = PollScheduler(
+            self.active_sources(),
+            CONFIG['settings']['check_interval'],
+            CONFIG['settings'].get('poll_min_interval', 30),
+            CONFIG['settings'].get('poll_max_interval', 900),
+            budget
+        )
+        self.error_streak = 0
+        self.longpoll = None
+        self.longpoll_retry_at = 0
+        self.edits_checked_at = 0
+        self.metrics = self.create_metrics()
+        if CONFIG['settings'].get('metrics_port'):
+            start_metrics_server(
+                self.metrics,
+                CONFIG['settings'].get('metrics_host', '127.0.0.1'),
+                CONFIG['settings']['metrics_port']
+            )
+        self.events = events or EventChannel()
+        if self.events.enabled:
+            logging.getLogger().addHandler(EventLogHandler(self.events))
+            threading.Thread(target=self.heartbeat_loop, name='heartbeat', daemon=True).start()
+            self.events.start_reader(self.handle_command)
+        if shard is not None:
+            shard.start(self.apply_ownership)
+
+    def active_sources(self):
+        # Источники, которые опрашивает этот процесс: все или арендованные воркером
+        if self.shard is None:
+            return list(self.routes)
+        owned = self.shard.owned_sources()
+        return [owner_id for owner_id in self.routes if owner_id in owned]
+
+    def create_metrics(self):
+        metrics = Metrics()
+        metrics.describe('vk2tg_vk_request_seconds', 'histogram', 'Время запроса к API VK', Metrics.LATENCY_BUCKETS)
+        metrics.describe('vk2tg_vk_errors_total', 'counter', 'Ошибки API VK по коду')
+        metrics.describe('vk2tg_download_seconds', 'histogram', 'Время загрузки фото из VK', Metrics.LATENCY_BUCKETS)
+        metrics.describe('vk2tg_download_bytes_total', 'counter', 'Скачано байт фото')
+        metrics.describe('vk2tg_download_failures_total', 'counter', 'Неудачные попытки загрузки фото')
+        metrics.describe('vk2tg_telegram_request_seconds', 'histogram', 'Время запроса к Telegram', Metrics.LATENCY_BUCKETS)
+        metrics.describe('vk2tg_telegram_upload_bytes_total', 'counter', 'Загружено байт в Telegram')
+        metrics.describe('vk2tg_telegram_responses_total', 'counter', 'Ответы Telegram по коду статуса')
+        metrics.describe('vk2tg_telegram_throttled_total', 'counter', 'Повторы после 429 от Telegram')
+        metrics.describe('vk2tg_posts_sent_total', 'counter', 'Доставленные посты')
+        metrics.describe('vk2tg_send_retries_total', 'counter', 'Посты, отложенные для повторной отправки')
+        metrics.describe('vk2tg_dead_letters_total', 'counter', 'Посты, перенесенные в очередь неотправленных')
+        metrics.describe('vk2tg_posts_edited_total', 'counter', 'Правки постов VK, перенесенные в Telegram')
+        metrics.describe('vk2tg_posts_deleted_total', 'counter', 'Посты, удаленные в Telegram вслед за VK')
+        metrics.describe('vk2tg_delivery_lag_seconds', 'histogram', 'Задержка от даты поста в VK до приема Telegram',
+                         Metrics.LAG_BUCKETS)
+        metrics.describe('vk2tg_outbox_depth', 'gauge', 'Постов в очереди отправки')
+        metrics.describe('vk2tg_dead_letters_depth', 'gauge', 'Постов в очереди неотправленных')
+        metrics.describe('vk2tg_posts_queue_depth', 'gauge', 'Постов в очереди между получением и подготовкой (async)')
+        metrics.gauge('vk2tg_outbox_depth', self.outbox.size)
+        metrics.gauge('vk2tg_dead_letters_depth', lambda: self.outbox.size('dead_letters'))
+        return metrics
+
+    def reload_config(self, path=CONFIG_PATH):
+        """Перечитывает config.json и применяет его к работающему боту.
+
+        Новые настройки проверяются целиком до применения. Если проверка
+        или применение не удались, бот продолжает работу с прежними.
+        """
+        try:
+            config = load_config(path)
+        except (OSError, ValueError) as e:
+            logging.error(f"Настройки из {path} не применены: {str(e)}")
+            return False
+        with self.config_lock:
+            previous = {key: CONFIG[key] for key in CONFIG}
+            try:
+                apply_config(config)
+                self.apply_runtime_config()
+            except Exception as e:
+                logging.error(f"Ошибка применения настроек, возвращаем прежние: {str(e)}")
+                apply_config(previous)
+                self.apply_runtime_config()
+                return False
+            if config['vk'] != previous['vk'] or config['routes'] != previous['routes']:
+                # Сервер long poll выдан под прежний ключ и группу
+                self.longpoll = None
+                self.longpoll_retry_at = 0
+        restart = [key for key in RESTART_SETTINGS if config['settings'].get(key) != previous['settings'].get(key)]
+        if restart:
+            logging.warning(f"Вступят в силу после перезапуска: {', '.join(restart)}")
+        logging.info(f"Настройки из {path} применены")
+        self.events.emit('config_reloaded', sources=len(self.routes))
+        return True
+
+    def apply_runtime_config(self):
+        # Источники, чаты и лимиты из CONFIG — в работающие планировщики
+        settings = CONFIG['settings']
+        routes = self.load_routes()
+        polled = set(self.poll_scheduler.stats) if self.shard is not None else set()
+        if self.shard is not None:
+            self.shard.sources = list(routes)
+            owned = self.shard.owned_sources()
+            sources = [owner_id for owner_id in routes if owner_id in owned]
+        else:
+            sources = list(routes)
+        for owner_id in routes:
+            # Позицию полученного от другого воркера источника читаем заново из общей базы
+            if owner_id not in self.cursors or (owner_id in sources and owner_id not in polled):
+                self.cursors[owner_id] = self.load_last_post_time(owner_id)
+        for owner_id in set(self.cursors) - set(routes):
+            del self.cursors[owner_id]
+        budget = settings.get('vk_requests_per_second', 2)
+        self.vk_bucket.configure(budget, max(1, budget))
+        self.poll_scheduler.reconfigure(
+            sources,
+            settings['check_interval'],
+            settings.get('poll_min_interval', 30),
+            settings.get('poll_max_interval', 900),
+            budget
+        )
+        self.scheduler.configure(settings.get('tg_global_rate', 30), settings.get('tg_chat_per_minute', 20))
+        self.routes = routes
+        if self.async_stop is not None:
+            self.async_stop[0].call_soon_threadsafe(self.add_senders)
 
-    def load_last_post_time(self):
+    def apply_ownership(self):
+        # Набор арендованных источников изменился — опрашиваем новый
+        with self.config_lock:
+            self.apply_runtime_config()
+
+    def load_routes(self):
+        # owner_id сообщества -> список чатов Telegram
+        routes = {}
+        for route in CONFIG.get('routes') or [
+            {'owner_id': CONFIG['vk']['owner_id'], 'chat_ids': [CONFIG['telegram']['chat_id']]}
+        ]:
+            chat_ids = routes.setdefault(int(route['owner_id']), [])
+            for chat_id in route.get('chat_ids') or [route['chat_id']]:
+                if chat_id not in chat_ids:
+                    chat_ids.append(chat_id)
+        return routes
+
+    def load_last_post_time(self, owner_id):
+        timestamp = self.journal.get_cursor(owner_id)
+        if timestamp is not None:
+            return timestamp
+        # Переносим позицию из старого last_post_time.txt (он был только у vk.owner_id)
+        if str(owner_id) != str(CONFIG['vk']['owner_id']):
+            return 0
         try:
             with open('last_post_time.txt', 'r') as f:
-                return int(f.read())
+                timestamp = int(f.read())
         except (FileNotFoundError, ValueError):
             return 0
+        # Старая версия хранила дату последнего отправленного поста, а позиция в журнале
+        # включительная, и этого поста в журнале нет: сдвигаем на секунду, чтобы не повторить его.
+        # Вызывается и из __init__, пока self.cursors еще не создан: пишем только в журнал
+        timestamp += 1
+        self.journal.set_cursor(owner_id, timestamp)
+        self.journal.commit()
+        return timestamp
+
+    def save_last_post_time(self, owner_id, timestamp):
+        self.cursors[owner_id] = timestamp
+        self.journal.set_cursor(owner_id, timestamp)
+
+    def fetch_limit(self, since):
+        settings = CONFIG['settings']
+        # При первом запуске, как и раньше, берем только последние посты
+        return settings.get('max_fetch_posts', 1000) if since else settings.get('initial_posts', 10)
+
+    def read_wall_page(self, source, items, count):
+        """Добавляет страницу wall.get (count — сколько запрошено) к чтению стены source.
+
+        В source['posts'] попадают посты не старше source['since'], в
+        source['items'] — все новые записи. Следующая страница берется с
+        нахлестом: если пока листаем, на стене удалят пост, смещения
+        сдвинутся к новым, и без нахлеста один пост пропал бы (а
+        propagate_changes счел бы его удаленным). Возвращает True, если
+        граница since достигнута.
+        """
+        source['offset'] += max(0, len(items) - min(10, count // 2))
+        done = False
+        for post in items:
+            # Повторы дают нахлест и новые посты, сдвигающие offset, пока листаем
+            if post['id'] in source['seen']:
+                continue
+            source['seen'].add(post['id'])
+            source['items'].append(post)
+            if done:
+                continue
+            if post['date'] >= source['since']:
+                source['posts'].append(post)
+            elif not post.get('is_pinned'):
+                done = True
+        return done
+
+    def vk_call(self, method, params):
+        """Вызывает метод API VK в пределах бюджета запросов.
+
+        При ошибке 6 (слишком много запросов в секунду) ждет и повторяет,
+        остальные ошибки поднимает как VKApiError.
+        """
+        params = {'v': CONFIG['vk']['api_version'], **params}
+        retries = CONFIG['settings']['max_retries']
+        for attempt in range(retries + 1):
+            self.vk_bucket.acquire()
+            started = time.monotonic()
+            response = self.session.post(
+                f"{CONFIG['vk'].get('api_url', 'https://api.vk.com/method')}/{method}",
+                data=params,
+                timeout=CONFIG['settings']['timeout']
+            )
+            data = json_loads(response.content)
+            self.metrics.observe('vk2tg_vk_request_seconds', time.monotonic() - started, method=method)
+            error = data.get('error')
+            if not error:
+                return data
+            self.metrics.inc('vk2tg_vk_errors_total', method=method, code=error.get('error_code'))
+            if error.get('error_code') == 6 and attempt < retries:
+                time.sleep(attempt + 1)
+                continue
+            raise VKApiError(error.get('error_code'), error.get('error_msg'))
+
+    def get_vk_posts(self, owner_id, since=None, items=None):
+        """Постранично читает стену от новых постов к старым.
+
+        Возвращает посты не старше since (по умолчанию позиция источника),
+        останавливаясь на первом посте старше since. Посты с датой ровно
+        since тоже отдаются, чтобы не потерять вышедшие в ту же секунду;
+        уже доставленные отсекает журнал. Закрепленный пост нарушает
+        порядок по дате, поэтому он не считается границей.
+        При ошибке запроса поднимает исключение, чтобы частично
+        прочитанная стена не сдвинула позицию источника мимо пропущенных постов.
+        Если max_fetch_posts кончился раньше границы, возвращает None, а
+        прочитанное передает fetch_walls: стена дочитывается опросом.
+        В список items, если он передан, складываются все прочитанные
+        записи стены (для propagate_changes).
+        """
+        if since is None:
+            since = self.cursors.get(owner_id, 0)
+        settings = CONFIG['settings']
+        page_size = min(100, settings.get('page_size', 100))
+        source = {
+            'since': since, 'limit': self.fetch_limit(since), 'offset': 0, 'seen': set(), 'posts': [], 'items': []
+        }
+        while True:
+            count = min(page_size, source['limit'] - len(source['seen']))
+            params = {
+                'owner_id': owner_id,
+                'count': count,
+                'offset': source['offset'],
+                'access_token': CONFIG['vk']['token']
+            }
+
+            try:
+                data = self.vk_call('wall.get', params)
+            except Exception as e:
+                logging.error(f"Ошибка получения постов: {str(e)}")
+                raise
+
+            page = data.get('response', {}).get('items', [])
+            read = len(source['items'])
+            done = self.read_wall_page(source, page, count)
+            if items is not None:
+                items.extend(source['items'][read:])
+            if done or len(page) < count:
+                return source['posts']
+            if len(source['seen']) >= source['limit']:
+                if self.wall_unfinished(owner_id, source):
+                    return None
+                return source['posts']
 
-    def save_last_post_time(self, timestamp):
-        with open('last_post_time.txt', 'w') as f:
-            f.write(str(timestamp))
+    def wall_unfinished(self, owner_id, source):
+        """Проверяет, что предел max_fetch_posts кончился раньше позиции источника.
 
-    def get_vk_posts(self):
+        Тогда постов не отдаем и позицию не сдвигаем: прочитанное остается
+        в wall_reads, и следующий опрос дочитывает стену с того же места,
+        пока не дойдет до позиции. Иначе старые непрочитанные посты
+        пропали бы. При первом запуске (позиции нет) предел — это
+        initial_posts, и более старые посты не нужны.
+        """
+        if not source['since']:
+            return False
+        self.wall_reads[owner_id] = source
+        logging.warning(
+            f"Стена {owner_id}: за цикл прочитано {len(source['seen'])} постов, но позиция источника "
+            f"не достигнута; дочитываем в следующем цикле"
+        )
+        return True
+
+    def fetch_walls(self, owner_ids=None):
+        """Читает стены источников (по умолчанию всех) пачками через execute.
+
+        Один запрос execute выполняет до 25 вызовов wall.get, поэтому
+        стоимость опроса растет с числом пачек, а не источников. Источник,
+        которому не хватило одной страницы, дочитывается в следующей пачке.
+        Возвращает посты только тех источников, чьи стены прочитаны
+        полностью: при ошибке позиция источника не сдвигается. Итог опроса
+        каждого источника передается в poll_scheduler. Стена, которой не
+        хватило max_fetch_posts, дочитывается в следующих циклах (wall_unfinished).
+        """
+        settings = CONFIG['settings']
+        page_size = min(100, settings.get('page_size', 100))
+        if owner_ids is None:
+            owner_ids = list(self.cursors)
+        state = {}
+        for owner_id in owner_ids:
+            since = self.cursors.get(owner_id, 0)
+            source = self.wall_reads.pop(owner_id, None)
+            if source is not None and source['since'] == since:
+                # Продолжаем с места прошлого цикла. Небольшой нахлест: удаленные на стене
+                # посты сдвигают смещения к новым, а повторы отсекает seen
+                source['offset'] = max(0, source['offset'] - 10)
+                source['limit'] = len(source['seen']) + self.fetch_limit(since)
+            else:
+                source = {
+                    'since': since, 'limit': self.fetch_limit(since), 'offset': 0, 'seen': set(), 'posts': [],
+                    'items': []
+                }
+            state[owner_id] = source
+        active = list(state)
+        finished = []
+
+        while active:
+            batch, active = active[:25], active[25:]
+            calls = []
+            for owner_id in batch:
+                source = state[owner_id]
+                calls.append({
+                    'owner_id': owner_id,
+                    'count': min(page_size, source['limit'] - len(source['seen'])),
+                    'offset': source['offset']
+                })
+            code = 'return [' + ','.join(f'API.wall.get({json.dumps(call)})' for call in calls) + '];'
+
+            try:
+                data = self.vk_call('execute', {'code': code, 'access_token': CONFIG['vk']['token']})
+            except Exception as e:
+                logging.error(f"Ошибка получения постов: {str(e)}")
+                for owner_id in batch:
+                    self.poll_scheduler.failure(owner_id)
+                if isinstance(e, VKApiError) and e.code == 9:
+                    # Flood control: притормаживаем все источники
+                    self.poll_scheduler.delay_all(settings.get('poll_max_interval', 900))
+                continue
+
+            results = data.get('response') or []
+            results += [False] * (len(batch) - len(results))
+            for owner_id, call, result in zip(batch, calls, results):
+                if not result:
+                    # Ошибка отдельного wall.get внутри execute (закрытая стена и т.п.)
+                    logging.error(f"Ошибка получения постов {owner_id}")
+                    self.poll_scheduler.failure(owner_id)
+                    continue
+                source = state[owner_id]
+                items = result.get('items', [])
+                done = self.read_wall_page(source, items, call['count'])
+                if not done and len(items) >= call['count'] and len(source['seen']) >= source['limit'] \
+                        and self.wall_unfinished(owner_id, source):
+                    self.poll_scheduler.success(owner_id, len(source['posts']))
+                    continue
+                if done or len(items) < call['count'] or len(source['seen']) >= source['limit']:
+                    finished.append(owner_id)
+                    new_posts = sum(1 for post in source['posts'] if post['date'] > source['since'])
+                    self.poll_scheduler.success(owner_id, new_posts)
+                else:
+                    active.append(owner_id)
+
+        for owner_id in finished:
+            try:
+                self.propagate_changes(owner_id, state[owner_id]['items'])
+            except Exception as e:
+                logging.error(f"Ошибка переноса правок {owner_id}: {str(e)}")
+        return [post for owner_id in finished for post in state[owner_id]['posts']]
+
+    def longpoll_available(self):
+        # Ключ сообщества выдается на одну группу, поэтому long poll — только для одного источника
+        return (
+            CONFIG['settings'].get('use_longpoll', True)
+            and bool(CONFIG['vk'].get('group_token'))
+            and len(self.routes) == 1
+            and self.shard is None
+            and time.time() >= self.longpoll_retry_at
+        )
+
+    def get_longpoll_server(self):
         params = {
-            'owner_id': CONFIG['vk']['owner_id'],
-            'count': 10,
-            'access_token': CONFIG['vk']['token'],
-            'v': CONFIG['vk']['api_version']
+            'group_id': abs(next(iter(self.routes))),
+            'access_token': CONFIG['vk']['group_token']
         }
 
+        try:
+            return self.vk_call('groups.getLongPollServer', params)['response']
+        except Exception as e:
+            logging.error(f"Ошибка получения long poll сервера: {str(e)}")
+            return None
+
+    def disable_longpoll(self):
+        # Временно переключаемся на опрос wall.get
+        self.longpoll = None
+        self.longpoll_retry_at = time.time() + CONFIG['settings'].get('longpoll_retry', 300)
+        logging.warning("Long poll недоступен, используется опрос wall.get")
+
+    def get_longpoll_posts(self):
+        """Ждет новые посты через Bots Long Poll.
+
+        Возвращает список постов или None, если long poll недоступен и нужно
+        опросить wall.get обычным способом.
+        """
+        if self.longpoll is None:
+            owner_id = next(iter(self.routes))
+            if owner_id in self.wall_reads:
+                # Пропущено больше max_fetch_posts: стену дочитывает опрос, потом переподключимся
+                return None
+            self.longpoll = self.get_longpoll_server()
+            if self.longpoll is None:
+                self.disable_longpoll()
+                return None
+            # Догоняем посты, вышедшие пока long poll не был подключен, и правки за это время
+            items = []
+            try:
+                posts = self.get_vk_posts(owner_id, items=items)
+            except Exception:
+                self.longpoll = None
+                raise
+            if posts is None:
+                self.longpoll = None
+                return None
+            self.propagate_changes(owner_id, items)
+            self.edits_checked_at = time.monotonic()
+            logging.info("Подключен Bots Long Poll")
+            return posts
+
+        wait = CONFIG['settings'].get('longpoll_wait', 25)
         try:
             response = self.session.get(
-                'https://api.vk.com/method/wall.get',
-                params=params,
-                timeout=CONFIG['settings']['timeout']
+                self.longpoll['server'],
+                params={
+                    'act': 'a_check',
+                    'key': self.longpoll['key'],
+                    'ts': self.longpoll['ts'],
+                    'wait': wait
+                },
+                timeout=wait + CONFIG['settings']['timeout']
             )
-            data = response.json()
-            return data.get('response', {}).get('items', [])
+            data = json_loads(response.content)
         except Exception as e:
-            logging.error(f"Ошибка получения постов: {str(e)}")
+            logging.error(f"Ошибка long poll запроса: {str(e)}")
+            # Один цикл опрашиваем wall.get, затем переподключаемся
+            self.longpoll = None
+            return None
+
+        failed = data.get('failed')
+        if failed == 1:
+            # История событий устарела, продолжаем с новым ts
+            self.longpoll['ts'] = data['ts']
             return []
+        if failed:
+            # Истек ключ или потеряна информация: переподключаемся и догоняем через wall.get
+            self.longpoll = None
+            return self.get_longpoll_posts()
+
+        self.longpoll['ts'] = data.get('ts', self.longpoll['ts'])
+        posts = []
+        for update in data.get('updates', []):
+            if update.get('type') != 'wall_post_new':
+                continue
+            post = update.get('object', {})
+            # Предложенные и отложенные записи не публикуем
+            if post.get('post_type', 'post') in ('suggest', 'postpone'):
+                continue
+            posts.append(post)
+        return posts
 
     def process_post(self, post):
+        """Разбирает пост VK (или его репост) в PostContent: текст, фото и файлы."""
         # Проверяем наличие репоста (copy_history)
-        if 'copy_history' in post and post['copy_history']:
+        if post.get('copy_history'):
             repost = post['copy_history'][0]
-            result = {
-                'timestamp': post.get('date', 0),
-                'text': '',
-                'images': [],
-                'stats': {
-                    'likes': post.get('likes', {}).get('count', 0),
-                    'reposts': post.get('reposts', {}).get('count', 0),
-                    'views': post.get('views', {}).get('count', 0)
-                }
-            }
-            
             # Обрабатываем текст: основной + репост
             main_text = post.get('text', '')
             repost_text = repost.get('text', '')
-            
             if main_text and repost_text:
-                result['text'] = f"{main_text}\n\n{repost_text}"
+                result = PostContent(f"{main_text}\n\n{repost_text}")
             else:
-                result['text'] = main_text or repost_text
-                
+                result = PostContent(main_text or repost_text)
+
             # Добавляем гиперссылку на исходный пост
             owner_id = repost.get('owner_id', 0)
             post_id = repost.get('id', 0)
-            
+
             if owner_id and post_id:
                 # Формируем правильный URL для группы или пользователя
                 if owner_id < 0:
@@ -111,54 +2449,239 @@ class VK2TGBot:
                     source_url = f"https://vk.com/club{group_id}?w=wall{owner_id}_{post_id}"
                 else:
                     source_url = f"https://vk.com/id{owner_id}?w=wall{owner_id}_{post_id}"
-                
-                result['text'] += f"\n\n🔗 <a href='{source_url}'>Источник</a>"
-            
+
+                result.text += f"\n\n🔗 <a href='{source_url}'>Источник</a>"
+
             # Обрабатываем вложения репоста
-            for att in repost.get('attachments', []):
-                if att.get('type') == 'photo':
-                    photo = att['photo']
-                    largest = max(photo['sizes'], key=lambda s: s['width'] * s['height'])
-                    result['images'].append(largest['url'])
-                    
+            self.collect_attachments(repost.get('attachments', []), result)
             return result
-        
+
         # Обработка обычного поста (не репоста)
-        result = {
-            'timestamp': post.get('date', 0),
-            'text': post.get('text', ''),
-            'images': [],
-            'stats': {
-                'likes': post.get('likes', {}).get('count', 0),
-                'reposts': post.get('reposts', {}).get('count', 0),
-                'views': post.get('views', {}).get('count', 0)
-            }
-        }
+        result = PostContent(post.get('text', ''))
+        self.collect_attachments(post.get('attachments', []), result)
+        return result
 
-        for att in post.get('attachments', []):
+    def collect_attachments(self, attachments, result):
+        # Фото идут в альбом, видео и документы (GIF — анимацией) — отдельными сообщениями
+        for att in attachments:
             if att.get('type') == 'photo':
                 photo = att['photo']
                 largest = max(photo['sizes'], key=lambda s: s['width'] * s['height'])
-                result['images'].append(largest['url'])
+                result.images.append(largest['url'])
+                result.photo_keys.append(self.photo_key(photo))
+            elif att.get('type') == 'video':
+                video = att['video']
+                # Прямые ссылки на mp4 VK отдает не всегда; без них остается ссылка на страницу видео
+                files = {k: v for k, v in (video.get('files') or {}).items() if k.startswith('mp4_')}
+                best = max(files, key=lambda k: int(k[4:]) if k[4:].isdigit() else 0) if files else None
+                result.media.append({
+                    'type': 'video',
+                    'url': files.get(best),
+                    'key': f"video{video.get('owner_id')}_{video.get('id')}",
+                    'name': f"{video.get('title') or 'video'}.mp4",
+                    'size': None,
+                    'link': f"https://vk.com/video{video.get('owner_id')}_{video.get('id')}",
+                })
+            elif att.get('type') == 'doc':
+                doc = att['doc']
+                ext = (doc.get('ext') or '').lower()
+                title = doc.get('title') or 'document'
+                result.media.append({
+                    'type': 'animation' if ext == 'gif' else 'document',
+                    'url': doc.get('url'),
+                    'key': f"doc{doc.get('owner_id')}_{doc.get('id')}",
+                    'name': title if not ext or title.lower().endswith('.' + ext) else f"{title}.{ext}",
+                    'size': doc.get('size'),
+                    'link': f"https://vk.com/doc{doc.get('owner_id')}_{doc.get('id')}",
+                })
 
-        return result
+    def photo_key(self, photo):
+        # Одно и то же фото VK в разных постах и репостах имеет одинаковые owner_id и id
+        if 'owner_id' in photo and 'id' in photo:
+            return f"{photo['owner_id']}_{photo['id']}"
+        return None
+
+    def content_key(self, image_data):
+        return 'sha1:' + hashlib.sha1(image_data).hexdigest()
 
     def download_image(self, url):
-        for attempt in range(CONFIG['settings']['max_retries']):
+        retries = CONFIG['settings']['max_retries']
+        for attempt in range(retries):
             try:
+                started = time.monotonic()
                 response = self.session.get(url, stream=True, timeout=10)
                 response.raise_for_status()
+                self.metrics.observe('vk2tg_download_seconds', time.monotonic() - started)
+                self.metrics.inc('vk2tg_download_bytes_total', len(response.content))
                 
-                # Проверяем что это валидное изображение
-                img = Image.open(io.BytesIO(response.content))
-                img.verify()
+                # Проверяем что это валидное изображение (при пережатии это сделает transcode_image)
+                if not CONFIG['settings'].get('transcode', True):
+                    from PIL import Image
+                    img = Image.open(io.BytesIO(response.content))
+                    img.verify()
                 
                 return response.content
             except Exception as e:
                 logging.warning(f"Попытка {attempt+1}: Ошибка загрузки изображения - {str(e)}")
-                time.sleep(2)
+                self.metrics.inc('vk2tg_download_failures_total')
+                # Пауза блокирует только свой поток пула, остальные загрузки идут дальше
+                if attempt + 1 < retries:
+                    time.sleep(2 * (attempt + 1))
         return None
 
+    def download_images(self, urls):
+        # Качаем все изображения параллельно, порядок результата совпадает с порядком urls
+        images = [None] * len(urls)
+        missing = []
+        for idx, url in enumerate(urls):
+            found, image_data = self.take_prefetched(url)
+            if found:
+                images[idx] = image_data
+            else:
+                missing.append(idx)
+        if missing:
+            for idx, image_data in zip(missing, self.fetch_images([urls[idx] for idx in missing])):
+                images[idx] = image_data
+        return images
+
+    def fetch_images(self, urls):
+        images = list(self.download_pool.map(self.download_image, urls))
+        if CONFIG['settings'].get('transcode', True):
+            images = self.transcode_images(images)
+        return images
+
+    def take_prefetched(self, url):
+        # (найдено ли, данные): фото из предзагрузки отдаем один раз
+        with self.prefetch_lock:
+            future = self.prefetched.pop(url, None)
+        if future is None:
+            return False, None
+        return True, future.result()[url]
+
+    def prefetched_bytes(self):
+        # Скачанное — по размеру, а еще не скачанное — по среднему размеру фото: иначе,
+        # пока загрузки в пути, предел не сдерживал бы постановку новых
+        with self.prefetch_lock:
+            futures = list(self.prefetched.values())
+            estimate = self.prefetch_estimate
+        total = sum(estimate for f in futures if not f.done())
+        # Одна задача предзагрузки хранит сразу все фото поста, считаем ее один раз
+        done = {id(f): f for f in futures if f.done() and not f.exception()}
+        return total + sum(len(data or b'') for f in done.values() for data in f.result().values())
+
+    def prefetch_images(self, urls):
+        images = dict(zip(urls, self.fetch_images(urls)))
+        with self.prefetch_lock:
+            for data in images.values():
+                if data:
+                    self.prefetch_estimate += (len(data) - self.prefetch_estimate) / 8
+        return images
+
+    def prefetch(self, items):
+        """Заранее качает фото следующих постов, пока отправляется текущий.
+
+        Нужны только фото, которые пойдут файлом: при remote_media Telegram
+        качает ссылки сам, а фото из кэша уходят по file_id. Возвращает
+        ссылки, поставленные в предзагрузку.
+        """
+        settings = CONFIG['settings']
+        started = []
+        if settings.get('remote_media', True):
+            return started
+        for item in items:
+            if self.prefetched_bytes() >= settings.get('prefetch_max_bytes', 50 * 1024 * 1024):
+                break
+            payload = item['payload']
+            keys = payload.photo_keys or [None] * len(payload.images)
+            images = payload.images[:settings['max_images']]
+            with self.prefetch_lock:
+                urls = [
+                    url for url, key in zip(images, keys)
+                    if url not in self.prefetched and not self.file_ids.get(key)
+                ]
+                if not urls:
+                    continue
+                future = self.prefetch_pool.submit(self.prefetch_images, urls)
+                for url in urls:
+                    self.prefetched[url] = future
+                started.extend(urls)
+        return started
+
+    def drop_prefetched(self, urls):
+        # Неиспользованные фото (пост отложен или отправлен иначе) не держим в памяти
+        with self.prefetch_lock:
+            for url in urls:
+                self.prefetched.pop(url, None)
+
+    def submit_transcode(self, image_data):
+        from concurrent.futures.process import BrokenProcessPool
+        settings = CONFIG['settings']
+        args = (
+            image_data,
+            settings.get('max_photo_side', 2560),
+            settings.get('jpeg_quality', 87),
+            settings.get('max_photo_bytes', 10 * 1024 * 1024)
+        )
+        for attempt in range(2):
+            # Пул процессов создаем только при первой загрузке, а не при старте
+            with self.transcode_lock:
+                if self.transcode_pool is None:
+                    from concurrent.futures import ProcessPoolExecutor
+                    self.transcode_pool = ProcessPoolExecutor(max_workers=max(1, settings.get('transcode_workers', 2)))
+                pool = self.transcode_pool
+            try:
+                return pool, pool.submit(transcode_image, *args)
+            except BrokenProcessPool:
+                # Пул сломался на фото из другого потока: пересоздаем и пробуем еще раз
+                self.reset_transcode_pool(pool)
+                if attempt:
+                    raise
+
+    def reset_transcode_pool(self, pool):
+        # Пул с умершим процессом больше не принимает задачи: следующий вызов создаст новый
+        with self.transcode_lock:
+            if self.transcode_pool is pool:
+                self.transcode_pool = None
+        pool.shutdown(wait=False)
+
+    def transcode_result(self, pool, future):
+        # Отчет transcode_image или None, если процесс пула умер
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self.reset_transcode_pool(pool)
+            return None
+        except Exception as e:
+            return {'data': None, 'size': 0, 'ok': False, 'error': str(e)}
+
+    def transcode_images(self, images):
+        todo = [idx for idx, image_data in enumerate(images) if image_data]
+        if not todo:
+            return images
+        jobs = [(idx, self.submit_transcode(images[idx])) for idx in todo]
+        reports = {idx: self.transcode_result(*job) for idx, job in jobs}
+        for idx in [idx for idx in todo if reports[idx] is None]:
+            # Умерший процесс (например, убитый за нехватку памяти на огромном фото) ломает
+            # весь пул, и какое фото виновато, неизвестно. Пострадавшие фото повторяем по
+            # одному в новом пуле: без результата останется только то, на котором он падает снова
+            reports[idx] = self.transcode_result(*self.submit_transcode(images[idx])) or {
+                'data': None, 'size': 0, 'ok': False, 'error': 'процесс обработки фото завершился аварийно'
+            }
+        result = list(images)
+        for idx in todo:
+            report = reports[idx]
+            if report['ok']:
+                logging.info(f"Фото {idx + 1}: {len(images[idx])} -> {report['size']} байт")
+            else:
+                logging.warning(f"Фото {idx + 1}: не удалось подготовить - {report['error']}")
+            result[idx] = report['data']
+        return result
+
+    def telegram_url(self, method):
+        base = CONFIG['telegram'].get('api_url', 'https://api.telegram.org')
+        return f'{base}/bot{CONFIG["telegram"]["bot_token"]}/{method}'
+
     def create_keyboard(self):
         return {
             'inline_keyboard': [[{
@@ -167,126 +2690,1118 @@ class VK2TGBot:
             }]]
         }
 
-    def send_text_post(self, text):
-        url = f'https://api.telegram.org/bot{CONFIG["telegram"]["bot_token"]}/sendMessage'
+    def photo_file_id(self, message):
+        # Последний размер в массиве photo — оригинал
+        return message['photo'][-1]['file_id']
+
+    def message_ids(self, response):
+        # sendMessage/sendPhoto возвращают одно сообщение, sendMediaGroup — список
+        result = response.json().get('result')
+        if isinstance(result, list):
+            return [m['message_id'] for m in result]
+        return [result['message_id']]
+
+    def telegram_post(self, url, data, files=None, timeout=20, tokens=1, upload=None):
+        """Отправляет запрос к Telegram с учетом лимитов и повторяет его после 429.
+
+        tokens — сколько сообщений публикует запрос (для медиагруппы — число фото).
+        upload — (поле, имя файла, путь): файл с диска отправляется потоком.
+        """
+        chat_id = data.get('chat_id')
+        method = url.rsplit('/', 1)[-1]
+        upload_bytes = sum(len(f[1]) for f in (files or {}).values())
+        if upload:
+            upload_bytes += os.path.getsize(upload[2])
+        for attempt in range(CONFIG['settings']['max_retries'] + 1):
+            self.scheduler.acquire(chat_id, tokens)
+            started = time.monotonic()
+            if upload:
+                body = MultipartStream(data, *upload)
+                try:
+                    response = self.session.post(
+                        url, data=body, headers={'Content-Type': body.content_type}, timeout=timeout
+                    )
+                finally:
+                    body.close()
+            else:
+                response = self.session.post(url, data=data, files=files, timeout=timeout)
+            self.metrics.observe('vk2tg_telegram_request_seconds', time.monotonic() - started, method=method)
+            self.metrics.inc('vk2tg_telegram_responses_total', method=method, code=response.status_code)
+            self.metrics.inc('vk2tg_telegram_upload_bytes_total', upload_bytes)
+            if response.status_code != 429:
+                return response
+            self.metrics.inc('vk2tg_telegram_throttled_total')
+            try:
+                retry_after = response.json()['parameters']['retry_after']
+            except Exception:
+                retry_after = 5
+            logging.warning(f"Telegram ограничил отправку, ждем {retry_after} с")
+            # Пауза действует на все пути отправки в этот чат
+            self.scheduler.pause(chat_id, retry_after)
+        return response
+
+    def send_text_post(self, text, chat_id):
+        url = self.telegram_url('sendMessage')
         
         data = {
-            'chat_id': CONFIG['telegram']['chat_id'],
+            'chat_id': chat_id,
             'text': text,
             'parse_mode': 'HTML',
             'reply_markup': json.dumps(self.create_keyboard())
         }
 
         try:
-            response = self.session.post(url, data=data, timeout=10)
-            return response.status_code == 200
+            response = self.telegram_post(url, data=data, timeout=10)
+            if response.status_code == 200:
+                return self.message_ids(response)
+            return False
         except Exception as e:
             logging.error(f"Ошибка отправки текста: {str(e)}")
             return False
 
-    def send_single_photo(self, caption, photo_url):
-        url = f'https://api.telegram.org/bot{CONFIG["telegram"]["bot_token"]}/sendPhoto'
-        
-        image_data = self.download_image(photo_url)
+    def send_single_photo(self, caption, photo_url, photo_key, chat_id):
+        url = self.telegram_url('sendPhoto')
+
+        data = {
+            'chat_id': chat_id,
+            'caption': caption,
+            'parse_mode': 'HTML',
+            'reply_markup': json.dumps(self.create_keyboard())
+        }
+
+        file_id = self.file_ids.get(photo_key)
+        if file_id:
+            photo = file_id
+        elif CONFIG['settings'].get('remote_media', True):
+            # Telegram сам скачивает фото по ссылке VK
+            photo = photo_url
+        else:
+            photo = None
+
+        if photo:
+            try:
+                response = self.telegram_post(url, data={**data, 'photo': photo}, timeout=20)
+                if response.status_code == 200:
+                    message = response.json()['result']
+                    if not file_id:
+                        self.file_ids.put(self.photo_file_id(message), photo_key)
+                    return [message['message_id']]
+                if response.status_code != 400:
+                    logging.error(f"Ошибка отправки фото: {response.text}")
+                    return False
+                logging.warning(f"Telegram не принял фото без загрузки, загружаем сами: {response.text}")
+                if file_id:
+                    self.file_ids.forget(photo_key)
+            except Exception as e:
+                logging.error(f"Ошибка отправки фото: {str(e)}")
+                return False
+
+        image_data = self.download_images([photo_url])[0]
         if not image_data:
             return False
 
+        try:
+            content_key = self.content_key(image_data)
+            file_id = self.file_ids.get(content_key)
+            if file_id:
+                # То же содержимое уже загружалось под другим id фото
+                response = self.telegram_post(url, data={**data, 'photo': file_id}, timeout=20)
+            else:
+                response = self.telegram_post(
+                    url,
+                    data=data,
+                    files={'photo': ('image.jpg', image_data)},
+                    timeout=10
+                )
+            if response.status_code == 200:
+                message = response.json()['result']
+                self.file_ids.put(self.photo_file_id(message), photo_key, content_key)
+                return [message['message_id']]
+            if file_id:
+                self.file_ids.forget(content_key)
+            return False
+        except Exception as e:
+            logging.error(f"Ошибка отправки фото: {str(e)}")
+            return False
+
+    def send_to_telegram(self, content, images, photo_keys=None, chat_id=None, media=None, sent=None, guard=None):
+        """Отправляет пост по частям: текст или фото, затем каждый файл.
+
+        В sent дописываются id сообщений каждой отправленной части, а части,
+        которые в нем уже есть, пропускаются. Так повтор после сбоя на
+        файле не дублирует текст и фото. Возвращает id всех сообщений
+        поста или False, если какая-то часть не ушла. guard проверяется
+        перед каждой частью (аренда источника при шардировании); если он
+        вернул False, отправка прерывается с LeaseLost.
+        """
+        photo_keys = photo_keys or [None] * len(images)
+        chat_id = chat_id or CONFIG['telegram']['chat_id']
+        media = media or []
+        sent = [] if sent is None else sent
+        # Без фото текст становится подписью первого видео или документа, если в нее помещается
+        caption = content if not images and media and len(content) <= 1024 else ''
+        if not sent:
+            if guard is not None and not guard():
+                raise LeaseLost("аренда источника потеряна")
+            if caption:
+                message_ids = []
+            elif not images:
+                message_ids = self.send_text_post(content, chat_id)
+            elif len(images) == 1:
+                message_ids = self.send_single_photo(content, images[0], photo_keys[0], chat_id)
+            else:
+                message_ids = self.send_media_group(content, images, photo_keys, chat_id)
+            if message_ids is False:
+                return False
+            sent.append(message_ids)
+        for idx, item in enumerate(media):
+            if idx + 1 < len(sent):
+                continue
+            if guard is not None and not guard():
+                raise LeaseLost("аренда источника потеряна")
+            message_ids = self.send_media_file(item, caption if idx == 0 else '', chat_id)
+            if not message_ids:
+                return False
+            sent.append(message_ids)
+        return [message_id for part in sent for message_id in part]
+
+    def send_media_file(self, item, caption, chat_id):
+        """Отправляет видео, документ или GIF: по file_id из кэша или файлом с диска.
+
+        Если файл нельзя получить (нет прямой ссылки, больше предела Telegram),
+        вместо него отправляется ссылка на страницу в VK.
+        """
+        method, field = {
+            'video': ('sendVideo', 'video'),
+            'animation': ('sendAnimation', 'animation'),
+        }.get(item['type'], ('sendDocument', 'document'))
+        url = self.telegram_url(method)
         data = {
-            'chat_id': CONFIG['telegram']['chat_id'],
+            'chat_id': chat_id,
             'caption': caption,
             'parse_mode': 'HTML',
             'reply_markup': json.dumps(self.create_keyboard())
         }
+        timeout = CONFIG['settings'].get('media_timeout', 300)
+
+        file_id = self.file_ids.get(item['key'])
+        if file_id:
+            try:
+                response = self.telegram_post(url, data={**data, field: file_id}, timeout=timeout)
+                if response.status_code == 200:
+                    return self.message_ids(response)
+                logging.warning(f"Telegram не принял file_id, загружаем файл заново: {response.text}")
+                self.file_ids.forget(item['key'])
+            except Exception as e:
+                logging.error(f"Ошибка отправки {item['name']}: {str(e)}")
+                return False
 
+        path = self.download_media(item)
+        if path is False:
+            return False
+        if path is None:
+            link = f"{caption}\n\n" if caption else ''
+            return self.send_text_post(f"{link}📎 <a href='{item['link']}'>{item['name']}</a>", chat_id)
         try:
-            response = self.session.post(
-                url,
-                data=data,
-                files={'photo': ('image.jpg', image_data)},
-                timeout=10
-            )
-            return response.status_code == 200
+            response = self.telegram_post(url, data=data, timeout=timeout, upload=(field, item['name'], path))
+            if response.status_code != 200:
+                logging.error(f"Ошибка отправки {item['name']}: {response.text}")
+                return False
+            message = response.json()['result']
+            # GIF Telegram возвращает как animation, остальное — под именем поля
+            attachment = message.get(field) or message.get('document')
+            if attachment:
+                self.file_ids.put(attachment['file_id'], item['key'])
+            return [message['message_id']]
         except Exception as e:
-            logging.error(f"Ошибка отправки фото: {str(e)}")
+            logging.error(f"Ошибка отправки {item['name']}: {str(e)}")
             return False
+        finally:
+            os.remove(path)
 
-    def send_to_telegram(self, content, images):
-        if not images:
-            return self.send_text_post(content)
-        elif len(images) == 1:
-            return self.send_single_photo(content, images[0])
-        else:
-            return self.send_media_group(content, images)
+    def download_media(self, item):
+        """Качает видео или документ во временный файл по частям и возвращает путь.
 
-    def send_media_group(self, caption, image_urls):
-        url = f'https://api.telegram.org/bot{CONFIG["telegram"]["bot_token"]}/sendMediaGroup'
-        
+        В памяти держится только текущий блок. Файлы больше max_upload_bytes
+        не качаются: Telegram их все равно не примет. None — файл получить
+        нельзя (вместо него пойдет ссылка), False — не удалось скачать сейчас.
+        """
+        settings = CONFIG['settings']
+        limit = settings.get('max_upload_bytes', 50 * 1024 * 1024)
+        if not item.get('url') or (item.get('size') or 0) > limit:
+            return None
+        for attempt in range(settings['max_retries']):
+            path = None
+            try:
+                started = time.monotonic()
+                with self.session.get(item['url'], stream=True, timeout=settings.get('media_timeout', 300)) as response:
+                    response.raise_for_status()
+                    if int(response.headers.get('Content-Length') or 0) > limit:
+                        logging.warning(f"{item['name']} больше предела Telegram, отправляем ссылку")
+                        return None
+                    with tempfile.NamedTemporaryFile(
+                        prefix='vk2tg-', suffix=os.path.splitext(item['name'])[1],
+                        dir=settings.get('media_temp_dir') or None, delete=False
+                    ) as f:
+                        path = f.name
+                        size = 0
+                        for chunk in response.iter_content(1024 * 1024):
+                            size += len(chunk)
+                            if size > limit:
+                                raise ValueError("файл больше предела Telegram")
+                            f.write(chunk)
+                self.metrics.observe('vk2tg_download_seconds', time.monotonic() - started)
+                self.metrics.inc('vk2tg_download_bytes_total', size)
+                return path
+            except Exception as e:
+                if path:
+                    os.remove(path)
+                logging.warning(f"Попытка {attempt+1}: Ошибка загрузки {item['name']} - {str(e)}")
+                self.metrics.inc('vk2tg_download_failures_total')
+                if isinstance(e, ValueError):
+                    return None
+                if attempt + 1 < settings['max_retries']:
+                    time.sleep(2 * (attempt + 1))
+        return False
+
+    def build_media_group(self, caption, items):
+        # items: ссылка или file_id (str) — без загрузки, bytes — загружаем файлом, None — пропускаем
         media = []
         files = {}
+        positions = []
         # Создаем список media без reply_markup
-        for idx, img_url in enumerate(image_urls[:CONFIG['settings']['max_images']]):
-            image_data = self.download_image(img_url)
-            if not image_data:
+        for idx, item in enumerate(items):
+            if not item:
                 continue
-                
-            media_obj = {
-                'type': 'photo',
-                'media': f'attach://photo{idx}'
-            }
+
+            if isinstance(item, str):
+                media_obj = {'type': 'photo', 'media': item}
+            else:
+                media_obj = {'type': 'photo', 'media': f'attach://photo{idx}'}
+                files[f'photo{idx}'] = (f'photo{idx}.jpg', item)
 
             # Добавляем caption и parse_mode только к первому элементу
-            if idx == 0:
+            if not media:
                 media_obj['caption'] = caption
                 media_obj['parse_mode'] = 'HTML'
-            
+
             media.append(media_obj)
-            files[f'photo{idx}'] = (f'photo{idx}.jpg', image_data)
+            positions.append(idx)
+        return media, files, positions
 
-        if not media:
-            return False
+    def send_media_group(self, caption, image_urls, photo_keys, chat_id):
+        url = self.telegram_url('sendMediaGroup')
+
+        image_urls = image_urls[:CONFIG['settings']['max_images']]
+        photo_keys = photo_keys[:len(image_urls)]
+        content_keys = [None] * len(image_urls)
+        remote_media = CONFIG['settings'].get('remote_media', True)
+
+        # Фото из кэша уходят по file_id, остальные по ссылке или файлом
+        cached = [self.file_ids.get(key) for key in photo_keys]
+        items = [file_id or (img_url if remote_media else None) for file_id, img_url in zip(cached, image_urls)]
+        missing = [idx for idx, item in enumerate(items) if item is None]
+        for idx, image_data in zip(missing, self.download_images([image_urls[i] for i in missing])):
+            items[idx] = self.cached_or_data(image_data, content_keys, idx)
 
         # Передаем reply_markup отдельно
         reply_markup = json.dumps(self.create_keyboard())
 
-        try:
-            response = self.session.post(
-                url,
-                data={
-                    'chat_id': CONFIG['telegram']['chat_id'],
-                    'media': json.dumps(media),
-                    'reply_markup': reply_markup
-                },
-                files=files,
-                timeout=20
-            )
-            
-            if response.status_code != 200:
-                logging.error(f"Ошибка медиагруппы: {response.text}")
-            return response.status_code == 200
-            
-        except Exception as e:
-            logging.error(f"Ошибка отправки медиагруппы: {str(e)}")
-            return False
-    def run(self):
-        logging.info("Bot Started")
         while True:
+            media, files, positions = self.build_media_group(caption, items)
+            if not media:
+                return False
+
             try:
-                posts = self.get_vk_posts()
-                new_posts = [p for p in posts if p['date'] > self.last_post_time]
-                new_posts.sort(key=lambda x: x['date'])
+                response = self.telegram_post(
+                    url,
+                    data={
+                        'chat_id': chat_id,
+                        'media': json.dumps(media),
+                        'reply_markup': reply_markup
+                    },
+                    files=files,
+                    timeout=20,
+                    tokens=len(media)
+                )
+            except Exception as e:
+                logging.error(f"Ошибка отправки медиагруппы: {str(e)}")
+                return False
+
+            if response.status_code == 200:
+                messages = response.json()['result']
+                for message, idx in zip(messages, positions):
+                    if 'photo' in message:
+                        self.file_ids.put(self.photo_file_id(message), photo_keys[idx], content_keys[idx])
+                return [m['message_id'] for m in messages]
+
+            # Telegram не смог взять часть фото по ссылке или file_id: качаем сами только отклоненные
+            remote = [idx for idx in positions if isinstance(items[idx], str)]
+            if response.status_code != 400 or not remote:
+                logging.error(f"Ошибка медиагруппы: {response.text}")
+                return False
+
+            # Ошибка вида "failed to send message #3 ..." указывает на элемент (с единицы)
+            match = re.search(r'#(\d+)', response.text)
+            if match and 0 < int(match.group(1)) <= len(positions) \
+                    and isinstance(items[positions[int(match.group(1)) - 1]], str):
+                rejected = [positions[int(match.group(1)) - 1]]
+            else:
+                rejected = remote
+            logging.warning(f"Telegram не принял {len(rejected)} фото без загрузки, загружаем сами: {response.text}")
+            for idx in rejected:
+                self.file_ids.forget(photo_keys[idx], content_keys[idx])
+                content_keys[idx] = None
+            for idx, image_data in zip(rejected, self.download_images([image_urls[i] for i in rejected])):
+                # После отказа грузим файл, даже если его хеш есть в кэше
+                items[idx] = image_data
+                if image_data:
+                    content_keys[idx] = self.content_key(image_data)
+
+    def cached_or_data(self, image_data, content_keys, idx):
+        # Скачанное фото могло уже загружаться под другим id: тогда шлем file_id
+        if not image_data:
+            return None
+        content_keys[idx] = self.content_key(image_data)
+        return self.file_ids.get(content_keys[idx]) or image_data
+
+    def check_edits(self):
+        """Сверяет первую страницу стены с журналом, пока посты приходят через long poll.
+
+        О правках и удалениях записей Bots Long Poll не сообщает, поэтому
+        раз в edit_poll_interval секунд стена читается одним запросом
+        wall.get. Ошибка только пишется в лог: новые посты идут дальше.
+        """
+        settings = CONFIG['settings']
+        interval = settings.get('edit_poll_interval', 300)
+        if not interval or not settings.get('edit_window', 86400):
+            return
+        if time.monotonic() - self.edits_checked_at < interval:
+            return
+        self.edits_checked_at = time.monotonic()
+        owner_id = next(iter(self.routes))
+        try:
+            data = self.vk_call('wall.get', {
+                'owner_id': owner_id,
+                'count': min(100, settings.get('page_size', 100)),
+                'access_token': CONFIG['vk']['token']
+            })
+            self.propagate_changes(owner_id, data.get('response', {}).get('items', []))
+        except Exception as e:
+            logging.error(f"Ошибка проверки правок постов: {str(e)}")
+
+    def fetch_new_posts(self):
+        """Один цикл получения постов: (посты, нужно ли ждать check_interval)."""
+        started = time.monotonic()
+        posts, wait = None, True
+        if self.longpoll_available():
+            posts = self.get_longpoll_posts()
+            wait = posts is None
+            if posts is not None:
+                self.check_edits()
+        if posts is None:
+            due = self.poll_scheduler.due()
+            posts = self.fetch_walls(due) if due else []
+        self.events.emit('stage', stage='fetch', seconds=round(time.monotonic() - started, 3), posts=len(posts))
+        return posts, wait
 
-                for post in new_posts:
+    def poll_delay(self):
+        # До ближайшего опроса по расписанию, но не дольше check_interval,
+        # чтобы очередь повторов отправки не простаивала
+        delay = self.poll_scheduler.next_time() - time.time()
+        return max(1, min(delay, CONFIG['settings']['check_interval']))
+
+    def error_delay(self):
+        # Пауза после ошибки в цикле растет экспоненциально
+        self.error_streak += 1
+        settings = CONFIG['settings']
+        return min(settings.get('poll_max_interval', 900), settings['check_interval'] * 2 ** (self.error_streak - 1))
+
+    def publish_posts(self, posts):
+        try:
+            self.enqueue_posts(posts)
+            self.deliver_outbox()
+        finally:
+            self.file_ids.evict()
+            self.journal.commit()
+
+    def enqueue_posts(self, posts):
+        """Ставит новые посты в очередь отправки и сдвигает позиции источников.
+
+        Возвращает чаты, в которые добавились посты.
+        """
+        started = time.monotonic()
+        new_posts = [p for p in posts if p['date'] >= self.cursors.get(p['owner_id'], 0)]
+        if self.shard is not None:
+            # Источник мог перейти к другому воркеру, пока шел запрос
+            new_posts = [p for p in new_posts if self.shard.owns(p['owner_id'])]
+        new_posts.sort(key=lambda x: (x['date'], x['id']))
+
+        # Новые посты сначала ставим в очередь для каждого чата маршрута: дальше
+        # они не теряются, и позицию на стене можно сдвигать сразу
+        chats = set()
+        for post in new_posts:
+            owner_id = post['owner_id']
+            processed = None
+            for chat_id in self.routes.get(owner_id, []):
+                if self.journal.is_sent(owner_id, post['id'], chat_id) \
+                        or self.outbox.contains(owner_id, post['id'], chat_id):
+                    continue
+                if processed is None:
                     processed = self.process_post(post)
-                    if self.send_to_telegram(processed['text'], processed['images']):
-                        self.last_post_time = max(self.last_post_time, processed['timestamp'])
-                        self.save_last_post_time(self.last_post_time)
+                self.outbox.enqueue(owner_id, post['id'], chat_id, post['date'], processed)
+                chats.add(str(chat_id))
+            if post['date'] > self.cursors.get(owner_id, 0):
+                self.save_last_post_time(owner_id, post['date'])
+        self.journal.commit()
+        if new_posts:
+            self.events.emit('stage', stage='enqueue', seconds=round(time.monotonic() - started, 3), posts=len(new_posts))
+        return chats
+
+    def deliver_outbox(self, chat_id=None):
+        # Отправляем только посты, чья пауза истекла: зависший пост не держит остальные
+        items = self.outbox.due(chat_id, self.shard.owned_sources() if self.shard is not None else None)
+        lookahead = CONFIG['settings'].get('prefetch_posts', 2)
+        prefetched = []
+        for idx, item in enumerate(items):
+            if self.stopping.is_set():
+                break
+            # Пока текущий пост загружается в Telegram, качаем фото следующих
+            prefetched += self.prefetch(items[idx + 1:idx + 1 + lookahead])
+            processed = item['payload']
+            sent_started = time.monotonic()
+            guard = None
+            if self.shard is not None:
+                if not self.shard.begin_send(item['owner_id']):
+                    continue
+                guard = functools.partial(self.shard.holds, item['owner_id'])
+            name = f"{item['owner_id']}_{item['post_id']} -> {item['chat_id']}"
+            lease_lost = False
+            try:
+                message_ids = self.send_to_telegram(
+                    processed.text, processed.images, processed.photo_keys, item['chat_id'],
+                    processed.media, processed.sent, guard
+                )
+                if message_ids:
+                    if guard is not None and not guard():
+                        raise LeaseLost("аренда источника потеряна")
+                    # Доставка фиксируется сразу: если процесс убьют посреди прохода, при
+                    # перезапуске повторится только пост, который отправлялся в тот момент.
+                    # При шардировании это еще и до освобождения аренды: новый владелец
+                    # увидит доставку в журнале
+                    self.journal.record(
+                        item['owner_id'], item['post_id'], item['chat_id'], item['date'], message_ids,
+                        self.content_hash(processed)
+                    )
+                    self.outbox.remove(item['owner_id'], item['post_id'], item['chat_id'])
+                    self.journal.commit()
+            except LeaseLost:
+                # Пост доставит новый владелец источника: оставляем ему уже отправленные части,
+                # не засчитывая попытку
+                logging.warning(f"Источник {item['owner_id']} перешел к другому воркеру, пост {name} оставлен ему")
+                self.outbox.save_progress(item)
+                message_ids = None
+                lease_lost = True
+            except Exception as e:
+                # Ошибка одного поста не останавливает проход: он уходит на повтор с паузой,
+                # а очередь за ним продолжает отправляться
+                logging.error(f"Ошибка отправки поста {name}: {str(e)}")
+                message_ids = None
+            finally:
+                if self.shard is not None:
+                    self.shard.end_send(item['owner_id'])
+            if lease_lost:
+                continue
+            self.last_progress = time.monotonic()
+            if message_ids:
+                lag = max(0, time.time() - item['date'])
+                self.metrics.inc('vk2tg_posts_sent_total')
+                self.metrics.observe('vk2tg_delivery_lag_seconds', lag)
+                self.events.emit(
+                    'post_sent', owner_id=item['owner_id'], post_id=item['post_id'], chat_id=item['chat_id'],
+                    lag=round(lag, 1), seconds=round(self.last_progress - sent_started, 3), messages=len(message_ids)
+                )
+            elif self.outbox.fail(item):
+                self.metrics.inc('vk2tg_dead_letters_total')
+                logging.error(
+                    f"Пост {name} не отправлен после {item['attempts'] + 1} попыток "
+                    f"и перенесен в очередь неотправленных"
+                )
+            else:
+                self.metrics.inc('vk2tg_send_retries_total')
+                logging.warning(f"Пост {name} будет отправлен повторно")
+        self.drop_prefetched(prefetched)
+        self.journal.commit()
+
+    def handle_command(self, command):
+        if command.get('type') == 'stop':
+            logging.info("Получена команда остановки")
+            self.stop()
 
-                time.sleep(CONFIG['settings']['check_interval'])
+    def heartbeat_loop(self):
+        # Сообщает лаунчеру, что процесс жив, и сколько секунд назад основной цикл делал работу
+        interval = CONFIG['settings'].get('heartbeat_interval', 5)
+        while not self.stopping.wait(interval):
+            try:
+                self.events.emit(
+                    'heartbeat',
+                    outbox=self.outbox.size(),
+                    dead_letters=self.outbox.size('dead_letters'),
+                    queue=self.posts_queue.qsize() if self.posts_queue is not None else 0,
+                    idle=round(time.monotonic() - self.last_progress, 1)
+                )
+            except Exception:
+                pass
+
+    def run(self):
+        logging.info("Bot Started")
+        self.events.emit('started', engine='sync', sources=len(self.routes))
+        while not self.stopping.is_set():
+            self.last_progress = time.monotonic()
+            try:
+                posts, wait = self.fetch_new_posts()
+                self.publish_posts(posts)
+                self.error_streak = 0
+                if wait:
+                    self.stopping.wait(self.poll_delay())
                 
             except Exception as e:
                 logging.error(f"Ошибка в основном цикле: {str(e)}")
-                time.sleep(60)
+                self.stopping.wait(self.error_delay())
+        self.journal.commit()
+        if self.shard is not None:
+            self.shard.stop()
+        logging.info("Bot Stopped")
+        self.events.emit('stopped')
+
+    def stop(self):
+        # Остановка из другого потока: синхронный цикл выходит после текущего поста,
+        # асинхронный завершается так же, как по SIGTERM
+        self.stopping.set()
+        if self.async_stop is not None:
+            self.async_stop[0].call_soon_threadsafe(self.async_stop[1].set)
+
+    # ---------------- Правки и удаления ----------------
+    def text_in_caption(self, processed):
+        # Текст поста — подпись к первому фото, видео или документу, а не отдельное сообщение
+        return bool(processed.images) or (bool(processed.media) and len(processed.text) <= 1024)
+
+    def content_hash(self, processed):
+        """Короткий хеш поста вида 'текст:вложения' для поиска правок.
+
+        Фото и файлы входят в хеш своими ключами VK, а не ссылками: ссылки
+        на CDN меняются и без правки поста.
+        """
+        text = hashlib.blake2b(processed.text.encode('utf-8'), digest_size=6).hexdigest()
+        keys = [key or url for key, url in zip(processed.photo_keys, processed.images)]
+        keys += [item['key'] for item in processed.media]
+        keys.append('caption' if self.text_in_caption(processed) else 'text')
+        media = hashlib.blake2b('\n'.join(map(str, keys)).encode('utf-8'), digest_size=6).hexdigest()
+        return f'{text}:{media}'
+
+    def propagate_changes(self, owner_id, items):
+        """Переносит в Telegram правки и удаления недавних постов.
+
+        items — страницы стены, уже прочитанные при опросе, так что лишних
+        запросов к VK нет. Для доставленного поста моложе edit_window
+        сравнивается хеш содержимого с журналом, и Telegram вызывается
+        только при расхождении. Пост из журнала, которого нет внутри
+        прочитанного отрезка стены, удален в VK.
+        """
+        settings = CONFIG['settings']
+        window = settings.get('edit_window', 86400)
+        if not window:
+            return
+        since = time.time() - window
+        posts = {post['id']: post for post in items if post['date'] >= since}
+        if not posts:
+            return
+        # Чтение идет от самых новых постов, поэтому отрезок стены — от самого старого прочитанного
+        # и выше; закрепленный пост стоит вне порядка и границей не служит
+        ids = [post['id'] for post in items if not post.get('is_pinned')]
+        processed = {}
+        for post_id, chat_id, message_ids, old_hash in self.journal.recent(owner_id, min(posts), since):
+            if old_hash == 'deleted':
+                continue
+            post = posts.get(post_id)
+            if post is None:
+                if settings.get('propagate_deletes', True) and ids and post_id > min(ids):
+                    if self.telegram_edit('deleteMessages', {'chat_id': chat_id, 'message_ids': json.dumps(message_ids)}):
+                        self.journal.set_content_hash(owner_id, post_id, chat_id, 'deleted')
+                        self.journal.commit()
+                        self.metrics.inc('vk2tg_posts_deleted_total')
+                        logging.info(f"Пост {owner_id}_{post_id} удален в VK, удаляем в {chat_id}")
+                continue
+            if post_id not in processed:
+                processed[post_id] = self.process_post(post)
+            new_hash = self.content_hash(processed[post_id])
+            if new_hash == old_hash:
+                continue
+            # У записей прежней версии хеша нет: запоминаем текущий, править нечего
+            if old_hash is None or self.edit_messages(chat_id, message_ids, old_hash, new_hash, processed[post_id]):
+                self.journal.set_content_hash(owner_id, post_id, chat_id, new_hash)
+                # Каждую правку фиксируем до следующего запроса к Telegram
+                self.journal.commit()
+                if old_hash is not None:
+                    self.metrics.inc('vk2tg_posts_edited_total')
+                    logging.info(f"Пост {owner_id}_{post_id} изменен в VK, обновлен в {chat_id}")
+        self.journal.commit()
+
+    def edit_messages(self, chat_id, message_ids, old_hash, new_hash, processed):
+        # True — правка перенесена (или перенести ее нельзя), False — повторить при следующем опросе
+        old_text, old_media = old_hash.split(':')
+        new_text, new_media = new_hash.split(':')
+        if old_media != new_media:
+            edited = self.edit_photos(chat_id, message_ids, processed)
+            if edited is not None:
+                return edited
+            logging.warning(f"Состав вложений поста изменился, в {chat_id} обновляем только текст")
+        if old_text == new_text or not message_ids:
+            return True
+        data = {'chat_id': chat_id, 'message_id': message_ids[0], 'parse_mode': 'HTML'}
+        if len(processed.images) <= 1:
+            # Клавиатуру в альбоме Telegram не показывает, и правка с ней не проходит
+            data['reply_markup'] = json.dumps(self.create_keyboard())
+        if self.text_in_caption(processed):
+            return self.telegram_edit('editMessageCaption', {**data, 'caption': processed.text})
+        return self.telegram_edit('editMessageText', {**data, 'text': processed.text})
+
+    def edit_photos(self, chat_id, message_ids, processed):
+        """Заменяет фото в отправленных сообщениях через editMessageMedia.
+
+        Возможно, только если пост по-прежнему из одних фото и их столько же,
+        сколько сообщений; иначе возвращает None.
+        """
+        images = processed.images[:CONFIG['settings']['max_images']]
+        if not images or processed.media or len(images) != len(message_ids):
+            return None
+        photo_keys = (processed.photo_keys or [None] * len(images))[:len(images)]
+        for idx, (message_id, url, key) in enumerate(zip(message_ids, images, photo_keys)):
+            photo = self.file_ids.get(key) or (url if CONFIG['settings'].get('remote_media', True) else None)
+            files = None
+            if photo is None:
+                image_data = self.download_images([url])[0]
+                if not image_data:
+                    return False
+                photo, files = 'attach://photo', {'photo': ('photo.jpg', image_data)}
+            media = {'type': 'photo', 'media': photo}
+            if idx == 0:
+                media.update({'caption': processed.text, 'parse_mode': 'HTML'})
+            data = {'chat_id': chat_id, 'message_id': message_id, 'media': json.dumps(media)}
+            if len(images) == 1:
+                data['reply_markup'] = json.dumps(self.create_keyboard())
+            if not self.telegram_edit('editMessageMedia', data, files):
+                return False
+        return True
+
+    def telegram_edit(self, method, data, files=None):
+        # False — временная ошибка; отказ Telegram (сообщение не найдено, не изменилось и т.п.) повторять незачем
+        try:
+            response = self.telegram_post(self.telegram_url(method), data=data, files=files, timeout=20)
+        except Exception as e:
+            logging.error(f"Ошибка {method}: {str(e)}")
+            return False
+        if response.status_code == 200 or 'message is not modified' in response.text:
+            return True
+        if 400 <= response.status_code < 500:
+            logging.warning(f"Telegram отклонил {method}: {response.text}")
+            return True
+        logging.error(f"Ошибка {method}: {response.text}")
+        return False
+
+    # ---------------- Перенос стены ----------------
+    def read_wall_chunk(self, owner_id, total, skip):
+        """Читает одним execute до migration_pages страниц стены, следующих за skip самыми старыми постами.
+
+        Смещения wall.get считаются от новых постов, поэтому вычисляются из
+        total. Возвращает (посты от старых к новым, сколько прочитано, total
+        по ответу VK). Если total за это время изменился, страницы сдвинуты:
+        тогда постов нет, и кусок нужно прочитать заново с новым total.
+        """
+        page_size = 100
+        calls = []
+        for page in range(min(24, CONFIG['settings'].get('migration_pages', 24))):
+            offset = total - skip - page_size * (page + 1)
+            count = page_size + min(0, offset)
+            if count <= 0:
+                break
+            calls.append({'owner_id': owner_id, 'count': count, 'offset': max(0, offset)})
+        code = 'return [' + ','.join(f'API.wall.get({json.dumps(call)})' for call in calls) + '];'
+        data = self.vk_call('execute', {'code': code, 'access_token': CONFIG['vk']['token']})
+        results = data.get('response') or []
+        if len(results) < len(calls) or not all(results):
+            raise RuntimeError(f"стена {owner_id} недоступна")
+        counts = {result.get('count', total) for result in results}
+        if counts != {total}:
+            return [], 0, max(counts)
+        posts = [post for result in reversed(results) for post in reversed(result.get('items', []))]
+        return posts, sum(call['count'] for call in calls), total
+
+    def migrate_wall(self, owner_id, chat_id):
+        """Переносит всю стену owner_id в chat_id, начиная с самых старых постов.
+
+        Стена читается кусками по migration_pages страниц через execute,
+        фото следующих постов качаются заранее, отправка идет в пределах
+        лимитов Telegram (SendScheduler). После каждого поста в журнал
+        пишется контрольная точка, поэтому прерванный перенос продолжается
+        с того же места, а доставленные посты не отправляются повторно.
+        Пост, который не удалось отправить, повторяется на месте с паузами
+        (send_migrated_post), чтобы архив не потерял порядок. Возвращает
+        число отправленных постов.
+        """
+        settings = CONFIG['settings']
+        state = self.journal.get_migration(owner_id, chat_id) or {'last_post_id': 0, 'read': 0, 'migrated': 0}
+        data = self.vk_call('wall.get', {'owner_id': owner_id, 'count': 1, 'access_token': CONFIG['vk']['token']})
+        total = data['response']['count']
+        if state['read']:
+            logging.info(f"Продолжаем перенос {owner_id} -> {chat_id}: прочитано {state['read']} из {total}")
+        else:
+            logging.info(f"Перенос {owner_id} -> {chat_id}: на стене {total} постов")
+        started, start_position, sent = time.monotonic(), state['read'], 0
+        reported = started
+        lookahead = settings.get('migration_prefetch', 10)
+        while not self.stopping.is_set() and state['read'] < total:
+            # Небольшой нахлест: удаленные на стене посты сдвигают смещения к новым
+            skip = max(0, state['read'] - 10)
+            posts, count, total = self.read_wall_chunk(owner_id, total, skip)
+            if not count:
+                continue
+            # Закрепленный пост приходит первым на первой странице, поэтому порядок — по id
+            posts = sorted({p['id']: p for p in posts if p['id'] > state['last_post_id']}.values(), key=lambda p: p['id'])
+            items = [
+                {'owner_id': owner_id, 'post_id': post['id'], 'chat_id': str(chat_id), 'date': post['date'],
+                 'payload': self.process_post(post)}
+                for post in posts
+            ]
+            prefetched = []
+            for idx, item in enumerate(items):
+                if self.stopping.is_set():
+                    break
+                if not self.journal.is_sent(owner_id, item['post_id'], chat_id) \
+                        and not self.outbox.contains(owner_id, item['post_id'], chat_id):
+                    prefetched += self.prefetch(items[idx + 1:idx + 1 + lookahead])
+                    message_ids = self.send_migrated_post(item)
+                    if message_ids is None:
+                        # Остановка во время паузы: контрольная точка остается перед этим постом
+                        break
+                    self.journal.record(
+                        owner_id, item['post_id'], chat_id, item['date'], message_ids,
+                        self.content_hash(item['payload'])
+                    )
+                    sent += 1
+                state['last_post_id'] = item['post_id']
+                state['migrated'] += 1
+                self.journal.set_migration(owner_id, chat_id, state)
+                self.journal.commit()
+                self.last_progress = time.monotonic()
+                if self.last_progress - reported >= settings.get('migration_report_interval', 30):
+                    reported = self.last_progress
+                    self.report_migration(owner_id, chat_id, skip + idx + 1, total, start_position, sent, started)
+            else:
+                state['read'] = min(total, skip + count)
+                self.journal.set_migration(owner_id, chat_id, state)
+                self.journal.commit()
+            self.drop_prefetched(prefetched)
+            self.file_ids.evict()
+            self.journal.commit()
+        elapsed = time.monotonic() - started
+        if state['read'] >= total:
+            logging.info(f"Перенос {owner_id} -> {chat_id} завершен: отправлено {sent} постов за {format_duration(elapsed)}")
+        else:
+            logging.info(f"Перенос {owner_id} -> {chat_id} остановлен на {state['read']} из {total}, продолжится со следующего запуска")
+        return sent
+
+    def send_migrated_post(self, item):
+        """Отправляет пост при переносе стены, повторяя неудачи с растущей паузой.
+
+        Повторов до max_attempts, паузы — как у outbox (retry_base_delay,
+        retry_max_delay). Уже отправленные части поста не повторяются.
+        Возвращает id сообщений или None, если перенос остановили во время
+        паузы. Если пост так и не ушел, поднимает RuntimeError: перенос
+        прерывается, и следующий запуск продолжит с этого поста.
+        """
+        settings = CONFIG['settings']
+        processed = item['payload']
+        name = f"{item['owner_id']}_{item['post_id']} -> {item['chat_id']}"
+        attempts = max(1, settings.get('max_attempts', 8))
+        for attempt in range(attempts):
+            try:
+                message_ids = self.send_to_telegram(
+                    processed.text, processed.images, processed.photo_keys, item['chat_id'],
+                    processed.media, processed.sent
+                )
+            except Exception as e:
+                logging.error(f"Ошибка отправки поста {name}: {str(e)}")
+                message_ids = None
+            if message_ids:
+                return message_ids
+            if attempt + 1 == attempts:
+                break
+            delay = min(settings.get('retry_max_delay', 3600), settings.get('retry_base_delay', 30) * 2 ** attempt)
+            logging.warning(f"Пост {name} не перенесен, повтор через {format_duration(delay)}")
+            if self.stopping.wait(delay):
+                return None
+        raise RuntimeError(
+            f"пост {name} не отправлен после {attempts} попыток; перенос продолжится с него при следующем запуске"
+        )
+
+    def report_migration(self, owner_id, chat_id, position, total, start_position, sent, started):
+        # Скорость считаем по продвижению по стене: уже доставленные посты проходятся быстро
+        elapsed = time.monotonic() - started
+        rate = (position - start_position) / elapsed if elapsed > 0 else 0
+        eta = format_duration((total - position) / rate) if rate > 0 else '?'
+        logging.info(
+            f"Перенос {owner_id} -> {chat_id}: {position}/{total} ({position * 100 // max(1, total)}%), "
+            f"{rate * 60:.1f} постов/мин, осталось ~{eta}"
+        )
+        self.events.emit(
+            'migration', owner_id=owner_id, chat_id=str(chat_id), position=position, total=total,
+            sent=sent, rate=round(rate, 3)
+        )
+
+    # ---------------- Асинхронный режим ----------------
+    async def run_async(self):
+        """Асинхронный режим: получение, подготовка и отправка — отдельные задачи.
+
+        Получение кладет посты в ограниченную очередь, подготовка ставит их
+        в outbox, а для каждого чата работает свой отправитель, который
+        шлет посты строго по порядку. Блокирующие запросы выполняются в
+        потоках, так что медленная загрузка в Telegram не задерживает опрос VK.
+        По SIGTERM/SIGINT новые посты больше не берутся, текущие отправки
+        дожидаются завершения (не дольше shutdown_timeout).
+        """
+        import asyncio
+        logging.info("Bot Started (async)")
+        self.events.emit('started', engine='async', sources=len(self.routes))
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        self.async_stop = (loop, stop)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows: обработчик сигнала через обычный signal
+                try:
+                    signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop.set))
+                except ValueError:
+                    # Цикл запущен не в главном потоке — останавливаем через stop()
+                    break
+        if self.stopping.is_set():
+            stop.set()
+
+        posts_queue = asyncio.Queue(maxsize=CONFIG['settings'].get('queue_size', 100))
+        self.posts_queue = posts_queue
+        self.metrics.gauge('vk2tg_posts_queue_depth', posts_queue.qsize)
+        self.wakeups = {}
+        tasks = self.async_tasks = [
+            asyncio.create_task(self.fetch_loop(posts_queue, stop)),
+            asyncio.create_task(self.enqueue_loop(posts_queue, self.wakeups)),
+        ]
+        self.add_senders()
+
+        await stop.wait()
+        logging.info("Получен сигнал остановки, завершаем отправку")
+        self.stopping.set()
+        for wakeup in self.wakeups.values():
+            wakeup.set()
+        # Получение и подготовку прерываем сразу, отправителям даем закончить текущий пост
+        for task in tasks[:2]:
+            task.cancel()
+        done, pending = await asyncio.wait(tasks, timeout=CONFIG['settings'].get('shutdown_timeout', 10))
+        for task in pending:
+            task.cancel()
+        self.journal.commit()
+        if self.shard is not None:
+            self.shard.stop()
+        logging.info("Bot Stopped")
+        self.events.emit('stopped')
+
+    def add_senders(self):
+        # Свой отправитель для каждого чата маршрутов, в том числе добавленного в настройках на лету
+        import asyncio
+        stop = self.async_stop[1]
+        for chats in self.routes.values():
+            for chat_id in map(str, chats):
+                if chat_id not in self.wakeups:
+                    self.wakeups[chat_id] = asyncio.Event()
+                    self.async_tasks.append(
+                        asyncio.create_task(self.deliver_loop(chat_id, self.wakeups[chat_id], stop))
+                    )
+
+    async def wait_or_stop(self, stop, timeout):
+        # Пауза, которую прерывает сигнал остановки
+        import asyncio
+        try:
+            await asyncio.wait_for(stop.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def fetch_loop(self, posts_queue, stop):
+        import asyncio
+        while not stop.is_set():
+            self.last_progress = time.monotonic()
+            try:
+                posts, wait = await asyncio.to_thread(self.fetch_new_posts)
+                self.error_streak = 0
+                for post in sorted(posts, key=lambda x: (x['date'], x['id'])):
+                    await posts_queue.put(post)
+                if wait:
+                    await self.wait_or_stop(stop, self.poll_delay())
+            except Exception as e:
+                logging.error(f"Ошибка получения постов: {str(e)}")
+                await self.wait_or_stop(stop, self.error_delay())
+
+    async def enqueue_loop(self, posts_queue, wakeups):
+        import asyncio
+        while True:
+            # Забираем все, что уже накопилось, и ставим в outbox одной транзакцией
+            posts = [await posts_queue.get()]
+            while not posts_queue.empty():
+                posts.append(posts_queue.get_nowait())
+            try:
+                chats = await asyncio.to_thread(self.enqueue_posts, posts)
+            except Exception as e:
+                logging.error(f"Ошибка подготовки постов: {str(e)}")
+                continue
+            for chat_id in chats:
+                if chat_id in wakeups:
+                    wakeups[chat_id].set()
+
+    async def deliver_loop(self, chat_id, wakeup, stop):
+        # Один отправитель на чат: посты уходят в том же порядке, что и в синхронном режиме
+        import asyncio
+        while not stop.is_set():
+            wakeup.clear()
+            try:
+                await asyncio.to_thread(self.deliver_outbox, chat_id)
+                await asyncio.to_thread(self.file_ids.evict)
+                # Открытая транзакция держала бы запись в базе, которую делят воркеры
+                await asyncio.to_thread(self.journal.commit)
+            except Exception as e:
+                logging.error(f"Ошибка отправки в {chat_id}: {str(e)}")
+            # Просыпаемся по новым постам или раз в несколько секунд для повторов
+            try:
+                await asyncio.wait_for(wakeup.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Репостинг ВКонтакте -> Telegram")
+    parser.add_argument('--dead-letters', action='store_true',
+                        help="показать посты, которые не удалось отправить")
+    parser.add_argument('--replay', metavar='OWNER_POST',
+                        help="вернуть пост (owner_id_post_id или all) из неотправленных в очередь, например --replay=-123_45")
+    parser.add_argument('--events', metavar='HOST:PORT',
+                        help="отправлять события (NDJSON) лаунчеру на локальный сокет")
+    parser.add_argument('--supervise', action='store_true',
+                        help="запустить бота дочерним процессом с перезапуском при падении и зависании")
+    parser.add_argument('--worker', metavar='ID', nargs='?', const='',
+                        help="вести только арендованные источники (шардированный запуск); ID по умолчанию — хост и pid")
+    parser.add_argument('--shards', metavar='N', type=int,
+                        help="запустить N воркеров с перезапуском; источники делятся между ними по аренде")
+    parser.add_argument('--migrate', metavar='OWNER_ID', type=int,
+                        help="перенести всю стену сообщества, начиная со старых постов (продолжается после прерывания)")
+    parser.add_argument('--to', metavar='CHAT', help="чат для --migrate (по умолчанию первый чат маршрута)")
+    parser.add_argument('--restart', action='store_true', help="начать --migrate заново, а не с контрольной точки")
+    parser.add_argument('--config', default=CONFIG_PATH, help="файл настроек (по умолчанию config.json)")
+    args = parser.parse_args()
+
+    if os.path.exists(args.config):
+        try:
+            apply_config(load_config(args.config))
+        except (OSError, ValueError) as e:
+            logging.error(f"Ошибка в настройках {args.config}: {str(e)}")
+            sys.exit(2)
+    # После настроек: журнал сразу сжимает оставшиеся части в log_dir из config.json
+    setup_logging()
+
+    if args.supervise or args.shards:
+        if args.shards:
+            host = socket.gethostname()
+            supervisors = [Supervisor(args.config, f'{host}-{index}') for index in range(args.shards)]
+        else:
+            supervisors = [Supervisor(args.config)]
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: [supervisor.stopping.set() for supervisor in supervisors])
+        if len(supervisors) == 1:
+            sys.exit(supervisors[0].run())
+        codes = [0] * len(supervisors)
+        threads = []
+        for index, supervisor in enumerate(supervisors):
+            def run(index=index, supervisor=supervisor):
+                codes[index] = supervisor.run()
+            threads.append(threading.Thread(target=run, name=supervisor.name))
+            threads[-1].start()
+        for thread in threads:
+            # join с таймаутом, чтобы главный поток успевал принять сигнал
+            while thread.is_alive():
+                thread.join(1)
+        sys.exit(max(codes))
+
+    if args.dead_letters or args.replay:
+        journal = DeliveryJournal(CONFIG['settings'].get('journal_path', 'vk2tg.db'), CONFIG['telegram']['chat_id'])
+        outbox = OutboundQueue(journal, 0, 0, 0, CONFIG['telegram']['chat_id'])
+        if args.dead_letters:
+            for item in outbox.dead_letters():
+                print(
+                    f"{item['owner_id']}_{item['post_id']}\tчат {item['chat_id']}"
+                    f"\tдата {item['date']}\tпопыток {item['attempts']}"
+                )
+        if args.replay:
+            if args.replay == 'all':
+                count = outbox.replay()
+            else:
+                owner_id, post_id = args.replay.rsplit('_', 1)
+                count = outbox.replay(int(owner_id), int(post_id))
+            print(f"Возвращено в очередь: {count}")
+        return
+
+    if args.migrate is not None:
+        # Перенос идет рядом с работающим ботом: его порт метрик уже занят
+        CONFIG['settings']['metrics_port'] = 0
+        bot = VK2TGBot()
+        chat_id = args.to or (bot.routes.get(args.migrate) or [CONFIG['telegram']['chat_id']])[0]
+        if args.restart:
+            bot.journal.reset_migration(args.migrate, chat_id)
+            bot.journal.commit()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: bot.stop())
+        try:
+            bot.migrate_wall(args.migrate, chat_id)
+        except Exception as e:
+            logging.error(f"Ошибка переноса стены: {str(e)}")
+            sys.exit(1)
+        return
+
+    events = None
+    if args.events:
+        try:
+            events = EventChannel(args.events, os.environ.get('VK2TG_EVENTS_TOKEN', ''))
+        except OSError as e:
+            logging.error(f"Не удалось подключиться к каналу событий {args.events}: {str(e)}")
+    shard = None
+    if args.worker is not None:
+        settings = CONFIG['settings']
+        try:
+            # Аренда в отдельном файле: продление не ждет записей журнала
+            store = open_lease_store(settings.get('lease_store') or settings.get('journal_path', 'vk2tg.db') + '.leases')
+        except (sqlite3.Error, ValueError) as e:
+            logging.error(f"Не удалось открыть хранилище аренды: {str(e)}")
+            sys.exit(2)
+        worker_id = args.worker or f'{socket.gethostname()}-{os.getpid()}'
+        shard = ShardMember(store, worker_id, settings.get('lease_ttl', 60))
+    bot = VK2TGBot(events, shard)
+    if os.path.exists(args.config):
+        ConfigWatcher(args.config, lambda: bot.reload_config(args.config)).start()
+    if CONFIG['settings'].get('engine', 'sync') == 'async':
+        import asyncio
+        asyncio.run(bot.run_async())
+    else:
+        # SIGTERM/SIGINT: дописываем текущий пост, остальные остаются в outbox до следующего запуска
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: bot.stop())
+        bot.run()
 
 if __name__ == "__main__":
-    bot = VK2TGBot()
-    bot.run()
\ No newline at end of file
+    main()
\ No newline at end of file